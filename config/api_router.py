@@ -4,7 +4,7 @@ from rest_framework.routers import SimpleRouter
 
 from rapidconsult.chats.api.views import ConversationViewSet, MessageViewSet, ImageMessageUploadView, \
     UserConversationViewSet, MongoMessageViewSet, ImageMessageViewSet
-from rapidconsult.users.api.views import UserViewSet, ContactViewSet
+from rapidconsult.users.api.views import UserViewSet, ContactViewSet, SyncViewSet
 from rapidconsult.scheduling.api.views import (LocationViewSet, DepartmentViewSet, UnitViewSet, OrganizationViewSet,
                                                UserProfileViewSet, RoleViewSet, UnitMembershipViewSet,
                                                OnCallShiftViewSet, UserOrgProfileViewSet, ConsultationViewSet)
@@ -30,6 +30,7 @@ router.register(r'active-conversations', UserConversationViewSet, basename='acti
 router.register(r'save-message', ImageMessageViewSet, basename='save-message')
 router.register(r"consultations", ConsultationViewSet, basename="consultation")
 router.register(r"devices", DeviceViewSet, basename="devices")
+router.register(r"sync", SyncViewSet, basename="sync")
 
 app_name = "api"
 urlpatterns = router.urls
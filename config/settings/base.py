@@ -70,6 +70,7 @@ DJANGO_APPS = [
     "django.contrib.sites",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     # "django.contrib.humanize", # Handy template tags
     "django.contrib.admin",
     "django.forms",
@@ -207,6 +208,69 @@ else:
 
 STATICFILES_DIRS = (BASE_DIR / 'static',)
 
+# Chat uploads (see config/utils.py)
+# ------------------------------------------------------------------------------
+# Files above this size are sent to Spaces as multipart uploads, part by part
+CHAT_UPLOAD_MULTIPART_THRESHOLD = env.int("CHAT_UPLOAD_MULTIPART_THRESHOLD", default=8 * 1024 * 1024)
+CHAT_UPLOAD_PART_SIZE = env.int("CHAT_UPLOAD_PART_SIZE", default=8 * 1024 * 1024)
+CHAT_UPLOAD_MAX_SIZE = env.int("CHAT_UPLOAD_MAX_SIZE", default=100 * 1024 * 1024)
+# Lifetime (seconds) of presigned direct-upload URLs handed to clients
+CHAT_UPLOAD_URL_EXPIRY = env.int("CHAT_UPLOAD_URL_EXPIRY", default=15 * 60)
+# Longest edge (px) of each WebP thumbnail generated for image messages
+CHAT_THUMBNAIL_SIZES = {"small": 160, "medium": 480, "large": 1080}
+# Newest messages per conversation kept serialized in Redis for chat opens (must exceed the 50 sent on connect)
+CHAT_HISTORY_CACHE_SIZE = env.int("CHAT_HISTORY_CACHE_SIZE", default=100)
+CHAT_HISTORY_CACHE_TTL = env.int("CHAT_HISTORY_CACHE_TTL", default=6 * 60 * 60)
+# JSON encoder for WebSocket text frames: "orjson", or "json" for the stdlib encoder
+CHAT_SOCKET_JSON_ENCODER = env("CHAT_SOCKET_JSON_ENCODER", default="orjson")
+# Per-socket outbound queue: typing/presence are shed past the soft limit, and a socket
+# with more frames than the high-water mark waiting is closed (code 4008)
+CHAT_SOCKET_QUEUE_SOFT_LIMIT = env.int("CHAT_SOCKET_QUEUE_SOFT_LIMIT", default=50)
+CHAT_SOCKET_QUEUE_HIGH_WATER = env.int("CHAT_SOCKET_QUEUE_HIGH_WATER", default=1000)
+# Number new messages per conversation (seq) for gap-free reconnect replay. Off by default: run
+# `backfill_message_seq` first, then turn it on (see docs/API_SPECIFICATION.md)
+CHAT_MESSAGE_SEQ = env.bool("CHAT_MESSAGE_SEQ", default=False)
+# Fan out new messages from the `run_message_pipeline` worker (needs a replica set for change
+# streams); off, writers dispatch inline through the same code path
+CHAT_MESSAGE_PIPELINE = env.bool("CHAT_MESSAGE_PIPELINE", default=False)
+# On start, a worker also dispatches undispatched messages from this many seconds back
+CHAT_MESSAGE_PIPELINE_CATCH_UP = env.int("CHAT_MESSAGE_PIPELINE_CATCH_UP", default=60 * 60)
+# A dispatch claim older than this is taken to belong to a dead worker and is reclaimed; keep it
+# well above the time a batch takes to fan out
+CHAT_MESSAGE_PIPELINE_LEASE = env.int("CHAT_MESSAGE_PIPELINE_LEASE", default=5 * 60)
+
+# Scheduling caches
+# ------------------------------------------------------------------------------
+# Per-user org -> allowed locations snapshot (scheduling/access.py): Redis lifetime, and how long a
+# process reuses its own copy (the longest a revoked location stays usable in other processes)
+ORG_ACCESS_CACHE_TTL = env.int("ORG_ACCESS_CACHE_TTL", default=60 * 60)
+ORG_ACCESS_LOCAL_TTL = env.int("ORG_ACCESS_LOCAL_TTL", default=30)
+# Most users whose access snapshot one process keeps in memory
+ORG_ACCESS_LOCAL_MAX_USERS = env.int("ORG_ACCESS_LOCAL_MAX_USERS", default=10000)
+# Lifetime of a cached login / bootstrap payload (users/bootstrap.py); changes invalidate it sooner
+BOOTSTRAP_CACHE_TTL = env.int("BOOTSTRAP_CACHE_TTL", default=24 * 60 * 60)
+# Lifetime of a cached organization tree (scheduling/tree.py); changes invalidate it sooner
+ORG_TREE_CACHE_TTL = env.int("ORG_TREE_CACHE_TTL", default=24 * 60 * 60)
+# Most rows accepted by one POST /api/shifts/import/
+SHIFT_IMPORT_MAX_ROWS = env.int("SHIFT_IMPORT_MAX_ROWS", default=20000)
+# Lifetime of a cached ICS feed (scheduling/feeds.py); shift changes invalidate it sooner
+ICS_FEED_CACHE_TTL = env.int("ICS_FEED_CACHE_TTL", default=24 * 60 * 60)
+# How far back ICS feeds include finished shifts
+ICS_FEED_PAST_DAYS = env.int("ICS_FEED_PAST_DAYS", default=30)
+# Lifetime of a cached department month grid (scheduling/roster.py); changes invalidate it sooner
+ROSTER_CACHE_TTL = env.int("ROSTER_CACHE_TTL", default=24 * 60 * 60)
+# Rows per section of one /api/sync/ page (users/sync.py)
+SYNC_PAGE_SIZE = env.int("SYNC_PAGE_SIZE", default=200)
+# Seconds /api/sync/ stays behind now, so rows stamped before their transaction commits are not skipped
+SYNC_SAFETY_LAG = env.int("SYNC_SAFETY_LAG", default=5)
+# How long removals are kept for /api/sync/; older tokens get a full sync
+SYNC_TOMBSTONE_DAYS = env.int("SYNC_TOMBSTONE_DAYS", default=30)
+# How far back /api/sync/ includes finished shifts
+SYNC_SHIFT_PAST_DAYS = env.int("SYNC_SHIFT_PAST_DAYS", default=30)
+# Lifetime of a cached organization / location / department / role / unit list page
+# (scheduling/api/caching.py); changes invalidate it sooner
+LIST_CACHE_TTL = env.int("LIST_CACHE_TTL", default=24 * 60 * 60)
+
 # TEMPLATES
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#templates
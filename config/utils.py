@@ -1,26 +1,64 @@
+import functools
+import math
+import mimetypes
+import uuid
+from urllib.parse import quote, unquote
+
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from django.conf import settings
-import uuid
-import mimetypes
 
 
-def upload_to_spaces(file, folder="chat"):
+@functools.lru_cache(maxsize=1)
+def get_spaces_client():
+    """
+    Return the process-wide S3 client for DigitalOcean Spaces.
+    boto3 clients are thread-safe and keep their own connection pool, so one is shared by all requests.
+    """
     session = boto3.session.Session()
-    client = session.client(
+    return session.client(
         "s3",
         region_name=settings.AWS_S3_REGION_NAME,
         endpoint_url=settings.AWS_S3_ENDPOINT_URL,
         aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
         aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        config=Config(max_pool_connections=20, retries={"max_attempts": 3, "mode": "standard"}),
     )
 
+
+def get_transfer_config():
+    return TransferConfig(
+        multipart_threshold=settings.CHAT_UPLOAD_MULTIPART_THRESHOLD,
+        multipart_chunksize=settings.CHAT_UPLOAD_PART_SIZE,
+        max_concurrency=4,
+    )
+
+
+def build_object_key(filename, folder="chat"):
+    # Client filenames may carry a path (either separator); only the last component goes into the key
+    name = filename.replace("\\", "/").rsplit("/", 1)[-1] or "file"
+    return f"{folder}/{uuid.uuid4()}-{name}"
+
+
+def get_object_url(key):
+    # Keys keep the client filename, so spaces, '#' and '?' must be escaped to give a working URL
+    return f"{settings.AWS_S3_ENDPOINT_URL}/{settings.AWS_STORAGE_BUCKET_NAME}/{quote(key)}"
+
+
+def upload_to_spaces(file, folder="chat"):
+    client = get_spaces_client()
+
     # Unique filename
-    filename = f"{folder}/{uuid.uuid4()}-{file.name}"
+    filename = build_object_key(file.name, folder)
 
     # Try to get MIME type from a file, fallback to guess
     content_type = (getattr(file, "content_type", None) or mimetypes.guess_type(file.name)[0]
                     or "application/octet-stream")
 
+    # upload_fileobj reads the spooled upload one part at a time; anything above the multipart
+    # threshold goes out as a multipart upload instead of being buffered whole in memory.
     client.upload_fileobj(
         file,
         settings.AWS_STORAGE_BUCKET_NAME,
@@ -28,7 +66,130 @@ def upload_to_spaces(file, folder="chat"):
         ExtraArgs={
             "ACL": "public-read",
             "ContentType": content_type,
+        },
+        Config=get_transfer_config(),
+    )
+
+    return get_object_url(filename)
+
+
+def create_presigned_upload(filename, content_type, size, folder="chat"):
+    """
+    Prepare a direct client -> Spaces upload so the file never passes through an app worker.
+    Small files get a single presigned PUT, large ones a multipart upload with one presigned URL per part.
+    """
+    client = get_spaces_client()
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    key = build_object_key(filename, folder)
+    expires_in = settings.CHAT_UPLOAD_URL_EXPIRY
+
+    if size <= settings.CHAT_UPLOAD_MULTIPART_THRESHOLD:
+        url = client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": bucket, "Key": key, "ContentType": content_type, "ACL": "public-read"},
+            ExpiresIn=expires_in,
+        )
+        return {
+            "method": "single",
+            "key": key,
+            "url": url,
+            "headers": {"Content-Type": content_type, "x-amz-acl": "public-read"},
+            "fileUrl": get_object_url(key),
         }
+
+    part_size = settings.CHAT_UPLOAD_PART_SIZE
+    upload = client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type, ACL="public-read")
+    upload_id = upload["UploadId"]
+    parts = [
+        {
+            "partNumber": part_number,
+            "url": client.generate_presigned_url(
+                "upload_part",
+                Params={"Bucket": bucket, "Key": key, "UploadId": upload_id, "PartNumber": part_number},
+                ExpiresIn=expires_in,
+            ),
+        }
+        for part_number in range(1, math.ceil(size / part_size) + 1)
+    ]
+    return {
+        "method": "multipart",
+        "key": key,
+        "uploadId": upload_id,
+        "partSize": part_size,
+        "parts": parts,
+        "fileUrl": get_object_url(key),
+    }
+
+
+def complete_multipart_upload(key, upload_id, parts):
+    """Stitch the parts a client uploaded with presigned URLs into the final object."""
+    client = get_spaces_client()
+    client.complete_multipart_upload(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"ETag": part["etag"], "PartNumber": int(part["partNumber"])}
+                for part in sorted(parts, key=lambda part: int(part["partNumber"]))
+            ]
+        },
+    )
+    return get_object_url(key)
+
+
+# Throttling and server-side failures: the same request may succeed when sent again
+RETRYABLE_ERROR_CODES = {"InternalError", "ServiceUnavailable", "SlowDown", "RequestTimeout", "Throttling"}
+
+
+def is_retryable_error(error):
+    """Whether a botocore ClientError is transient, so the operation should be retried rather than given up."""
+    response = error.response
+    return (response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+            or response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500)
+
+
+def abort_multipart_upload(key, upload_id):
+    get_spaces_client().abort_multipart_upload(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=key, UploadId=upload_id,
+    )
+
+
+def get_uploaded_object(key):
+    """Return size and content type of an uploaded object, or None if it does not exist."""
+    try:
+        head = get_spaces_client().head_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return {"size": head["ContentLength"], "mimeType": head.get("ContentType")}
+
+
+def get_object_key(url):
+    """Reverse of get_object_url; returns None for URLs outside our bucket."""
+    prefix = get_object_url("")
+    if url and url.startswith(prefix):
+        return unquote(url[len(prefix):])
+    return None
+
+
+def download_from_spaces(key, fileobj):
+    get_spaces_client().download_fileobj(
+        settings.AWS_STORAGE_BUCKET_NAME, key, fileobj, Config=get_transfer_config(),
     )
+    fileobj.seek(0)
+    return fileobj
 
-    return f"{settings.AWS_S3_ENDPOINT_URL}/{settings.AWS_STORAGE_BUCKET_NAME}/{filename}"
+
+def upload_bytes_to_spaces(key, body, content_type):
+    """Store generated content (thumbnails, previews) under a fixed key; it is never rewritten."""
+    get_spaces_client().put_object(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=key,
+        Body=body,
+        ACL="public-read",
+        ContentType=content_type,
+        CacheControl="public, max-age=31536000, immutable",
+    )
+    return get_object_url(key)
@@ -1,12 +1,12 @@
 import datetime
 
-from asgiref.sync import async_to_sync
 from bson import ObjectId
-from channels.layers import get_channel_layer
+from pymongo import DeleteMany, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from rest_framework.exceptions import ValidationError
 
-from rapidconsult.chats.api.serializers import MongoMessageSerializer
-from rapidconsult.chats.utils import update_user_conversation
+from rapidconsult.chats.pipeline import message_saved
+from rapidconsult.chats.utils import insert_message
 from rapidconsult.chats.mongo.models import (
     Conversation, Participant, GroupSettings, DirectMessageInfo, GroupChatInfo, User
 )
@@ -14,6 +14,8 @@ from rapidconsult.chats.mongo.models import UserConversation, Message as MongoMe
 from rapidconsult.scheduling.models import UserOrgProfile
 from rapidconsult.scheduling.models import Consultation
 
+DUPLICATE_KEY = 11000
+
 
 def create_direct_message_conv(user1_id, user2_id, organization_id, location_id, system_message=True):
     existing_users = User.objects(sql_user_id__in=[str(user1_id), str(user2_id)]).only("sql_user_id")
@@ -111,6 +113,7 @@ def create_group_chat(created_by_id, name, description, member_ids, location_id,
                 name=name,
                 description=description,
                 memberCount=len(member_ids),
+                membershipVersion=0,
                 adminIds=[created_by_id],
                 myRole=role
             ),
@@ -123,79 +126,201 @@ def create_group_chat(created_by_id, name, description, member_ids, location_id,
     return conv
 
 
-def add_user_to_group_chat(unit_id: str, user_id: str, is_admin: bool = False):
-    """Add a participant to the unit's group chat conversation."""
-    conversation = Conversation.objects(unitId=str(unit_id), type="group").first()
-    if not conversation:
-        return None
-
-    # Check if already a participant
-    if any(p.userId == user_id for p in conversation.participants):
-        return conversation
-
-    # Check if the user is a legitimate user
-    user = User.objects(sql_user_id=user_id).first()
-    if not user:
-        raise ValidationError({"detail": "User does not exist."})
-
-    name = user.displayName
-    role = "admin" if is_admin else "member"
-
-    participant = Participant(
-        userId=user_id,
-        name=name,
-        role=role,
-        joinedAt=datetime.datetime.utcnow()
+def _sync_member_count(conversation_id: str, member_count: int, version: int):
+    """Write memberCount to every member's inbox entry, unless a later membership change already did."""
+    UserConversation._get_collection().update_many(
+        {
+            "conversationId": conversation_id,
+            "conversationType": "group",
+            "groupChat.membershipVersion": {"$not": {"$gte": version}},
+        },
+        {"$set": {"groupChat.memberCount": member_count, "groupChat.membershipVersion": version}},
     )
-    conversation.participants.append(participant)
-    conversation.updatedAt = datetime.datetime.utcnow()
-    conversation.save()
 
-    # Also add UserConversation record
-    UserConversation(
+
+def _group_inbox_entry(conversation, user_id: str, role: str, now):
+    """Fields of a new member's group UserConversation, for an upsert's $setOnInsert."""
+    user_conv = UserConversation(
         _id=str(ObjectId()),
         userId=user_id,
         conversationId=str(conversation.id),
         conversationType="group",
-        groupChat=dict(
+        groupChat=GroupChatInfo(
             name=conversation.name,
             description=conversation.description,
-            memberCount=len(conversation.participants),
             adminIds=[conversation.createdBy],
-            myRole="member",
+            myRole=role,
         ),
-        updatedAt=datetime.datetime.utcnow(),
+        updatedAt=now,
         locationId=conversation.locationId,
         organizationId=conversation.organizationId,
         unitId=conversation.unitId,
-    ).save()
-
-    return conversation
+    )
+    user_conv.clean()
+    on_insert = user_conv.to_mongo().to_dict()
+    for key in ("userId", "conversationId"):
+        on_insert.pop(key)
+    return on_insert
 
 
-def remove_user_from_group_chat(unit_id: str, user_id: str):
-    """Remove a participant from the unit's group chat conversation."""
-    conversation = Conversation.objects(unitId=str(unit_id), type="group").first()
+def add_user_to_group_chat(unit_id: str, user_id: str, is_admin: bool = False):
+    """
+    Add a participant to the unit's group chat conversation.
+    The participant is pushed atomically only if not already present, so concurrent adds never duplicate.
+    """
+    conversation = Conversation.objects(unitId=str(unit_id), type="group").only(
+        "name", "description", "createdBy", "locationId", "organizationId", "unitId"
+    ).first()
     if not conversation:
         return None
+    conversation_id = str(conversation.id)
+
+    # Check if the user is a legitimate user
+    user = User.objects(sql_user_id=user_id).only("displayName").first()
+    if not user:
+        raise ValidationError({"detail": "User does not exist."})
+
+    now = datetime.datetime.utcnow()
+    role = "admin" if is_admin else "member"
+
+    # Create the inbox entry first, so any membership change that follows also updates its memberCount
+    try:
+        UserConversation._get_collection().update_one(
+            {"userId": user_id, "conversationId": conversation_id},
+            {"$setOnInsert": _group_inbox_entry(conversation, user_id, role, now)},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # A concurrent add of the same user inserted the entry first
+        pass
+
+    participant = Participant(userId=user_id, name=user.displayName, role=role, joinedAt=now)
+    updated = Conversation._get_collection().find_one_and_update(
+        {"_id": conversation.id, "participants.userId": {"$ne": user_id}},
+        {
+            "$push": {"participants": participant.to_mongo()},
+            "$inc": {"membershipVersion": 1},
+            "$set": {"updatedAt": now},
+        },
+        projection={"participants.userId": True, "membershipVersion": True},
+        return_document=ReturnDocument.AFTER,
+    )
+    if updated:
+        _sync_member_count(conversation_id, len(updated["participants"]), updated["membershipVersion"])
+
+    return conversation
 
-    print(user_id)
 
+def remove_user_from_group_chat(unit_id: str, user_id: str):
+    """Remove a participant from the unit's group chat conversation with an atomic $pull."""
     if not User.objects(sql_user_id=user_id).only("sql_user_id").first():
         raise ValidationError({"detail": "User does not exist."})
 
-    before_count = len(conversation.participants)
-    conversation.participants = [p for p in conversation.participants if p.userId != user_id]
-    after_count = len(conversation.participants)
-
-    if before_count != after_count:
-        conversation.updatedAt = datetime.datetime.utcnow()
-        conversation.save()
+    updated = Conversation._get_collection().find_one_and_update(
+        {"unitId": str(unit_id), "type": "group", "participants.userId": user_id},
+        {
+            "$pull": {"participants": {"userId": user_id}},
+            "$inc": {"membershipVersion": 1},
+            "$set": {"updatedAt": datetime.datetime.utcnow()},
+        },
+        projection={"participants.userId": True, "membershipVersion": True},
+        return_document=ReturnDocument.AFTER,
+    )
+    if updated is None:
+        conversation = Conversation.objects(unitId=str(unit_id), type="group").only("id").first()
+        if not conversation:
+            return None
+        conversation_id = str(conversation.id)
+    else:
+        conversation_id = str(updated["_id"])
+        _sync_member_count(conversation_id, len(updated["participants"]), updated["membershipVersion"])
 
     # Remove their UserConversation record
-    UserConversation.objects(userId=user_id, conversationId=str(conversation.id)).delete()
+    UserConversation.objects(userId=user_id, conversationId=conversation_id).delete()
 
-    return conversation
+    return conversation_id
+
+
+def sync_group_chat_members(unit_id: str, added: dict, removed, role_changes: dict):
+    """
+    Apply a unit roster diff to its group chat: `added` and `role_changes` map user ids to is_admin,
+    `removed` lists user ids. Costs one bulk write per collection, however large the unit is.
+    """
+    removed = set(removed)
+    if not (added or removed or role_changes):
+        return None
+
+    conversation = Conversation.objects(unitId=str(unit_id), type="group").only(
+        "name", "description", "createdBy", "locationId", "organizationId", "unitId", "participants"
+    ).first()
+    if not conversation:
+        return None
+    conversation_id = str(conversation.id)
+
+    now = datetime.datetime.utcnow()
+    joined_at = {p.userId: p.joinedAt for p in conversation.participants}
+    # Users without a chat account cannot be participants
+    names = dict(User.objects(sql_user_id__in=list(added)).scalar("sql_user_id", "displayName"))
+    added = {user_id: is_admin for user_id, is_admin in added.items() if user_id in names}
+    promoted = [user_id for user_id, is_admin in role_changes.items() if is_admin]
+    demoted = [user_id for user_id, is_admin in role_changes.items() if not is_admin]
+
+    participants = [
+        Participant(
+            userId=user_id,
+            name=names[user_id],
+            role="admin" if is_admin else "member",
+            joinedAt=joined_at.get(user_id, now),
+        ).to_mongo()
+        for user_id, is_admin in added.items()
+    ]
+    # Pulling the added users as well keeps the push idempotent if some were already participants
+    conversation_ops = [
+        UpdateOne({"_id": conversation.id}, {"$pull": {"participants": {"userId": {"$in": list(removed | set(added))}}}}),
+        UpdateOne({"_id": conversation.id}, {"$push": {"participants": {"$each": participants}}}),
+        UpdateOne(
+            {"_id": conversation.id},
+            {
+                "$set": {
+                    "participants.$[admin].role": "admin",
+                    "participants.$[member].role": "member",
+                    "updatedAt": now,
+                },
+                "$inc": {"membershipVersion": 1},
+            },
+            array_filters=[{"admin.userId": {"$in": promoted}}, {"member.userId": {"$in": demoted}}],
+        ),
+    ]
+    Conversation._get_collection().bulk_write(conversation_ops, ordered=True)
+
+    inbox_ops = [
+        UpdateOne(
+            {"userId": user_id, "conversationId": conversation_id},
+            {"$setOnInsert": _group_inbox_entry(conversation, user_id, "admin" if is_admin else "member", now)},
+            upsert=True,
+        )
+        for user_id, is_admin in added.items()
+    ]
+    if removed:
+        inbox_ops.append(DeleteMany({"conversationId": conversation_id, "userId": {"$in": list(removed)}}))
+    for role, user_ids in (("admin", promoted), ("member", demoted)):
+        if user_ids:
+            inbox_ops.append(UpdateMany(
+                {"conversationId": conversation_id, "userId": {"$in": user_ids}},
+                {"$set": {"groupChat.myRole": role}},
+            ))
+    if inbox_ops:
+        try:
+            UserConversation._get_collection().bulk_write(inbox_ops, ordered=False)
+        except BulkWriteError as e:
+            # Upserts that lost to a concurrent add of the same user: their entry exists already
+            if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                raise
+    updated = Conversation._get_collection().find_one(
+        {"_id": conversation.id}, {"participants.userId": True, "membershipVersion": True}
+    )
+    _sync_member_count(conversation_id, len(updated["participants"]), updated["membershipVersion"])
+    return conversation_id
 
 
 def handle_consult_update_system_message(consult: Consultation):
@@ -262,7 +387,7 @@ def create_system_message(user1_id: str, user2_id: str, organization_id: str, lo
     conversation_id = conv.id
 
     ## Step 2 - Send a system message
-    msg = MongoMessage.objects.create(
+    msg, _ = insert_message(MongoMessage(
         conversationId=str(conversation_id),
         senderId=str(user1_id),
         senderName=str(user1_name),
@@ -271,20 +396,9 @@ def create_system_message(user1_id: str, user2_id: str, organization_id: str, lo
         timestamp=datetime.datetime.utcnow(),
         locationId=str(location_id),
         organizationId=str(organization_id),
-    )
+    ))
 
-    # Update user conversation
-    update_user_conversation(msg)
-
-    # Broadcast over WebSocket
-    channel_layer = get_channel_layer()
-    # Broadcast to group
-    async_to_sync(channel_layer.group_send)(
-        str(conversation_id),
-        {
-            "type": "chat_message_echo",
-            "message": MongoMessageSerializer(msg).data,
-        }
-    )
+    # Inbox updates and the broadcast happen in the message pipeline
+    message_saved(msg)
 
     return msg
@@ -1,12 +1,13 @@
 from rest_framework.permissions import BasePermission
 from rest_framework.exceptions import PermissionDenied
-from rapidconsult.scheduling.models import UserOrgProfile
+from rapidconsult.scheduling.access import get_access
 
 
 class HasOrgLocationAccess(BasePermission):
     """
     Permission that checks if a user belongs to an organization
     and has access to the given location.
+    Served from the cached authorization snapshot (see scheduling/access.py).
     """
 
     def has_permission(self, request, view):
@@ -17,15 +18,10 @@ class HasOrgLocationAccess(BasePermission):
         if not organization_id or not location_id:
             raise PermissionDenied("You must specify an organization and location")
 
-        try:
-            org_profile = UserOrgProfile.objects.get(
-                user_id=user.id,
-                organization_id=organization_id
-            )
-        except UserOrgProfile.DoesNotExist:
+        allowed_location_ids = get_access(user.id).get(str(organization_id))
+        if allowed_location_ids is None:
             raise PermissionDenied("User is not part of this organization_id")
 
-        allowed_location_ids = [str(loc.id) for loc in org_profile.allowed_locations.all()]
         if str(location_id) not in allowed_location_ids:
             raise PermissionDenied("User does not have access to this location_id")
 
@@ -1,16 +1,25 @@
 import datetime
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 
 from rapidconsult.chats.models import Message, Conversation
-from rapidconsult.users.api.serializers import UserSerializer
 
 User = get_user_model()
 
 
+class ChatUserSerializer(serializers.ModelSerializer):
+    """Compact user representation for legacy chat payloads (no org profiles or locations)."""
+
+    class Meta:
+        model = User
+        fields = ["id", "username", "name", "profile_picture"]
+
+
 class MessageSerializer(serializers.ModelSerializer):
-    from_user = serializers.SerializerMethodField()
-    to_user = serializers.SerializerMethodField()
+    """Expects `from_user` / `to_user` to be select_related by the caller."""
+    from_user = ChatUserSerializer(read_only=True)
+    to_user = ChatUserSerializer(read_only=True)
     conversation = serializers.SerializerMethodField()
 
     class Meta:
@@ -27,13 +36,7 @@ class MessageSerializer(serializers.ModelSerializer):
         )
 
     def get_conversation(self, obj):
-        return str(obj.conversation.id)
-
-    def get_from_user(self, obj):
-        return UserSerializer(obj.from_user).data
-
-    def get_to_user(self, obj):
-        return UserSerializer(obj.to_user).data
+        return str(obj.conversation_id)
 
     def get_file(self, obj):
         if obj.file:
@@ -44,6 +47,28 @@ class MessageSerializer(serializers.ModelSerializer):
         return None
 
 
+class ConversationListSerializer(serializers.ListSerializer):
+    """
+    Loads every last message and every other participant for the page in two queries,
+    instead of three queries per conversation.
+    """
+
+    def to_representation(self, data):
+        conversations = list(data.all() if hasattr(data, "all") else data)
+
+        last_message_ids = [c.last_message_id for c in conversations if getattr(c, "last_message_id", None)]
+        usernames = {username for c in conversations for username in c.name.split("__")}
+
+        self.context["last_messages"] = {
+            message.id: message
+            for message in Message.objects.filter(id__in=last_message_ids).select_related("from_user", "to_user")
+        }
+        self.context["users_by_username"] = {
+            user.username: user for user in User.objects.filter(username__in=usernames)
+        }
+        return super().to_representation(conversations)
+
+
 class ConversationSerializer(serializers.ModelSerializer):
     other_user = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
@@ -51,22 +76,28 @@ class ConversationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Conversation
         fields = ("id", "name", "other_user", "last_message")
+        list_serializer_class = ConversationListSerializer
 
     def get_last_message(self, obj):
-        messages = obj.messages.all().order_by("-timestamp")
-        if not messages.exists():
+        last_messages = self.context.get("last_messages")
+        if last_messages is not None:
+            message = last_messages.get(getattr(obj, "last_message_id", None))
+        else:
+            message = obj.messages.select_related("from_user", "to_user").order_by("-timestamp").first()
+        if message is None:
             return None
-        message = messages[0]
         return MessageSerializer(message).data
 
     def get_other_user(self, obj):
-        usernames = obj.name.split("__")
-        context = {}
-        for username in usernames:
+        users_by_username = self.context.get("users_by_username")
+        for username in obj.name.split("__"):
             if username != self.context["user"].username:
                 # This is the other participant
-                other_user = User.objects.get(username=username)
-                return UserSerializer(other_user, context=context).data
+                if users_by_username is not None:
+                    other_user = users_by_username.get(username)
+                else:
+                    other_user = User.objects.filter(username=username).first()
+                return ChatUserSerializer(other_user).data if other_user else None
         return None
 
 
@@ -140,11 +171,69 @@ class GroupChatSerializer(serializers.Serializer):
 
 
 # Message serialization
+class ThumbnailSerializer(serializers.Serializer):
+    name = serializers.CharField()
+    url = serializers.CharField()
+    width = serializers.IntegerField()
+    height = serializers.IntegerField()
+
+
 class MediaSerializer(serializers.Serializer):
     url = serializers.CharField(required=False, allow_blank=True)
     filename = serializers.CharField(required=False, allow_blank=True)
     size = serializers.IntegerField(required=False)
     mimeType = serializers.CharField(required=False, allow_blank=True)
+    width = serializers.IntegerField(required=False)
+    height = serializers.IntegerField(required=False)
+    blurhash = serializers.CharField(required=False, allow_blank=True)
+    thumbnails = ThumbnailSerializer(many=True, required=False)
+
+
+class UploadUrlRequestSerializer(serializers.Serializer):
+    filename = serializers.CharField(max_length=255)
+    contentType = serializers.CharField(required=False, allow_blank=True)
+    size = serializers.IntegerField(min_value=1)
+
+    def validate_size(self, value):
+        if value > settings.CHAT_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f"File exceeds the {settings.CHAT_UPLOAD_MAX_SIZE} byte upload limit.")
+        return value
+
+
+class UploadKeyField(serializers.RegexField):
+    """
+    Key of an object from `upload_url`. Keys sit under the uploader's id (chat/<user id>/...)
+    and are only accepted from that user, so nobody can attach someone else's upload.
+    Needs the request in the serializer context.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(r"^chat/\d+/[^/]+$", **kwargs)
+
+    def to_internal_value(self, data):
+        key = super().to_internal_value(data)
+        request = self.context.get("request")
+        if request is None or key.split("/")[1] != str(request.user.id):
+            raise serializers.ValidationError("Unknown upload key.")
+        return key
+
+
+class UploadedPartSerializer(serializers.Serializer):
+    partNumber = serializers.IntegerField(min_value=1)
+    etag = serializers.CharField()
+
+
+class CompleteUploadSerializer(serializers.Serializer):
+    key = UploadKeyField()
+    uploadId = serializers.CharField()
+    parts = UploadedPartSerializer(many=True, allow_empty=False)
+
+
+class UploadedMediaSerializer(serializers.Serializer):
+    """Metadata a client posts after uploading a file directly to Spaces."""
+    key = UploadKeyField()
+    filename = serializers.CharField(max_length=255)
+    mimeType = serializers.CharField(required=False, allow_blank=True)
 
 
 class SystemMessageSerializer(serializers.Serializer):
@@ -174,6 +263,8 @@ class MongoMessageSerializer(serializers.Serializer):
     readBy = ReadReceiptSerializer(many=True, required=False)
     locationId = serializers.CharField(required=False, allow_blank=True)
     organizationId = serializers.CharField(required=False, allow_blank=True)
+    seq = serializers.IntegerField(required=False)
+    clientMessageId = serializers.CharField(required=False, allow_null=True)
     replyTo = serializers.SerializerMethodField()
 
     @staticmethod
@@ -189,12 +280,8 @@ class MongoMessageSerializer(serializers.Serializer):
                     "content": obj.replyTo.content,
                     "type": obj.replyTo.type,
                     "timestamp": obj.replyTo.timestamp.isoformat() if obj.replyTo.timestamp else None,
-                    "media": {
-                        "url": obj.media.url,
-                        "filename": obj.media.filename,
-                        "size": obj.media.size,
-                        "mimeType": obj.media.mimeType,
-                    } if obj.media else None,
+                    # Previews should render from the thumbnails rather than the full-size original
+                    "media": MediaSerializer(obj.replyTo.media).data if obj.replyTo.media else None,
                 }
             except Exception:
                 return str(obj.replyTo)  # fallback to ID if not a full object
@@ -1,10 +1,15 @@
+import mimetypes
 from datetime import datetime
 
 from asgiref.sync import async_to_sync
+from botocore.exceptions import ClientError
 from bson import ObjectId
 from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
 from mongoengine.errors import ValidationError
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
 from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework.permissions import IsAuthenticated
@@ -12,17 +17,22 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 
-from config.utils import upload_to_spaces
+from config.utils import upload_to_spaces, create_presigned_upload, complete_multipart_upload, \
+    abort_multipart_upload, get_uploaded_object, get_object_url, is_retryable_error
 from rapidconsult.chats.models import Conversation, Message, User
 from rapidconsult.chats.mongo.models import UserConversation, Message as MongoMessage, \
-    Conversation as MongoConversation
+    Conversation as MongoConversation, normalize_search_key
 from .mongo import create_direct_message_conv, create_group_chat
 from .paginaters import MessagePagination
 from .pagination import UserConversationPagination
 from .permissions import HasOrgLocationAccess
 from .serializers import ConversationSerializer, MessageSerializer, UserConversationSerializer, DirectMessageSerializer, \
-    GroupChatSerializer, MongoMessageSerializer
-from ..utils import update_user_conversation
+    GroupChatSerializer, MongoMessageSerializer, UploadUrlRequestSerializer, CompleteUploadSerializer, \
+    UploadedMediaSerializer
+from ..history import HISTORY_ORDER, get_recent_messages
+from ..pipeline import message_saved
+from ..unread import increment_unread_count
+from ..utils import find_client_message, insert_message
 
 
 class ConversationViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
@@ -31,9 +41,10 @@ class ConversationViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
     lookup_field = "name"
 
     def get_queryset(self):
+        last_message = Message.objects.filter(conversation=OuterRef("pk")).order_by("-timestamp")
         queryset = Conversation.objects.filter(
             name__contains=self.request.user.username
-        )
+        ).annotate(last_message_id=Subquery(last_message.values("id")[:1]))
         return queryset
 
     def get_serializer_context(self):
@@ -52,6 +63,7 @@ class MessageViewSet(ListModelMixin, GenericViewSet):
                 conversation__name__contains=self.request.user.username,
             )
             .filter(conversation__name=conversation_name)
+            .select_related("from_user", "to_user")
             .order_by("-timestamp")
         )
         return queryset
@@ -85,6 +97,7 @@ class ImageMessageUploadView(APIView):
             conversation=conversation,
             content=content  # optional
         )
+        increment_unread_count(msg.to_user_id)
 
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
@@ -160,15 +173,11 @@ class UserConversationViewSet(viewsets.ViewSet):
 
         # Apply search filter if provided
         if search:
-            # Search in direct message participant name or group chat name
-            queryset = queryset.filter(
-                __raw__={
-                    "$or": [
-                        {"directMessage.otherParticipantName": {"$regex": search, "$options": "i"}},
-                        {"groupChat.name": {"$regex": search, "$options": "i"}},
-                    ]
-                }
-            )
+            # Prefix match on the normalized participant / group name. The input is escaped and
+            # anchored, so the (userId, organizationId, locationId, searchKey) index is used.
+            search_key = normalize_search_key(search)
+            if search_key:
+                queryset = queryset.filter(searchKey__startswith=search_key)
 
         paginator = self.pagination_class()
         page = paginator.paginate_queryset(queryset, request)
@@ -196,6 +205,25 @@ class UserConversationViewSet(viewsets.ViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+class RecentMessagesWindow:
+    """
+    Sequence over a conversation's messages (newest first) that Django's Paginator can page.
+    Slices are read from the Redis hot window; only the total still comes from Mongo.
+    """
+
+    def __init__(self, conversation_id, queryset):
+        self.conversation_id = conversation_id
+        self.queryset = queryset
+
+    def count(self):
+        return self.queryset.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.start:
+            raise IndexError("Only the first page is served from the hot window")
+        return get_recent_messages(self.conversation_id, item.stop)
+
+
 class MongoMessageViewSet(viewsets.ViewSet):
     """
     Returns paginated messages for a given conversation.
@@ -213,9 +241,27 @@ class MongoMessageViewSet(viewsets.ViewSet):
 
         filters = {"conversationId": conversation_id}
 
-        queryset = MongoMessage.objects(**filters).order_by("-timestamp")
+        # Gap fill after a reconnect: everything after the last sequence number the client holds, oldest first
+        since_seq = request.query_params.get("since_seq")
+        if since_seq is not None:
+            try:
+                filters["seq__gt"] = int(since_seq)
+            except ValueError:
+                return Response({"error": "since_seq must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = MongoMessage.objects(**filters).order_by("seq")
+        else:
+            queryset = MongoMessage.objects(**filters).order_by(*HISTORY_ORDER)
 
         paginator = self.pagination_class()
+
+        # The first page is what every chat open asks for; serve it from the Redis hot window
+        if since_seq is None and request.query_params.get(paginator.page_query_param, "1") == "1":
+            page_size = paginator.get_page_size(request)
+            if page_size <= settings.CHAT_HISTORY_CACHE_SIZE:
+                window = RecentMessagesWindow(conversation_id, queryset)
+                page = paginator.paginate_queryset(window, request)
+                return paginator.get_paginated_response(page)
+
         page = paginator.paginate_queryset(queryset, request)
         serializer = MongoMessageSerializer(page, many=True)
 
@@ -245,19 +291,60 @@ class ImageMessageViewSet(viewsets.ViewSet):
             conversation = MongoConversation.objects(id=conversation_id).first()
         except ValidationError:
             return Response({"error": "Invalid conversationId"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Detect a message type
-        if file:
+        if conversation is None:
+            return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        # A retried send returns the original message before anything is uploaded or stored again
+        client_message_id = request.data.get("clientMessageId") or None
+        if client_message_id is not None and not isinstance(client_message_id, str):
+            return Response({"error": "clientMessageId must be a string"}, status=status.HTTP_400_BAD_REQUEST)
+        if client_message_id is not None and len(client_message_id) > 64:
+            return Response({"error": "clientMessageId is too long"}, status=status.HTTP_400_BAD_REQUEST)
+        existing = find_client_message(conversation_id, str(request.user.id), client_message_id)
+        if existing:
+            return Response(MongoMessageSerializer(existing).data)
+
+        # Files uploaded straight to Spaces (see upload_url) only send their metadata here
+        uploaded_media = request.data.get("media")
+        if not file and uploaded_media:
+            media_serializer = UploadedMediaSerializer(data=uploaded_media, context={"request": request})
+            media_serializer.is_valid(raise_exception=True)
+            media_data = media_serializer.validated_data
+
+            uploaded = get_uploaded_object(media_data["key"])
+            if not uploaded:
+                return Response({"error": "Uploaded file not found"}, status=status.HTTP_400_BAD_REQUEST)
+            # upload_url checked the size the client declared; this is what was actually stored
+            if uploaded["size"] > settings.CHAT_UPLOAD_MAX_SIZE:
+                return Response({"error": f"File exceeds the {settings.CHAT_UPLOAD_MAX_SIZE} byte upload limit"},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            media = {
+                "url": get_object_url(media_data["key"]),
+                "filename": media_data["filename"],
+                "size": uploaded["size"],
+                "mimeType": media_data.get("mimeType") or uploaded["mimeType"],
+            }
+        elif file:
             # Upload image/file to DigitalOcean Spaces
-            file_url = upload_to_spaces(file, folder="chat")
+            media = {
+                "url": upload_to_spaces(file, folder="chat"),
+                "filename": file.name,
+                "size": file.size,
+                "mimeType": file.content_type,
+            }
+        else:
+            media = None
 
+        # Detect a message type
+        if media:
             if reply_to is not None and reply_to != "":
                 replied_to_message = MongoMessage.objects.get(conversationId=conversation_id,
                                                               id=reply_to)
             else:
                 replied_to_message = None
 
-            msg = MongoMessage.objects.create(
+            msg = MongoMessage(
                 conversationId=conversation_id,
                 senderId=str(request.user.id),
                 senderName=str(request.user.name),
@@ -265,14 +352,10 @@ class ImageMessageViewSet(viewsets.ViewSet):
                 type="file",
                 timestamp=datetime.utcnow(),
                 replyTo=replied_to_message,
-                media={
-                    "url": file_url,
-                    "filename": file.name,
-                    "size": file.size,
-                    "mimeType": file.content_type,
-                },
+                media=media,
                 locationId=str(location_id),
                 organizationId=str(organization_id),
+                clientMessageId=client_message_id,
             )
         else:
             # Plain text message
@@ -285,7 +368,7 @@ class ImageMessageViewSet(viewsets.ViewSet):
             else:
                 replied_to_message = None
 
-            msg = MongoMessage.objects.create(
+            msg = MongoMessage(
                 conversationId=conversation_id,
                 senderId=str(request.user.id),
                 senderName=str(request.user.name),
@@ -295,36 +378,50 @@ class ImageMessageViewSet(viewsets.ViewSet):
                 timestamp=datetime.utcnow(),
                 locationId=str(location_id),
                 organizationId=str(organization_id),
+                clientMessageId=client_message_id,
             )
 
-        # Update user conversation
-        update_user_conversation(msg)
+        msg, created = insert_message(msg)
+        if not created:
+            return Response(MongoMessageSerializer(msg).data)
 
-        # Broadcast over WebSocket
-        channel_layer = get_channel_layer()
-        # Broadcast to group
-        async_to_sync(channel_layer.group_send)(
-            conversation_id,
-            {
-                "type": "chat_message_echo",
-                "message": MongoMessageSerializer(msg).data,
-            }
-        )
-
-        # Send push notification
-        from rapidconsult.notifications.services import send_notification
-        participants = conversation.participants
-        for participant in participants:
-            if str(participant.userId) != str(request.user.id):
-                try:
-                    receiver = User.objects.get(id=participant.userId)
-                    send_notification(
-                        user=receiver,
-                        title=f"New message from {request.user.name}",
-                        body=msg.content[:100] if msg.content else "Sent a file",
-                        data={"conversation_id": conversation_id}
-                    )
-                except User.DoesNotExist:
-                    pass
+        # Inbox updates, the broadcast, push notifications and thumbnails (`media_ready`)
+        # are handled by the message pipeline
+        message_saved(msg)
 
         return Response(MongoMessageSerializer(msg).data)
+
+    @action(detail=False, methods=["post"], url_path="upload-url")
+    def upload_url(self, request):
+        """
+        Hand out presigned URL(s) so the client uploads straight to Spaces, then posts the
+        returned `key` as `media` to `create`. Large files get one URL per multipart part.
+        """
+        serializer = UploadUrlRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        content_type = (data.get("contentType") or mimetypes.guess_type(data["filename"])[0]
+                        or "application/octet-stream")
+        # Under the uploader's id: only they can complete the upload or attach it to a message
+        upload = create_presigned_upload(data["filename"], content_type, data["size"],
+                                         folder=f"chat/{request.user.id}")
+        return Response(upload, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=["post"], url_path="complete-upload")
+    def complete_upload(self, request):
+        serializer = CompleteUploadSerializer(data=request.data, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        try:
+            file_url = complete_multipart_upload(data["key"], data["uploadId"], data["parts"])
+        except ClientError as e:
+            if is_retryable_error(e):
+                # The uploaded parts are kept, so the client can simply complete again
+                return Response({"error": "Storage is unavailable, retry completing the upload"},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            abort_multipart_upload(data["key"], data["uploadId"])
+            return Response({"error": "Could not complete upload"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"key": data["key"], "fileUrl": file_url})
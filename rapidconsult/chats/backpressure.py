@@ -0,0 +1,202 @@
+"""
+Bounded, prioritised outbound buffering for the chat WebSockets.
+
+A sync consumer normally writes each frame straight to the socket, so a client that stops
+reading (a phone on poor reception) blocks the consumer, which then stops draining its
+channel-layer queue until channels_redis silently drops events at `capacity`. Instead,
+BackpressureMixin hands frames to a per-connection OutboundQueue drained by a writer task,
+so the consumer keeps up with the channel layer and the queue decides what to shed:
+
+- chat messages (and anything unclassified) are never dropped;
+- typing / presence frames are dropped once the queue is past its soft limit;
+- acks and read updates replace an already queued frame with the same key;
+- past the high-water mark the client is considered hopeless and the socket is closed.
+"""
+import asyncio
+import logging
+from collections import Counter, deque
+
+from django.conf import settings
+
+from rapidconsult.chats.presence import r
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "chats:outbound:metrics"
+# Close code sent to clients that fell too far behind; they should reconnect and resume
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# Frames sent between two flushes of the per-connection stats to Redis
+STATS_FLUSH_EVERY = 100
+
+CONTROL, MESSAGE, DROPPABLE, COALESCED = "control", "message", "droppable", "coalesced"
+
+DROPPABLE_TYPES = {"typing", "presence", "user_join", "user_leave"}
+COALESCED_TYPES = {"read_messages_ack", "last_read_update", "message_read_by_user", "unread_count", "pong"}
+
+_record_peak = r.register_script("""
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > current then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+""")
+
+
+def classify(content):
+    """Priority class and coalescing key of an outgoing frame."""
+    frame_type = content.get("type")
+    if frame_type in DROPPABLE_TYPES:
+        return DROPPABLE, None
+    if frame_type in COALESCED_TYPES:
+        return COALESCED, (frame_type, content.get("conversationId"), content.get("userId"))
+    return MESSAGE, None
+
+
+class OutboundQueue:
+    def __init__(self, soft_limit, high_water):
+        self.soft_limit = soft_limit
+        self.high_water = high_water
+        # Entries are [message] lists so a coalesced frame can be swapped in place
+        self.frames = deque()
+        self.coalesce_keys = {}
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.stats = Counter()
+        self.peak = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, message, priority=MESSAGE, key=None):
+        """Queue a frame; returns False once the client is too far behind to keep."""
+        if self.closed:
+            return True
+
+        depth = len(self.frames)
+        self.stats["frames"] += 1
+        self.stats["depth_total"] += depth
+
+        if priority == DROPPABLE and depth >= self.soft_limit:
+            self.stats["dropped"] += 1
+            return True
+
+        if priority == COALESCED and key in self.coalesce_keys:
+            self.coalesce_keys[key][0] = message
+            self.stats["coalesced"] += 1
+            return True
+
+        if priority != CONTROL and depth >= self.high_water:
+            return False
+
+        entry = [message]
+        self.frames.append(entry)
+        if priority == COALESCED:
+            self.coalesce_keys[key] = entry
+        self.peak = max(self.peak, depth + 1)
+        self.ready.set()
+        return True
+
+    def pop(self):
+        entry = self.frames.popleft()
+        for key, queued in list(self.coalesce_keys.items()):
+            if queued is entry:
+                del self.coalesce_keys[key]
+                break
+        return entry[0]
+
+    async def get(self):
+        while not self.frames:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.pop()
+
+    def abort(self, close_message):
+        """Throw away everything queued and leave only `close_message` to send."""
+        self.stats["disconnected"] += 1
+        self.frames.clear()
+        self.coalesce_keys.clear()
+        self.frames.append([close_message])
+        self.closed = True
+        self.ready.set()
+
+    def take_stats(self):
+        stats, self.stats = self.stats, Counter()
+        peak, self.peak = self.peak, 0
+        return stats, peak
+
+
+class BackpressureMixin:
+    """
+    Route a sync JsonWebsocketConsumer's frames through an OutboundQueue.
+    Goes before the encoding mixin in the MRO so it sees frames as dicts.
+    """
+
+    outbox = None
+    frame_class = (MESSAGE, None)
+
+    async def __call__(self, scope, receive, send):
+        self.outbox = OutboundQueue(settings.CHAT_SOCKET_QUEUE_SOFT_LIMIT, settings.CHAT_SOCKET_QUEUE_HIGH_WATER)
+        writer = asyncio.ensure_future(self._drain(send))
+        try:
+            await super().__call__(scope, receive, self._queue_send)
+        finally:
+            writer.cancel()
+
+    async def _drain(self, send):
+        while True:
+            message = await self.outbox.get()
+            await send(message)
+            if message["type"] == "websocket.close":
+                return
+
+    async def _queue_send(self, message):
+        if message["type"] == "websocket.send":
+            priority, key = self.frame_class
+        else:
+            priority, key = CONTROL, None
+
+        if not self.outbox.put(message, priority, key):
+            logger.warning("%s fell %s frames behind, closing", type(self).__name__, len(self.outbox))
+            self.outbox.abort({"type": "websocket.close", "code": SLOW_CONSUMER_CLOSE_CODE})
+
+    def send_json(self, content, close=False):
+        # Frames are handed over one at a time, so the class travels with the instance
+        self.frame_class = classify(content)
+        try:
+            super().send_json(content, close=close)
+        finally:
+            self.frame_class = (MESSAGE, None)
+
+        if self.outbox.stats["frames"] >= STATS_FLUSH_EVERY:
+            self.flush_outbound_stats()
+
+    def websocket_disconnect(self, message):
+        try:
+            super().websocket_disconnect(message)
+        finally:
+            self.flush_outbound_stats()
+
+    def flush_outbound_stats(self):
+        stats, peak = self.outbox.take_stats()
+        consumer = type(self).__name__
+        pipe = r.pipeline(transaction=False)
+        for metric, amount in stats.items():
+            pipe.hincrby(METRICS_KEY, f"{consumer}:{metric}", amount)
+        pipe.execute()
+        if peak:
+            _record_peak(keys=[METRICS_KEY], args=[f"{consumer}:peak_depth", peak])
+
+
+def get_outbound_stats():
+    """Per consumer type: frames, dropped, coalesced, disconnected, peak and mean queue depth."""
+    stats = {}
+    for field, value in r.hgetall(METRICS_KEY).items():
+        consumer, metric = field.split(":", 1)
+        stats.setdefault(consumer, {})[metric] = int(value)
+    for consumer_stats in stats.values():
+        frames = consumer_stats.get("frames", 0)
+        consumer_stats["mean_depth"] = consumer_stats.pop("depth_total", 0) / frames if frames else 0.0
+    return stats
+
+
+def reset_outbound_stats():
+    r.delete(METRICS_KEY)
@@ -1,33 +1,69 @@
-import json
-from uuid import UUID
+from urllib.parse import parse_qs
 
+from django.conf import settings
 from django.utils import timezone
 from channels.generic.websocket import JsonWebsocketConsumer
 from asgiref.sync import async_to_sync
 
 from rapidconsult.chats.api.serializers import MongoMessageSerializer
+from rapidconsult.chats.backpressure import BackpressureMixin
+from rapidconsult.chats.encoding import MSGPACK_SUBPROTOCOL, dumps, loads, pack, unpack
+from rapidconsult.chats.history import cache_read_receipt, get_recent_messages
+from rapidconsult.chats.pipeline import message_saved
+from rapidconsult.chats.throttling import TYPING_TIMEOUT, TrafficCounters, TypingThrottle
 from rapidconsult.chats.presence import is_online, mark_online, mark_offline, heartbeat, get_last_seen
-from rapidconsult.chats.utils import update_user_conversation
+from rapidconsult.chats.unread import get_unread_count, increment_unread_count, decrement_unread_count
+from rapidconsult.chats.utils import insert_message
 from rapidconsult.chats.models import Conversation, Message, User
+from rapidconsult.scheduling.access import has_location_access
 from rapidconsult.chats.api.serializers import MessageSerializer
 from rapidconsult.chats.mongo.models import Conversation as MongoConversation, Message as MongoMessage, \
     User as MongoUser, LastMessageInfo, UserConversation
 from mongoengine.queryset.visitor import Q
+from bson import ObjectId
 
 
-class UUIDEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, UUID):
-            return obj.hex
-        return json.JSONEncoder.default(self, obj)
+class FastEncodingMixin:
+    """
+    orjson for text frames, and binary MessagePack frames for clients that offer the
+    `msgpack` subprotocol at handshake (both directions). See rapidconsult.chats.encoding.
+    """
+    binary_frames = False
 
+    def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None and MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            subprotocol = MSGPACK_SUBPROTOCOL
+        self.binary_frames = subprotocol == MSGPACK_SUBPROTOCOL
+        super().accept(subprotocol=subprotocol, headers=headers)
 
-class ChatConsumer(JsonWebsocketConsumer):
+    def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.binary_frames:
+            self.receive_json(unpack(bytes_data), **kwargs)
+        else:
+            super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    def send_json(self, content, close=False):
+        if self.binary_frames:
+            self.send(bytes_data=pack(content), close=close)
+        else:
+            super().send_json(content, close=close)
+
+    @classmethod
+    def encode_json(cls, content):
+        return dumps(content)
+
+    @classmethod
+    def decode_json(cls, text_data):
+        return loads(text_data)
+
+
+class ChatConsumer(BackpressureMixin, FastEncodingMixin, JsonWebsocketConsumer):
     def __init__(self):
         super().__init__()
         self.user = None
         self.conversation_name = None
         self.conversation = None
+        self.receiver = None
 
     def connect(self):
         self.user = self.scope["user"]
@@ -43,20 +79,25 @@ class ChatConsumer(JsonWebsocketConsumer):
             self.channel_name,
         )
 
-        # Send last 50 messages
-        messages = self.conversation.messages.all().order_by("-timestamp")[:50]
-        message_count = self.conversation.messages.count()
+        # Send last 50 messages; fetching one extra row tells us whether there are more, so only
+        # longer conversations pay for the count() of message_count (the conversation's total)
+        messages = list(
+            self.conversation.messages.select_related("from_user", "to_user").order_by("-timestamp")[:51]
+        )
+        has_more = len(messages) > 50
+        message_count = self.conversation.messages.count() if has_more else len(messages)
+        messages = messages[:50]
 
         self.send_json({
             "type": "last_50_messages",
             "messages": MessageSerializer(messages, many=True).data,
             "message_count": message_count,
-            "has_more": message_count > 50,
+            "has_more": has_more,
         })
 
         self.send_json({
             "type": "online_user_list",
-            "users": [user.username for user in self.conversation.online.all()],
+            "users": list(self.conversation.online.values_list("username", flat=True)),
         })
 
         async_to_sync(self.channel_layer.group_send)(
@@ -70,10 +111,9 @@ class ChatConsumer(JsonWebsocketConsumer):
         self.conversation.online.add(self.user)
 
         # Initial unread count
-        unread_count = Message.objects.filter(to_user=self.user, read=False).count()
         self.send_json({
             "type": "unread_count",
-            "unread_count": unread_count,
+            "unread_count": get_unread_count(self.user.id),
         })
 
     def disconnect(self, code):
@@ -100,6 +140,7 @@ class ChatConsumer(JsonWebsocketConsumer):
                 content=content.get("message", ""),
                 conversation=self.conversation
             )
+            increment_unread_count(message.to_user_id)
 
             async_to_sync(self.channel_layer.group_send)(
                 self.conversation_name,
@@ -121,28 +162,7 @@ class ChatConsumer(JsonWebsocketConsumer):
             )
 
         elif message_type == "read_messages":
-            # Mark all messages sent *to me* as read
-            messages_to_me = self.conversation.messages.filter(to_user=self.user, read=False)
-
-            for msg in messages_to_me:
-                async_to_sync(self.channel_layer.group_send)(
-                    self.conversation_name,
-                    {
-                        "type": "message_read",
-                        "message_id": str(msg.id),
-                    }
-                )
-
-            # Update unread count for user
-            unread_count = Message.objects.filter(to_user=self.user, read=False).count()
-            async_to_sync(self.channel_layer.group_send)(
-                self.user.username + "__notifications",
-                {
-                    "type": "unread_count",
-                    "unread_count": unread_count,
-                },
-            )
-            messages_to_me.update(read=True)
+            self.read_messages()
 
         elif message_type == "ping":
             async_to_sync(self.channel_layer.group_send)(
@@ -154,13 +174,53 @@ class ChatConsumer(JsonWebsocketConsumer):
 
         return super().receive_json(content, **kwargs)
 
+    def read_messages(self):
+        """
+        Mark all messages sent *to me* as read and announce them in one batched event,
+        rather than one channel-layer publish per message.
+        """
+        read_up_to = timezone.now()
+        message_ids = list(
+            self.conversation.messages.filter(
+                to_user=self.user, read=False, timestamp__lte=read_up_to
+            ).values_list("id", flat=True)
+        )
+        if not message_ids:
+            return
+
+        marked = Message.objects.filter(id__in=message_ids, read=False).update(read=True)
+
+        async_to_sync(self.channel_layer.group_send)(
+            self.conversation_name,
+            {
+                "type": "messages_read",
+                "user": self.user.username,
+                "message_ids": [str(message_id) for message_id in message_ids],
+                "read_up_to": read_up_to.isoformat(),
+            }
+        )
+
+        # Update unread count for user
+        async_to_sync(self.channel_layer.group_send)(
+            self.user.username + "__notifications",
+            {
+                "type": "unread_count",
+                "unread_count": decrement_unread_count(self.user.id, marked),
+            },
+        )
+
     def get_message_receiver(self):
-        usernames = self.conversation_name.split("__")
-        for username in usernames:
-            if username != self.user.username:
-                # This is the receiver
-                return User.objects.get(username=username)
-        return User.objects.get_or_create(username="test")
+        # The receiver never changes for a conversation, so only look it up once per connection
+        if self.receiver is None:
+            usernames = self.conversation_name.split("__")
+            for username in usernames:
+                if username != self.user.username:
+                    # This is the receiver
+                    self.receiver = User.objects.get(username=username)
+                    break
+            else:
+                self.receiver, _ = User.objects.get_or_create(username="test")
+        return self.receiver
 
     def chat_message_echo(self, event):
         self.send_json(event)
@@ -183,12 +243,11 @@ class ChatConsumer(JsonWebsocketConsumer):
     def message_read(self, event):
         self.send_json(event)
 
-    @classmethod
-    def encode_json(cls, content):
-        return json.dumps(content, cls=UUIDEncoder)
+    def messages_read(self, event):
+        self.send_json(event)
 
 
-class NotificationConsumer(JsonWebsocketConsumer):
+class NotificationConsumer(BackpressureMixin, FastEncodingMixin, JsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
         self.user = None
@@ -268,94 +327,122 @@ class NotificationConsumer(JsonWebsocketConsumer):
         self.send_json(event)
 
 
-class VoxChatConsumer(JsonWebsocketConsumer):
+# Reconnect replay is sent in batches, and capped so a long-offline client pages the rest over HTTP
+RESUME_BATCH_SIZE = 100
+RESUME_LIMIT = 1000
+
+
+# `status` of typing frames, both ways (booleans are accepted from clients too)
+TYPING, STOP_TYPING = "typing", "stop_typing"
 
-    def __init__(self):
-        super().__init__()
-        self.user = None
-        self.conversation_id = None
-        self.conversation = None
 
-    def send_last_50_messages(self):
-        last_msgs = MongoMessage.objects(conversationId=self.conversation_id).order_by("-timestamp")[:50]
-        total_count = MongoMessage.objects(conversationId=self.conversation_id).count()
-        has_more = total_count > 50
-        serialized = [MongoMessageSerializer(msg).data for msg in reversed(last_msgs)]
+def to_seq(value):
+    """A client-sent seq as an int, or None when it is not one."""
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_since_seq(scope):
+    values = parse_qs(scope.get("query_string", b"").decode()).get("since_seq")
+    return to_seq(values[0]) if values else None
+
+
+class MongoChatMixin:
+    """
+    Chat operations on Mongo conversations, shared by the single-conversation
+    VoxChatConsumer and the multiplexed MultiplexChatConsumer.
+    Consumers using it must set `self.user` and a `self.typing` TypingThrottle.
+    """
+
+    def send_last_50_messages(self, conversation_id):
+        # Served from the Redis hot window; one extra message tells us whether there are more without a count()
+        recent = get_recent_messages(conversation_id, 51)
+        has_more = len(recent) > 50
+        serialized = list(reversed(recent[:50]))
 
         self.send_json({
             "type": "last_50_messages",
+            "conversationId": conversation_id,
             "messages": serialized,
             "message_count": len(serialized),
             "has_more": has_more,
         })
 
-    def handle_presence(self):
-        participants = self.conversation.participants
-        other = next((p for p in participants if str(p.userId) != str(self.user.id)), None)
-        if other:
-            self.other_user_id = str(other.userId)
-
-            # Immediately inform frontend about other participant's status
-            self.send_json({
-                "type": "presence",
-                "user_id": self.other_user_id,
-                "status": "online" if is_online(self.other_user_id) else "offline",
-                "last_seen": get_last_seen(self.other_user_id),
-            })
-
-            # Listen for presence updates
-            async_to_sync(self.channel_layer.group_add)(
-                "presence_updates",
-                self.channel_name,
+    def resume(self, conversation_id, since_seq):
+        """
+        Stream only the messages after `since_seq`, in order, from the (conversationId, seq) index.
+        Clients that fell further behind than RESUME_LIMIT get `complete: false` and resume again
+        from `lastSeq` (or page the rest over HTTP).
+        """
+        last_seq = since_seq
+        sent = 0
+        complete = False
+        while sent < RESUME_LIMIT:
+            batch = list(
+                MongoMessage.objects(conversationId=conversation_id, seq__gt=last_seq)
+                .order_by("seq")
+                .limit(RESUME_BATCH_SIZE)
             )
+            if batch:
+                sent += len(batch)
+                last_seq = batch[-1].seq
+                self.send_json({
+                    "type": "resume_batch",
+                    "conversationId": conversation_id,
+                    "messages": [MongoMessageSerializer(msg).data for msg in batch],
+                })
+            if len(batch) < RESUME_BATCH_SIZE:
+                complete = True
+                break
 
-        # Subscribe to presence updates
-        async_to_sync(self.channel_layer.group_add)("presence_updates", self.channel_name)
+        self.send_json({
+            "type": "resume_complete",
+            "conversationId": conversation_id,
+            "lastSeq": last_seq,
+            "complete": complete,
+        })
 
-    def connect(self):
-        self.user = self.scope["user"]
-        if not self.user.is_authenticated:
+    def resume_from_client(self, conversation_id, since_seq):
+        """`resume` frame: replay after the client's since_seq (from the start when missing)."""
+        since_seq = to_seq(since_seq or 0)
+        if since_seq is None:
+            self.send_json({"type": "error", "conversationId": conversation_id, "error": "invalid_since_seq"})
             return
+        self.resume(conversation_id, since_seq)
 
-        self.accept()
-
-        # Getting the conversation name using URL route
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.conversation = MongoConversation.objects.get(id=self.conversation_id)
-
-        async_to_sync(self.channel_layer.group_add)(
-            self.conversation_id,
-            self.channel_name,
-        )
-
-        # Sending last 50 messages
-        self.send_last_50_messages()
-
-        # Handle online/offline and last_seen
-        self.handle_presence()
-
-    def disconnect(self, code):
-        print("Disconnected!")
-        if self.user.is_authenticated:
-            async_to_sync(self.channel_layer.group_discard)(
-                self.conversation_id,
-                self.channel_name,
-            )
-            async_to_sync(self.channel_layer.group_discard)(
-                "presence_updates",
-                self.channel_name,
-            )
-        return super().disconnect(code)
+    def send_history(self, conversation_id, since_seq=None):
+        """Initial history for a (re)connect: just the gap if the client says what it has, else the last 50."""
+        if since_seq is None or not settings.CHAT_MESSAGE_SEQ:
+            self.send_last_50_messages(conversation_id)
+        else:
+            self.resume(conversation_id, since_seq)
 
-    def save_message(self, content):
+    def save_message(self, conversation, content):
+        conversation_id = str(conversation.id)
         if content.get("replyTo") is not None:
-            replied_to_message = MongoMessage.objects.get(conversationId=self.conversation_id,
+            replied_to_message = MongoMessage.objects.get(conversationId=conversation_id,
                                                           id=content["replyTo"])
         else:
             replied_to_message = None
 
-        msg = MongoMessage(
-            conversationId=content["conversationId"],
+        client_message_id = content.get("clientMessageId")
+        if client_message_id is not None and (not isinstance(client_message_id, str) or len(client_message_id) > 64):
+            self.send_json({"type": "error", "conversationId": conversation_id, "error": "invalid_client_message_id"})
+            return
+
+        # The message is stamped with the client's org / location, so they must be ones the sender may post in
+        organization_id, location_id = content.get("organizationId"), content.get("locationId")
+        if organization_id is not None and location_id is not None \
+                and not has_location_access(self.user.id, organization_id, location_id):
+            self.send_json({"type": "error", "conversationId": conversation_id, "error": "location_forbidden"})
+            return
+
+        msg, created = insert_message(MongoMessage(
+            conversationId=conversation_id,
             senderId=str(self.user.id),
             senderName=str(self.user.name),
             content=content.get("content"),
@@ -364,89 +451,85 @@ class VoxChatConsumer(JsonWebsocketConsumer):
             replyTo=replied_to_message,
             locationId=str(content.get("locationId")),
             organizationId=str(content.get("organizationId")),
-        )
-        msg.save()
+            clientMessageId=client_message_id,
+        ))
+        if not created:
+            # Retried send: only the sender needs the original back, nothing is fanned out again
+            self.send_json({"type": "chat_message_echo", "message": MongoMessageSerializer(msg).data})
+            return
 
-        # Update user conversation
-        update_user_conversation(msg)
+        # Inbox updates, the echo to the group and push notifications happen in the message pipeline
+        message_saved(msg)
 
-        # Broadcast to group
-        async_to_sync(self.channel_layer.group_send)(
-            self.conversation_id,
-            {
-                "type": "chat_message_echo",
-                "message": MongoMessageSerializer(msg).data,
-            }
-        )
-
-        # Send push notification
-        from rapidconsult.notifications.services import send_notification
-        participants = self.conversation.participants
-        for participant in participants:
-            if str(participant.userId) != str(self.user.id):
-                try:
-                    receiver = User.objects.get(id=participant.userId)
-                    send_notification(
-                        user=receiver,
-                        title=f"New message from {self.user.name}",
-                        body=msg.content[:100] if msg.content else "Sent a file",
-                        data={"conversation_id": self.conversation_id}
-                    )
-                except User.DoesNotExist:
-                    pass
+        # Sending a message ends the typing indicator without waiting for the client's stop frame
+        if self.typing.stop(conversation_id):
+            self.publish_typing(conversation_id, False)
 
         # Updating lastReadAt for the user, user read the messages before he sent the message
-        self.update_last_read_at()
-
-    def typing_status(self, content):
-        status = content["status"]
-        async_to_sync(self.channel_layer.group_send)(
-            self.conversation_id,
-            {
-                "type": "typing",
-                "userId": str(self.user.id),
-                "username": str(self.user.name),
-                "conversationId": self.conversation_id,
-                "status": status,
-            },
-        )
-
-    def update_last_read_at(self):
+        self.update_last_read_at(conversation_id)
+
+    def typing_status(self, conversation_id, content):
+        # Only start / stop edges (and a periodic refresh while typing) reach the group
+        status = content.get("status")
+        typing = status == TYPING or status is True
+        if self.typing.on_frame(conversation_id, typing):
+            self.publish_typing(conversation_id, typing)
+
+    def publish_typing(self, conversation_id, typing):
+        # Clients match the status strings they send: "typing" / "stop_typing"
+        event = {
+            "type": "typing",
+            "userId": str(self.user.id),
+            "username": str(self.user.name),
+            "conversationId": conversation_id,
+            "status": TYPING if typing else STOP_TYPING,
+        }
+        if typing:
+            event["expiresIn"] = TYPING_TIMEOUT
+        async_to_sync(self.channel_layer.group_send)(conversation_id, event)
+
+    def stop_typing_everywhere(self):
+        for conversation_id in self.typing.active():
+            self.typing.stop(conversation_id)
+            self.publish_typing(conversation_id, False)
+
+    def update_last_read_at(self, conversation_id):
         now = timezone.now()
 
         # Update UserConversation doc
         UserConversation.objects(
-            userId=str(self.user.id), conversationId=self.conversation_id
+            userId=str(self.user.id), conversationId=conversation_id
         ).update_one(set__lastReadAt=now, set__unreadCount=0)
 
         # Update the message readBy till now
         MongoMessage.objects(
-            Q(conversationId=self.conversation_id) &
+            Q(conversationId=conversation_id) &
             Q(timestamp__lte=now) &
             Q(readBy__not__elemMatch={"userId": self.user.id})
         ).update(
             add_to_set__readBy={"userId": self.user.id, "readAt": now}
         )
+        cache_read_receipt(conversation_id, self.user.id, now)
 
         # Broadcast back to group (so other clients of this user or admins know)
         async_to_sync(self.channel_layer.group_send)(
-            self.conversation_id,
+            conversation_id,
             {
                 "type": "last_read_update",
                 "userId": str(self.user.id),
-                "conversationId": self.conversation_id,
+                "conversationId": conversation_id,
                 "lastReadAt": now.isoformat(),
             },
         )
 
         # Broadcast user details who read the message
         async_to_sync(self.channel_layer.group_send)(
-            self.conversation_id,
+            conversation_id,
             {
                 "type": "message_read_by_user",
                 "userId": str(self.user.id),
                 "userName": str(self.user.name),
-                "conversationId": self.conversation_id,
+                "conversationId": conversation_id,
                 "readAt": now.isoformat(),
             },
         )
@@ -454,18 +537,122 @@ class VoxChatConsumer(JsonWebsocketConsumer):
         # Ack to the same client (so UI updates divider)
         self.send_json({
             "type": "read_messages_ack",
-            "conversationId": self.conversation_id,
+            "conversationId": conversation_id,
             "lastReadAt": now.isoformat(),
         })
 
+    def chat_message_echo(self, event):
+        self.send_json(event)
+
+    def typing(self, event):
+        self.send_json(event)
+
+    def user_join(self, event):
+        self.send_json(event)
+
+    def user_leave(self, event):
+        self.send_json(event)
+
+    def unread_count(self, event):
+        self.send_json(event)
+
+    def pong(self, event):
+        self.send_json(event)
+
+    def message_read(self, event):
+        self.send_json(event)
+
+    def presence(self, event):
+        self.send_json(event)
+
+    def last_read_update(self, event):
+        self.send_json(event)
+
+    def message_read_by_user(self, event):
+        self.send_json(event)
+
+    def media_ready(self, event):
+        self.send_json(event)
+
+
+class VoxChatConsumer(MongoChatMixin, BackpressureMixin, FastEncodingMixin, JsonWebsocketConsumer):
+
+    def __init__(self):
+        super().__init__()
+        self.user = None
+        self.conversation_id = None
+        self.conversation = None
+        self.counters = TrafficCounters()
+        self.typing = TypingThrottle(self.counters)
+
+    def handle_presence(self):
+        participants = self.conversation.participants
+        other = next((p for p in participants if str(p.userId) != str(self.user.id)), None)
+        if other:
+            self.other_user_id = str(other.userId)
+
+            # Immediately inform frontend about other participant's status
+            self.send_json({
+                "type": "presence",
+                "user_id": self.other_user_id,
+                "status": "online" if is_online(self.other_user_id) else "offline",
+                "last_seen": get_last_seen(self.other_user_id),
+            })
+
+            # Listen for presence updates
+            async_to_sync(self.channel_layer.group_add)(
+                "presence_updates",
+                self.channel_name,
+            )
+
+        # Subscribe to presence updates
+        async_to_sync(self.channel_layer.group_add)("presence_updates", self.channel_name)
+
+    def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            return
+
+        self.accept()
+
+        # Getting the conversation name using URL route
+        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
+        self.conversation = MongoConversation.objects.get(id=self.conversation_id)
+
+        async_to_sync(self.channel_layer.group_add)(
+            self.conversation_id,
+            self.channel_name,
+        )
+
+        # Sending last 50 messages, or only what was missed if the client reconnects with ?since_seq=
+        self.send_history(self.conversation_id, parse_since_seq(self.scope))
+
+        # Handle online/offline and last_seen
+        self.handle_presence()
+
+    def disconnect(self, code):
+        print("Disconnected!")
+        if self.user.is_authenticated:
+            self.stop_typing_everywhere()
+            self.counters.flush()
+            async_to_sync(self.channel_layer.group_discard)(
+                self.conversation_id,
+                self.channel_name,
+            )
+            async_to_sync(self.channel_layer.group_discard)(
+                "presence_updates",
+                self.channel_name,
+            )
+        return super().disconnect(code)
+
     def receive_json(self, content, **kwargs):
         message_type = content["type"]
 
         if message_type == "chat_message":
-            self.save_message(content)
+            self.save_message(self.conversation, content)
 
         elif message_type == "typing":
-            self.typing_status(content)
+            self.typing_status(self.conversation_id, content)
 
         elif message_type == "presence_updates":
             if str(content["user_id"]) == str(self.other_user_id):
@@ -480,17 +667,16 @@ class VoxChatConsumer(JsonWebsocketConsumer):
                 )
 
         elif message_type == "read_messages":
-            self.update_last_read_at()
+            self.update_last_read_at(self.conversation_id)
 
+        elif message_type == "resume":
+            self.resume_from_client(self.conversation_id, content.get("since_seq"))
 
-        # TODO - Connection check
+        # Connection check: answered on this socket only, it also keeps presence alive
         elif message_type == "ping":
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_id,
-                {
-                    "type": "pong"
-                },
-            )
+            heartbeat(self.user.id)
+            self.send_json({"type": "pong"})
+            self.counters.add("ping_direct")
 
         return super().receive_json(content, **kwargs)
 
@@ -506,36 +692,169 @@ class VoxChatConsumer(JsonWebsocketConsumer):
             "last_seen": get_last_seen(self.other_user_id),
         })
 
-    def chat_message_echo(self, event):
-        self.send_json(event)
 
-    def typing(self, event):
-        self.send_json(event)
+class MultiplexChatConsumer(MongoChatMixin, BackpressureMixin, FastEncodingMixin, JsonWebsocketConsumer):
+    """
+    One authenticated socket per client carrying any number of conversations, plus the
+    notification / presence traffic that otherwise needs a separate `notifications/` socket.
 
-    def user_join(self, event):
-        self.send_json(event)
+    Client frames name their conversation with `conversationId`:
+        {"type": "subscribe", "conversationId": "..."}
+        {"type": "unsubscribe", "conversationId": "..."}
+        {"type": "chat_message" | "typing" | "read_messages", "conversationId": "...", ...}
+        {"type": "heartbeat"} / {"type": "ping"}
+    Conversations, push receivers and presence watches are cached for the life of the connection,
+    so switching between chats costs a subscribe frame instead of a new handshake.
+    """
 
-    def user_leave(self, event):
-        self.send_json(event)
+    def __init__(self):
+        super().__init__()
+        self.user = None
+        self.notification_group_name = None
+        # conversation id -> MongoConversation, for subscribed conversations only
+        self.conversations = {}
+        # other participant id -> conversation ids whose presence we forward
+        self.presence_watch = {}
+        self.counters = TrafficCounters()
+        self.typing = TypingThrottle(self.counters)
 
-    def unread_count(self, event):
-        self.send_json(event)
+    def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            return
+        self.accept()
 
-    def pong(self, event):
-        self.send_json(event)
+        self.notification_group_name = self.user.username + "__notifications"
+        async_to_sync(self.channel_layer.group_add)(self.notification_group_name, self.channel_name)
+        async_to_sync(self.channel_layer.group_add)("presence_updates", self.channel_name)
 
-    def message_read(self, event):
-        self.send_json(event)
+        mark_online(self.user.id)
+        async_to_sync(self.channel_layer.group_send)(
+            "presence_updates",
+            {
+                "type": "user_status",
+                "user_id": str(self.user.id),
+                "status": "online",
+            },
+        )
 
-    def presence(self, event):
-        self.send_json(event)
+    def disconnect(self, code):
+        if self.user is not None and self.user.is_authenticated:
+            self.stop_typing_everywhere()
+            self.counters.flush()
+            for conversation_id in list(self.conversations):
+                async_to_sync(self.channel_layer.group_discard)(conversation_id, self.channel_name)
+            async_to_sync(self.channel_layer.group_discard)(self.notification_group_name, self.channel_name)
+            async_to_sync(self.channel_layer.group_discard)("presence_updates", self.channel_name)
+
+            mark_offline(self.user.id)
+            async_to_sync(self.channel_layer.group_send)(
+                "presence_updates",
+                {
+                    "type": "user_status",
+                    "user_id": str(self.user.id),
+                    "status": "offline",
+                },
+            )
+        return super().disconnect(code)
 
-    def last_read_update(self, event):
-        self.send_json(event)
+    def receive_json(self, content, **kwargs):
+        message_type = content.get("type")
+        conversation_id = content.get("conversationId")
 
-    def message_read_by_user(self, event):
-        self.send_json(event)
+        if message_type == "heartbeat":
+            heartbeat(self.user.id)
 
-    @classmethod
-    def encode_json(cls, content):
-        return json.dumps(content, cls=UUIDEncoder)
+        elif message_type == "ping":
+            self.send_json({"type": "pong"})
+
+        elif message_type == "subscribe":
+            self.subscribe(conversation_id, content.get("since_seq"))
+
+        elif message_type == "unsubscribe":
+            self.unsubscribe(conversation_id)
+
+        elif message_type in ("chat_message", "typing", "read_messages", "resume"):
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                self.send_json({"type": "error", "conversationId": conversation_id, "error": "not_subscribed"})
+            elif message_type == "chat_message":
+                self.save_message(conversation, content)
+            elif message_type == "typing":
+                self.typing_status(conversation_id, content)
+            elif message_type == "resume":
+                self.resume_from_client(conversation_id, content.get("since_seq"))
+            else:
+                self.update_last_read_at(conversation_id)
+
+        return super().receive_json(content, **kwargs)
+
+    def subscribe(self, conversation_id, since_seq=None):
+        # A malformed id would make the lookup raise and close every other subscription of the socket
+        if not ObjectId.is_valid(conversation_id):
+            self.send_json({"type": "error", "conversationId": conversation_id, "error": "not_found"})
+            return
+        if since_seq is not None:
+            since_seq = to_seq(since_seq)
+            if since_seq is None:
+                self.send_json({"type": "error", "conversationId": conversation_id, "error": "invalid_since_seq"})
+                return
+        if conversation_id in self.conversations:
+            # Already subscribed (e.g. the client re-opened the chat); just refresh history
+            self.send_history(conversation_id, since_seq)
+            return
+
+        conversation = MongoConversation.objects(
+            id=conversation_id, participants__userId=str(self.user.id)
+        ).only("type", "participants").first()
+        if conversation is None:
+            self.send_json({"type": "error", "conversationId": conversation_id, "error": "not_found"})
+            return
+
+        self.conversations[conversation_id] = conversation
+        async_to_sync(self.channel_layer.group_add)(conversation_id, self.channel_name)
+
+        self.send_json({"type": "subscribed", "conversationId": conversation_id})
+        self.send_history(conversation_id, since_seq)
+
+        if conversation.type == "direct":
+            other = next((p for p in conversation.participants if str(p.userId) != str(self.user.id)), None)
+            if other:
+                other_user_id = str(other.userId)
+                self.presence_watch.setdefault(other_user_id, set()).add(conversation_id)
+                self.send_json({
+                    "type": "presence",
+                    "conversationId": conversation_id,
+                    "user_id": other_user_id,
+                    "status": "online" if is_online(other_user_id) else "offline",
+                    "last_seen": get_last_seen(other_user_id),
+                })
+
+    def unsubscribe(self, conversation_id):
+        if self.conversations.pop(conversation_id, None) is None:
+            return
+
+        if self.typing.stop(conversation_id):
+            self.publish_typing(conversation_id, False)
+        async_to_sync(self.channel_layer.group_discard)(conversation_id, self.channel_name)
+        for user_id, conversation_ids in list(self.presence_watch.items()):
+            conversation_ids.discard(conversation_id)
+            if not conversation_ids:
+                del self.presence_watch[user_id]
+
+        self.send_json({"type": "unsubscribed", "conversationId": conversation_id})
+
+    # --- Presence / notification handlers ---
+    def user_status(self, event):
+        # Presence is broadcast to everyone; only forward users this client has a DM open with
+        if event["user_id"] not in self.presence_watch:
+            return
+        self.send_json({
+            "type": "presence",
+            "user_id": event["user_id"],
+            "status": event["status"],
+            "last_seen": get_last_seen(event["user_id"]),
+        })
+
+    def new_message_notification(self, event):
+        self.send_json(event)
@@ -0,0 +1,72 @@
+"""
+Frame encoders for the chat WebSockets.
+
+Text frames are JSON, produced by orjson unless CHAT_SOCKET_JSON_ENCODER says "json" (the old
+json.dumps + UUIDEncoder path, kept as a fallback). Clients that offer the `msgpack` subprotocol
+at handshake get binary MessagePack frames instead, which are smaller and cheaper to decode on
+phones; they send their own frames as MessagePack too.
+"""
+import datetime
+import json
+from decimal import Decimal
+from uuid import UUID
+
+import msgpack
+import orjson
+from django.conf import settings
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+
+class UUIDEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, UUID):
+            return obj.hex
+        return json.JSONEncoder.default(self, obj)
+
+
+def _default(obj):
+    # orjson handles UUID and datetime natively; these are what DRF data can still hold
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not MessagePack serializable")
+
+
+def orjson_dumps(content):
+    return orjson.dumps(content, default=_default).decode()
+
+
+def stdlib_dumps(content):
+    return json.dumps(content, cls=UUIDEncoder)
+
+
+JSON_ENCODERS = {
+    "orjson": orjson_dumps,
+    "json": stdlib_dumps,
+}
+
+
+def dumps(content):
+    return JSON_ENCODERS[settings.CHAT_SOCKET_JSON_ENCODER](content)
+
+
+def loads(text_data):
+    return orjson.loads(text_data)
+
+
+def pack(content):
+    return msgpack.packb(content, default=_msgpack_default, use_bin_type=True)
+
+
+def unpack(bytes_data):
+    return msgpack.unpackb(bytes_data, raw=False)
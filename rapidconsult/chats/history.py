@@ -0,0 +1,197 @@
+"""
+Hot window of the newest serialized messages of each Mongo conversation, kept in Redis.
+
+The window is a sorted set scored by message timestamp (in milliseconds, the precision Mongo stores),
+capped at CHAT_HISTORY_CACHE_SIZE entries, so it is in the same order as the Mongo reads whether or not
+messages carry a `seq`. Entries with the same timestamp fall back to comparing the serialized JSON, which
+starts with the message id, matching the `-id` tie-break of the Mongo reads.
+It is filled from Mongo on a miss and then maintained write-through: new messages are pushed,
+read receipts and media updates patch the cached entries in place. Writers only touch a window
+that already exists, and every write cancels an in-flight fill (the fill lease), so a fill that
+read Mongo before the write can never publish a window that is missing it.
+"""
+import datetime
+import json
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from rapidconsult.chats.api.serializers import MediaSerializer, MongoMessageSerializer, ReadReceiptSerializer
+from rapidconsult.chats.mongo.models import Message
+from rapidconsult.chats.presence import r
+
+METRICS_KEY = "chats:history:metrics"
+# A fill holds its lease for at most this long (seconds)
+FILL_LEASE_TTL = 10
+# Newest first, ties broken by id; the window and every Mongo read of recent history use this order
+HISTORY_ORDER = ("-timestamp", "-id")
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+_push_if_exists = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[2])
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(tonumber(ARGV[3]) + 1))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+""")
+
+_fill_with_lease = r.register_script("""
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+# Versioned: windows from before timestamp scoring were scored by seq and must not be mixed with new entries
+def _key(conversation_id):
+    return f"chats:history:v2:conv:{conversation_id}"
+
+
+def _lease_key(conversation_id):
+    return f"chats:history:v2:conv:{conversation_id}:lease"
+
+
+def _score(msg):
+    timestamp = msg.timestamp
+    if timestamp.tzinfo is None:
+        # Mongo hands back naive UTC datetimes
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return (timestamp - EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def _dumps(message):
+    return json.dumps(message, cls=DjangoJSONEncoder)
+
+
+def _record(metric, amount=1):
+    r.hincrby(METRICS_KEY, metric, amount)
+
+
+def get_recent_messages(conversation_id, limit):
+    """
+    Return up to `limit` serialized messages of a conversation, newest first.
+    Served from the hot window when it is warm; otherwise read from Mongo and used to warm it.
+    """
+    size = settings.CHAT_HISTORY_CACHE_SIZE
+    if limit <= 0:
+        return []
+    if limit > size:
+        _record("bypass")
+        return [
+            MongoMessageSerializer(msg).data
+            for msg in Message.objects(conversationId=conversation_id).order_by(*HISTORY_ORDER)[:limit]
+        ]
+
+    cached = r.zrevrange(_key(conversation_id), 0, limit - 1)
+    if cached:
+        _record("hits")
+        return [json.loads(entry) for entry in cached]
+
+    _record("misses")
+    lease = uuid.uuid4().hex
+    r.set(_lease_key(conversation_id), lease, ex=FILL_LEASE_TTL)
+
+    messages = list(Message.objects(conversationId=conversation_id).order_by(*HISTORY_ORDER)[:size])
+    serialized = [MongoMessageSerializer(msg).data for msg in messages]
+
+    # A message without a timestamp cannot be placed in the window; serve such conversations from Mongo
+    if serialized and all(msg.timestamp is not None for msg in messages):
+        args = [lease, settings.CHAT_HISTORY_CACHE_TTL]
+        for msg, data in zip(messages, serialized):
+            args.extend([_score(msg), _dumps(data)])
+        if _fill_with_lease(keys=[_key(conversation_id), _lease_key(conversation_id)], args=args):
+            _record("fills")
+        else:
+            _record("fills_aborted")
+
+    return serialized[:limit]
+
+
+def cache_message(msg, data=None):
+    """Write-through for a newly saved message; pass `data` when it is already serialized."""
+    if msg.timestamp is None:
+        # Cannot be placed in the window; drop it (and any fill in flight) so reads go to Mongo
+        r.delete(_key(msg.conversationId), _lease_key(msg.conversationId))
+        return
+    data = data if data is not None else MongoMessageSerializer(msg).data
+    _push_if_exists(
+        keys=[_key(msg.conversationId), _lease_key(msg.conversationId)],
+        args=[_score(msg), _dumps(data), settings.CHAT_HISTORY_CACHE_SIZE, settings.CHAT_HISTORY_CACHE_TTL],
+    )
+
+
+def _patch_window(conversation_id, patch):
+    """Apply `patch(message) -> changed` to every cached entry atomically (WATCH/MULTI, retried on conflict)."""
+    key = _key(conversation_id)
+    lease_key = _lease_key(conversation_id)
+
+    def apply(pipe):
+        changed = []
+        for raw, score in pipe.zrange(key, 0, -1, withscores=True):
+            message = json.loads(raw)
+            if patch(message):
+                changed.append((raw, score, _dumps(message)))
+
+        pipe.multi()
+        pipe.delete(lease_key)
+        for raw, score, updated in changed:
+            pipe.zrem(key, raw)
+            pipe.zadd(key, {updated: score})
+
+    r.transaction(apply, key)
+
+
+def cache_read_receipt(conversation_id, user_id, read_at):
+    """Mirror `update_last_read_at`: every message not yet read by the user gains a receipt."""
+    receipt = dict(ReadReceiptSerializer({"userId": user_id, "readAt": read_at}).data)
+
+    def patch(message):
+        read_by = message.get("readBy") or []
+        if any(str(existing.get("userId")) == receipt["userId"] for existing in read_by):
+            return False
+        message["readBy"] = read_by + [receipt]
+        return True
+
+    _patch_window(conversation_id, patch)
+
+
+def cache_media_update(conversation_id, message_id, media):
+    """Swap in processed media (thumbnails, blurhash) for a message and for replies quoting it."""
+    data = MediaSerializer(media).data
+
+    def patch(message):
+        changed = False
+        if message.get("id") == message_id:
+            message["media"] = data
+            changed = True
+        reply_to = message.get("replyTo")
+        if isinstance(reply_to, dict) and reply_to.get("id") == message_id:
+            reply_to["media"] = data
+            changed = True
+        return changed
+
+    _patch_window(conversation_id, patch)
+
+
+def get_cache_stats():
+    stats = {metric: int(value) for metric, value in r.hgetall(METRICS_KEY).items()}
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    stats["hit_ratio"] = stats.get("hits", 0) / lookups if lookups else 0.0
+    return stats
+
+
+def reset_cache_stats():
+    r.delete(METRICS_KEY)
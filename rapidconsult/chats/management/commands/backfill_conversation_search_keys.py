@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from rapidconsult.chats.mongo.models import UserConversation, normalize_search_key
+
+
+class Command(BaseCommand):
+    help = "Backfill the normalized searchKey on existing UserConversations."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of updates sent to Mongo per bulk write",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        collection = UserConversation._get_collection()
+
+        updated_count = 0
+        operations = []
+        queryset = UserConversation.objects.only("conversationType", "directMessage", "groupChat", "searchKey")
+        for user_conv in queryset.no_cache():
+            search_key = normalize_search_key(user_conv.get_display_name())
+            if user_conv.searchKey == search_key:
+                continue
+
+            operations.append(UpdateOne({"_id": user_conv.pk}, {"$set": {"searchKey": search_key}}))
+            if len(operations) >= batch_size:
+                updated_count += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+
+        if operations:
+            updated_count += collection.bulk_write(operations, ordered=False).modified_count
+
+        self.stdout.write(self.style.SUCCESS(f"Backfill complete. Updated {updated_count} user conversations."))
@@ -0,0 +1,50 @@
+from bson import ObjectId
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import UpdateOne
+
+from rapidconsult.chats.mongo.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Number unsequenced messages per conversation in timestamp order (from 1, or after the "
+        "highest seq already assigned) and set lastSeq. Run with CHAT_MESSAGE_SEQ off, then turn it on."
+    )
+
+    def handle(self, *args, **options):
+        if settings.CHAT_MESSAGE_SEQ:
+            # Live writers take max(seq) + 1, which would collide with the numbers handed out here
+            raise CommandError("Turn CHAT_MESSAGE_SEQ off (and restart the app servers) before backfilling.")
+
+        conversations = Conversation._get_collection()
+        messages = Message._get_collection()
+
+        updated_count = 0
+        for conversation_id in Message.objects(seq__exists=False).distinct("conversationId"):
+            if not ObjectId.is_valid(conversation_id):
+                continue
+            pending = list(
+                messages.find({"conversationId": conversation_id, "seq": {"$exists": False}}, {"_id": True})
+                .sort([("timestamp", 1), ("_id", 1)])
+            )
+            # History is numbered from 1. Seqs already handed out (the flag was on for a while) are
+            # kept, since clients may hold them, and the stragglers are numbered after them.
+            last = messages.find_one(
+                {"conversationId": conversation_id, "seq": {"$exists": True}}, {"seq": True}, sort=[("seq", -1)]
+            )
+            first_seq = last["seq"] + 1 if last else 1
+
+            result = messages.bulk_write(
+                [
+                    UpdateOne({"_id": message["_id"]}, {"$set": {"seq": seq}})
+                    for seq, message in enumerate(pending, start=first_seq)
+                ],
+                ordered=False,
+            )
+            conversations.update_one(
+                {"_id": ObjectId(conversation_id)}, {"$max": {"lastSeq": first_seq + len(pending) - 1}}
+            )
+            updated_count += result.modified_count
+
+        self.stdout.write(self.style.SUCCESS(f"Backfill complete. Sequenced {updated_count} messages."))
@@ -0,0 +1,66 @@
+import datetime
+import statistics
+import time
+
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+
+from rapidconsult.chats.mongo.models import DirectMessageInfo, UserConversation, normalize_search_key
+
+
+class Command(BaseCommand):
+    help = "Compare the legacy regex inbox search against the indexed searchKey prefix search."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=5000, help="Conversations seeded for the user")
+        parser.add_argument("--runs", type=int, default=50, help="Query repetitions per strategy")
+        parser.add_argument("--search", type=str, default="dr. sm", help="Search term to benchmark")
+
+    def handle(self, *args, **options):
+        user_id = f"benchmark-{ObjectId()}"
+        organization_id, location_id = "benchmark-org", "benchmark-loc"
+        search = options["search"]
+
+        self.stdout.write(f"Seeding {options['conversations']} conversations for {user_id}...")
+        now = datetime.datetime.utcnow()
+        docs = []
+        for i in range(options["conversations"]):
+            name = f"Dr. {'Smith' if i % 100 == 0 else 'Jones'} {i}"
+            docs.append(UserConversation(
+                _id=str(ObjectId()),
+                userId=user_id,
+                conversationId=str(ObjectId()),
+                conversationType="direct",
+                directMessage=DirectMessageInfo(otherParticipantId=str(i), otherParticipantName=name),
+                updatedAt=now - datetime.timedelta(minutes=i),
+                organizationId=organization_id,
+                locationId=location_id,
+                searchKey=normalize_search_key(name),
+            ))
+        UserConversation.objects.insert(docs, load_bulk=False)
+
+        try:
+            base = UserConversation.objects(userId=user_id, organizationId=organization_id, locationId=location_id)
+            legacy = base.filter(__raw__={
+                "$or": [
+                    {"directMessage.otherParticipantName": {"$regex": search, "$options": "i"}},
+                    {"groupChat.name": {"$regex": search, "$options": "i"}},
+                ]
+            }).order_by("-updatedAt")
+            indexed = base.filter(searchKey__startswith=normalize_search_key(search)).order_by("-updatedAt")
+
+            for label, queryset in (("legacy $regex", legacy), ("searchKey prefix", indexed)):
+                timings = []
+                for _ in range(options["runs"]):
+                    start = time.perf_counter()
+                    list(queryset.clone()[:20])
+                    timings.append((time.perf_counter() - start) * 1000)
+
+                stats = queryset.clone().explain().get("executionStats", {})
+                self.stdout.write(
+                    f"{label:>18}: median {statistics.median(timings):.2f} ms, "
+                    f"p95 {sorted(timings)[int(len(timings) * 0.95) - 1]:.2f} ms, "
+                    f"docs examined {stats.get('totalDocsExamined', 'n/a')}"
+                )
+        finally:
+            UserConversation.objects(userId=user_id).delete()
@@ -0,0 +1,76 @@
+import datetime
+import time
+
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+
+from rapidconsult.chats.encoding import loads, orjson_dumps, pack, stdlib_dumps, unpack
+
+
+def _history_frame(message_count):
+    """A `last_50_messages` frame shaped like MongoMessageSerializer output."""
+    conversation_id = str(ObjectId())
+    now = datetime.datetime.utcnow()
+    messages = []
+    for i in range(message_count):
+        timestamp = (now - datetime.timedelta(minutes=message_count - i)).isoformat() + "Z"
+        messages.append({
+            "id": str(ObjectId()),
+            "conversationId": conversation_id,
+            "senderName": "Dr. Jane Doe" if i % 2 else "Dr. John Smith",
+            "senderId": str(40 + i % 2),
+            "content": "Patient in bed 12 is stable, BP 120/80, please review the latest labs before rounds.",
+            "type": "text",
+            "timestamp": timestamp,
+            "media": None,
+            "systemMessage": None,
+            "isEdited": False,
+            "editedAt": None,
+            "isDeleted": False,
+            "deletedAt": None,
+            "readBy": [{"userId": str(40 + (i + 1) % 2), "readAt": timestamp}],
+            "locationId": "2",
+            "organizationId": "1",
+            "seq": i + 1,
+            "replyTo": None,
+        })
+    return {
+        "type": "last_50_messages",
+        "conversationId": conversation_id,
+        "messages": messages,
+        "message_count": len(messages),
+        "has_more": True,
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare frames/sec and bytes on the wire of the WebSocket encoders for a typical history frame."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=50, help="Messages in the history frame")
+        parser.add_argument("--runs", type=int, default=2000, help="Frames encoded per encoder")
+
+    def handle(self, *args, **options):
+        frame = _history_frame(options["messages"])
+        runs = options["runs"]
+
+        encoders = [
+            ("json + UUIDEncoder", stdlib_dumps, loads),
+            ("orjson", orjson_dumps, loads),
+            ("msgpack (binary)", pack, unpack),
+        ]
+
+        self.stdout.write(f"{'encoder':<20}{'encode/s':>12}{'decode/s':>12}{'bytes':>10}")
+        for name, encode, decode in encoders:
+            start = time.perf_counter()
+            for _ in range(runs):
+                payload = encode(frame)
+            encode_rate = runs / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(runs):
+                decode(payload)
+            decode_rate = runs / (time.perf_counter() - start)
+
+            size = len(payload.encode() if isinstance(payload, str) else payload)
+            self.stdout.write(f"{name:<20}{encode_rate:>12,.0f}{decode_rate:>12,.0f}{size:>10,}")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from rapidconsult.chats.backpressure import get_outbound_stats, reset_outbound_stats
+from rapidconsult.chats.throttling import get_traffic_stats, reset_traffic_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Show how much typing / ping chatter the chat sockets kept off the channel layer, "
+        "and outbound queue depth / shedding per consumer type."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Clear the counters after printing them")
+
+    def handle(self, *args, **options):
+        stats = get_traffic_stats()
+        for metric in ("typing_received", "typing_published", "typing_coalesced", "typing_rate_limited",
+                       "ping_direct"):
+            self.stdout.write(f"{metric:>20}: {stats.get(metric, 0)}")
+        self.stdout.write(self.style.SUCCESS(f"{'events_saved':>20}: {stats['events_saved']}"))
+
+        for consumer, outbound in sorted(get_outbound_stats().items()):
+            self.stdout.write(f"\n{consumer} outbound queue")
+            for metric in ("frames", "dropped", "coalesced", "disconnected", "peak_depth"):
+                self.stdout.write(f"{metric:>20}: {outbound.get(metric, 0)}")
+            self.stdout.write(f"{'mean_depth':>20}: {outbound['mean_depth']:.2f}")
+
+        if options["reset"]:
+            reset_traffic_stats()
+            reset_outbound_stats()
+            self.stdout.write("Counters reset.")
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from rapidconsult.chats.mongo.models import UserConversation
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete duplicate UserConversations (same conversationId and userId), keeping the most "
+        "recently updated one, so the unique inbox index can be built."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the duplicates")
+
+    def handle(self, *args, **options):
+        # The raw collection: UserConversation._get_collection() would try to build the unique index first
+        collection = UserConversation._get_db()[UserConversation._get_collection_name()]
+
+        duplicates = collection.aggregate([
+            {"$sort": {"updatedAt": -1, "_id": -1}},
+            {"$group": {"_id": {"conversationId": "$conversationId", "userId": "$userId"}, "ids": {"$push": "$_id"},
+                        "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ], allowDiskUse=True)
+
+        stale_ids = [stale_id for group in duplicates for stale_id in group["ids"][1:]]
+        if stale_ids and not options["dry_run"]:
+            collection.delete_many({"_id": {"$in": stale_ids}})
+
+        verb = "Found" if options["dry_run"] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {len(stale_ids)} duplicate user conversations."))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from rapidconsult.chats.history import get_cache_stats, reset_cache_stats
+
+
+class Command(BaseCommand):
+    help = "Show hit/miss counters of the Redis hot-window message cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Clear the counters after printing them")
+
+    def handle(self, *args, **options):
+        stats = get_cache_stats()
+        for metric in ("hits", "misses", "fills", "fills_aborted", "bypass"):
+            self.stdout.write(f"{metric:>14}: {stats.get(metric, 0)}")
+        self.stdout.write(self.style.SUCCESS(f"{'hit ratio':>14}: {stats['hit_ratio']:.1%}"))
+
+        if options["reset"]:
+            reset_cache_stats()
+            self.stdout.write("Counters reset.")
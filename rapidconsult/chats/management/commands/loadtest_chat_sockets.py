@@ -0,0 +1,127 @@
+import asyncio
+import time
+import tracemalloc
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from config.routing import websocket_urlpatterns
+from rapidconsult.chats.middleware import TokenAuthMiddleware
+from rapidconsult.chats.mongo.models import UserConversation
+from rapidconsult.users.models import User
+
+
+async def _receive_until(communicator, frame_type):
+    while True:
+        frame = await communicator.receive_json_from(timeout=10)
+        if frame.get("type") == frame_type:
+            return frame
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate clinicians flipping between chats, once with one socket per conversation "
+        "(voxchats/<id>/ + notifications/) and once over the multiplexed voxchats/ socket, "
+        "and report handshakes, switch latency and memory per user."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Users taking part in the run")
+        parser.add_argument("--conversations", type=int, default=5, help="Conversations each user flips between")
+        parser.add_argument("--switches", type=int, default=30, help="Chat switches per user")
+
+    def handle(self, *args, **options):
+        user_ids = UserConversation.objects.distinct("userId")[:options["users"]]
+        if not user_ids:
+            raise CommandError("No users with conversations found.")
+
+        clients = []
+        for user in User.objects.filter(id__in=user_ids):
+            conversation_ids = list(
+                UserConversation.objects(userId=str(user.id))
+                .order_by("-updatedAt")
+                .limit(options["conversations"])
+                .scalar("conversationId")
+            )
+            token, _ = Token.objects.get_or_create(user=user)
+            clients.append((token.key, conversation_ids))
+
+        application = TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
+        for label, scenario in (("per-conversation sockets", self.run_legacy), ("multiplexed socket", self.run_multiplexed)):
+            handshakes, switch_ms, memory = asyncio.run(scenario(application, clients, options["switches"]))
+            self.stdout.write(
+                f"{label:>25}: {handshakes} handshakes ({handshakes / len(clients):.1f}/user), "
+                f"{switch_ms:.1f} ms/switch, {memory / len(clients) / 1024:.1f} KiB/user"
+            )
+
+    @staticmethod
+    async def _open(application, path):
+        communicator = WebsocketCommunicator(application, path)
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise CommandError(f"Could not connect to {path.split('?')[0]}")
+        return communicator
+
+    async def run_legacy(self, application, clients, switches):
+        handshakes, elapsed = 0, 0.0
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        # Steady state: a notifications socket plus the socket of the open chat
+        open_sockets = []
+        for token, conversation_ids in clients:
+            notifications = await self._open(application, f"/notifications/?token={token}")
+            chat = await self._open(application, f"/voxchats/{conversation_ids[0]}/?token={token}")
+            await _receive_until(chat, "last_50_messages")
+            handshakes += 2
+            open_sockets.append([notifications, chat])
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        for (token, conversation_ids), sockets in zip(clients, open_sockets, strict=True):
+            for i in range(1, switches + 1):
+                start = time.perf_counter()
+                await sockets[1].disconnect()
+                sockets[1] = await self._open(
+                    application, f"/voxchats/{conversation_ids[i % len(conversation_ids)]}/?token={token}",
+                )
+                await _receive_until(sockets[1], "last_50_messages")
+                elapsed += time.perf_counter() - start
+                handshakes += 1
+
+        for sockets in open_sockets:
+            for communicator in sockets:
+                await communicator.disconnect()
+        return handshakes, elapsed * 1000 / (switches * len(clients)), memory
+
+    async def run_multiplexed(self, application, clients, switches):
+        handshakes, elapsed = 0, 0.0
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        open_sockets = []
+        for token, conversation_ids in clients:
+            communicator = await self._open(application, f"/voxchats/?token={token}")
+            await communicator.send_json_to({"type": "subscribe", "conversationId": conversation_ids[0]})
+            await _receive_until(communicator, "last_50_messages")
+            handshakes += 1
+            open_sockets.append(communicator)
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        for (_, conversation_ids), communicator in zip(clients, open_sockets, strict=True):
+            for i in range(1, switches + 1):
+                start = time.perf_counter()
+                previous = conversation_ids[(i - 1) % len(conversation_ids)]
+                await communicator.send_json_to({"type": "unsubscribe", "conversationId": previous})
+                await communicator.send_json_to(
+                    {"type": "subscribe", "conversationId": conversation_ids[i % len(conversation_ids)]},
+                )
+                await _receive_until(communicator, "last_50_messages")
+                elapsed += time.perf_counter() - start
+
+        for communicator in open_sockets:
+            await communicator.disconnect()
+        return handshakes, elapsed * 1000 / (switches * len(clients)), memory
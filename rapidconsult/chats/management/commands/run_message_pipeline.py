@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rapidconsult.chats.pipeline import watch
+
+
+class Command(BaseCommand):
+    help = (
+        "Tail new Mongo messages and fan them out (inbox updates, broadcast, push) in batches. "
+        "Run N workers with --partitions N and a distinct --partition each."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--partition", type=int, default=0, help="Index of this worker")
+        parser.add_argument("--partitions", type=int, default=1, help="Number of workers (at most 16)")
+        parser.add_argument("--batch-size", type=int, default=100, help="Messages dispatched per batch")
+        parser.add_argument("--max-wait-ms", type=int, default=200, help="Longest wait to fill a batch")
+
+    def handle(self, *args, **options):
+        partitions = options["partitions"]
+        if not 1 <= partitions <= 16 or not 0 <= options["partition"] < partitions:
+            raise CommandError("Need 1 <= --partitions <= 16 and 0 <= --partition < --partitions.")
+        if not settings.CHAT_MESSAGE_PIPELINE:
+            # Writers dispatch inline, and a standalone Mongo has no change streams to tail
+            self.stdout.write("CHAT_MESSAGE_PIPELINE is off; messages are dispatched inline. Exiting.")
+            return
+
+        self.stdout.write(f"Message pipeline worker {options['partition']} of {partitions} started.")
+        watch(
+            partition=options["partition"],
+            partitions=partitions,
+            batch_size=options["batch_size"],
+            max_wait_ms=options["max_wait_ms"],
+        )
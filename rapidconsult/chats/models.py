@@ -44,5 +44,13 @@ class Message(models.Model):
     file = models.FileField(blank=True, null=True)
     read = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # History pages and the "last message" subquery
+            models.Index(fields=["conversation", "-timestamp"], name="chats_msg_conv_ts_idx"),
+            # Unread counts per recipient
+            models.Index(fields=["to_user", "read"], name="chats_msg_to_user_read_idx"),
+        ]
+
     def __str__(self):
         return f"From {self.from_user.username} to {self.to_user.username}: {self.content} [{self.timestamp}]"
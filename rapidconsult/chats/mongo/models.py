@@ -1,8 +1,9 @@
 import datetime
+import unicodedata
 
 from mongoengine import (
     Document, StringField, BooleanField, IntField, DateTimeField,
-    EmbeddedDocument, EmbeddedDocumentField, ListField, URLField, ReferenceField
+    EmbeddedDocument, EmbeddedDocumentField, ListField, URLField, ReferenceField, DictField
 )
 
 
@@ -72,13 +73,18 @@ class Conversation(Document):
     locationId = StringField()
     organizationId = StringField()
     unitId = StringField()
+    # Highest sequence number stored in this conversation (see utils.insert_message)
+    lastSeq = IntField(default=0)
+    # Bumped by every participant $push/$pull so member counts are never overwritten by an older change
+    membershipVersion = IntField(default=0)
 
     meta = {
         "collection": "conversations",
         "indexes": [
             {"fields": ["type", "directMessageParticipants"]},
             {"fields": ["participants.userId"]},
-            {"fields": ["isActive", "-updatedAt"]}
+            {"fields": ["isActive", "-updatedAt"]},
+            {"fields": ["unitId", "type"]},
         ]
     }
 
@@ -86,11 +92,23 @@ class Conversation(Document):
 # ---------------------------
 # Messages
 # ---------------------------
+class Thumbnail(EmbeddedDocument):
+    name = StringField()
+    url = StringField()
+    width = IntField()
+    height = IntField()
+
+
 class Media(EmbeddedDocument):
     url = StringField()
     filename = StringField()
     size = IntField()
     mimeType = StringField()
+    # Filled in by the media-processing task once the upload has been analysed
+    width = IntField()
+    height = IntField()
+    blurhash = StringField()
+    thumbnails = ListField(EmbeddedDocumentField(Thumbnail))
 
 
 class SystemMessage(EmbeddedDocument):
@@ -120,17 +138,49 @@ class Message(Document):
     readBy = ListField(EmbeddedDocumentField(ReadReceipt))
     locationId = StringField()
     organizationId = StringField()
+    # Per-conversation, strictly increasing; lets clients detect and replay gaps after a reconnect
+    seq = IntField()
+    # Client-generated id of the send; a retried send with the same id returns the original message
+    clientMessageId = StringField(max_length=64)
+    # Claimed by the message pipeline once inbox updates, broadcast and push have been done
+    dispatched = BooleanField(default=False)
+    dispatchBatch = StringField()
+    # Set while a batch is being fanned out; a claim left behind by a dead worker is reclaimed
+    dispatchClaimedAt = DateTimeField()
 
     meta = {
         "collection": "messages",
         "indexes": [
             {"fields": ["conversationId", "-timestamp"]},
             {"fields": ["senderId", "-timestamp"]},
-            {"fields": ["conversationId", "content", "type"]}
+            {"fields": ["conversationId", "content", "type"]},
+            {
+                "fields": ["conversationId", "seq"],
+                "unique": True,
+                "partialFilterExpression": {"seq": {"$exists": True}},
+            },
+            # Replaces the (conversationId, clientMessageId) index, which has to be dropped by hand
+            {
+                "fields": ["conversationId", "senderId", "clientMessageId"],
+                "unique": True,
+                "partialFilterExpression": {"clientMessageId": {"$type": "string"}},
+            },
+            # Catch-up sweep of the message pipeline
+            {"fields": ["timestamp"], "partialFilterExpression": {"dispatched": False}},
+            {"fields": ["dispatchClaimedAt"], "partialFilterExpression": {"dispatchClaimedAt": {"$exists": True}}},
         ]
     }
 
 
+class StreamCheckpoint(Document):
+    """Last processed change-stream resume token of a pipeline worker."""
+    name = StringField(primary_key=True)
+    resumeToken = DictField()
+    updatedAt = DateTimeField()
+
+    meta = {"collection": "stream_checkpoints"}
+
+
 # ---------------------------
 # UserConversations
 # ---------------------------
@@ -146,6 +196,8 @@ class GroupChatInfo(EmbeddedDocument):
     description = StringField()
     avatar = URLField()
     memberCount = IntField()
+    # Conversation.membershipVersion that memberCount reflects
+    membershipVersion = IntField()
     adminIds = ListField(StringField())
     myRole = StringField()
 
@@ -170,6 +222,15 @@ class DraftInfo(EmbeddedDocument):
     timestamp = DateTimeField()
 
 
+def normalize_search_key(value):
+    """Lowercase, strip accents and collapse whitespace so names can be prefix-matched."""
+    if not value:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", value)
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.lower().split())
+
+
 class UserConversation(Document):
     _id = StringField(primary_key=True)
     userId = StringField(required=True)
@@ -189,12 +250,27 @@ class UserConversation(Document):
     locationId = StringField()
     organizationId = StringField()
     unitId = StringField()
+    searchKey = StringField()
 
     meta = {
         "collection": "user_conversations",
         "indexes": [
             {"fields": ["userId", "-updatedAt"]},
             {"fields": ["userId", "organizationId", "-updatedAt"]},
-            {"fields": ["userId", "organizationId", "locationId", "-updatedAt"]}
+            {"fields": ["userId", "organizationId", "locationId", "-updatedAt"]},
+            {"fields": ["userId", "organizationId", "locationId", "searchKey"]},
+            # One inbox entry per member; run `dedupe_user_conversations` before this index is built
+            {"fields": ["conversationId", "userId"], "unique": True},
         ]
     }
+
+    def get_display_name(self):
+        if self.conversationType == "direct" and self.directMessage:
+            return self.directMessage.otherParticipantName
+        if self.groupChat:
+            return self.groupChat.name
+        return None
+
+    def clean(self):
+        # Kept in sync on every save so inbox search can use an anchored, indexed prefix match
+        self.searchKey = normalize_search_key(self.get_display_name())
@@ -0,0 +1,237 @@
+"""
+Message-event pipeline: everything that happens after a Mongo message is inserted.
+
+Writers (`save_message`, `ImageMessageViewSet.create`, `create_system_message`) only insert the
+message and call `message_saved`. With CHAT_MESSAGE_PIPELINE on, a `run_message_pipeline`
+worker tails a change stream on `messages` and fans new messages out in batches: inbox
+(UserConversation) updates, the history window, group broadcasts, push notifications and media
+processing. With it off, `message_saved` runs the same `dispatch_messages` inline.
+
+Each message is claimed before fan-out (`dispatched` flips from False under a batch id and
+claim time), so replaying the stream after a crash, the catch-up sweeps and several workers
+never deliver a message twice. A claim still open after CHAT_MESSAGE_PIPELINE_LEASE belongs to
+a worker that died mid-batch; the sweeps reclaim it, so those messages are delivered at least
+once. Workers split conversations by the last hex digit of their id.
+"""
+import datetime
+import logging
+import time
+import uuid
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from bson import ObjectId
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+from pymongo.errors import OperationFailure
+
+from rapidconsult.chats.api.serializers import MongoMessageSerializer
+from rapidconsult.chats.history import cache_message
+from rapidconsult.chats.models import User
+from rapidconsult.chats.mongo.models import Conversation, Message, StreamCheckpoint
+from rapidconsult.chats.tasks import process_message_media
+from rapidconsult.chats.utils import update_user_conversations
+
+logger = logging.getLogger(__name__)
+
+# System / consultation messages never sent a push notification of their own
+SILENT_TYPES = {"system", "consult"}
+HEX_DIGITS = "0123456789abcdef"
+# The checkpointed resume token is no longer in the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+def message_saved(msg):
+    """Hook for writers, called right after the insert."""
+    if not settings.CHAT_MESSAGE_PIPELINE:
+        dispatch_messages([msg.id])
+
+
+def _stale_before():
+    return timezone.now() - datetime.timedelta(seconds=settings.CHAT_MESSAGE_PIPELINE_LEASE)
+
+
+def _claim(message_ids, stale_before=None):
+    batch = uuid.uuid4().hex
+    claimable = [{"dispatched": False}]
+    if stale_before is not None:
+        claimable.append({"dispatchClaimedAt": {"$lt": stale_before}})
+    Message._get_collection().update_many(
+        {"_id": {"$in": list(message_ids)}, "$or": claimable},
+        {"$set": {"dispatched": True, "dispatchBatch": batch, "dispatchClaimedAt": timezone.now()}},
+    )
+    return batch
+
+
+def _finish(batch):
+    Message._get_collection().update_many(
+        {"dispatchBatch": batch},
+        {"$unset": {"dispatchBatch": "", "dispatchClaimedAt": ""}},
+    )
+
+
+def _release(message_ids, batch):
+    Message._get_collection().update_many(
+        {"_id": {"$in": list(message_ids)}, "dispatchBatch": batch},
+        {"$set": {"dispatched": False}, "$unset": {"dispatchBatch": "", "dispatchClaimedAt": ""}},
+    )
+
+
+def dispatch_messages(message_ids, stale_before=None):
+    """
+    Fan out newly inserted messages that nobody has dispatched yet, plus those whose claim is
+    older than `stale_before`; returns how many were sent.
+    """
+    if not message_ids:
+        return 0
+
+    batch = _claim(message_ids, stale_before)
+    messages = list(Message.objects(id__in=message_ids, dispatchBatch=batch).order_by("conversationId", "seq"))
+    if not messages:
+        return 0
+
+    try:
+        update_user_conversations(messages)
+        _broadcast(messages)
+        _notify(messages)
+    except Exception:
+        _release(message_ids, batch)
+        raise
+    _finish(batch)
+
+    for msg in messages:
+        if msg.media and (msg.media.mimeType or "").startswith("image/"):
+            process_message_media.delay(str(msg.id))
+    return len(messages)
+
+
+def _broadcast(messages):
+    channel_layer = get_channel_layer()
+    for msg in messages:
+        serialized = MongoMessageSerializer(msg).data
+        cache_message(msg, serialized)
+        async_to_sync(channel_layer.group_send)(
+            msg.conversationId,
+            {
+                "type": "chat_message_echo",
+                "message": serialized,
+            }
+        )
+
+
+def _notify(messages):
+    """One push per receiver and conversation, however many messages the batch holds for them."""
+    from rapidconsult.notifications.services import send_notification
+
+    by_conversation = defaultdict(list)
+    for msg in messages:
+        if msg.type not in SILENT_TYPES:
+            by_conversation[msg.conversationId].append(msg)
+    if not by_conversation:
+        return
+
+    conversations = Conversation.objects(id__in=list(by_conversation)).only("participants")
+    participants = {str(conv.id): [str(p.userId) for p in conv.participants] for conv in conversations}
+    users = User.objects.in_bulk({user_id for ids in participants.values() for user_id in ids})
+
+    for conversation_id, conv_messages in by_conversation.items():
+        for user_id in participants.get(conversation_id, []):
+            receiver = users.get(int(user_id)) if user_id.isdigit() else None
+            unseen = [msg for msg in conv_messages if msg.senderId != user_id]
+            if receiver is None or not unseen:
+                continue
+
+            last = unseen[-1]
+            senders = {msg.senderName for msg in unseen}
+            if len(unseen) == 1:
+                title = f"New message from {last.senderName}"
+            elif len(senders) == 1:
+                title = f"{len(unseen)} new messages from {last.senderName}"
+            else:
+                title = f"{len(unseen)} new messages"
+            send_notification(
+                user=receiver,
+                title=title,
+                body=last.content[:100] if last.content else "Sent a file",
+                data={"conversation_id": conversation_id}
+            )
+
+
+def partition_pattern(partition, partitions):
+    """Regex on conversationId picking the conversations (by last hex digit) a worker owns."""
+    digits = "".join(digit for digit in HEX_DIGITS if int(digit, 16) % partitions == partition)
+    return f"[{digits}]$"
+
+
+def catch_up(partition, partitions, since):
+    """
+    Dispatch messages inserted while no worker was watching (e.g. the resume token had expired)
+    and reclaim the batches of workers that died before finishing them.
+    """
+    stale_before = _stale_before()
+    pending = Message.objects(
+        conversationId__regex=partition_pattern(partition, partitions),
+        __raw__={"$or": [
+            {"dispatched": False, "timestamp": {"$gte": since}},
+            {"dispatchClaimedAt": {"$lt": stale_before}},
+        ]},
+    ).order_by("timestamp").scalar("id")
+    return dispatch_messages(list(pending), stale_before)
+
+
+def watch(partition=0, partitions=1, batch_size=100, max_wait_ms=200):
+    """
+    Tail inserts into `messages` and dispatch them in batches, checkpointing the resume token
+    after every batch. Runs until interrupted.
+    """
+    name = f"message-pipeline-{partition}-of-{partitions}"
+    checkpoint = StreamCheckpoint.objects(name=name).first()
+
+    since = timezone.now() - datetime.timedelta(seconds=settings.CHAT_MESSAGE_PIPELINE_CATCH_UP)
+    caught_up = catch_up(partition, partitions, since)
+    if caught_up:
+        logger.info("%s caught up on %s undispatched messages", name, caught_up)
+
+    pipeline = [{"$match": {
+        "operationType": "insert",
+        "fullDocument.conversationId": {"$regex": partition_pattern(partition, partitions)},
+    }}]
+    collection = Message._get_collection()
+    try:
+        stream = collection.watch(
+            pipeline,
+            resume_after=checkpoint.resumeToken if checkpoint else None,
+            max_await_time_ms=max_wait_ms,
+        )
+    except OperationFailure as e:
+        if e.code != CHANGE_STREAM_HISTORY_LOST:
+            raise
+        # The catch-up sweep above already covered the gap; start from now
+        logger.warning("%s resume token expired, watching from now", name)
+        stream = collection.watch(pipeline, max_await_time_ms=max_wait_ms)
+
+    # Claims left behind by a worker that crashed mid-batch are only reclaimable once their lease
+    # runs out, which a quickly restarted worker has not waited for; sweep again every lease
+    lease = settings.CHAT_MESSAGE_PIPELINE_LEASE
+    next_sweep = time.monotonic() + lease
+    with stream:
+        while stream.alive:
+            if time.monotonic() >= next_sweep:
+                catch_up(partition, partitions, timezone.now() - datetime.timedelta(seconds=2 * lease))
+                next_sweep = time.monotonic() + lease
+
+            message_ids = []
+            while len(message_ids) < batch_size:
+                change = stream.try_next()
+                if change is None:
+                    break
+                message_ids.append(ObjectId(change["documentKey"]["_id"]))
+
+            if message_ids:
+                dispatch_messages(message_ids)
+                StreamCheckpoint.objects(name=name).update_one(
+                    upsert=True,
+                    set__resumeToken=stream.resume_token,
+                    set__updatedAt=timezone.now(),
+                )
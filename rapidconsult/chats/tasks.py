@@ -0,0 +1,104 @@
+import io
+import logging
+
+import blurhash
+from asgiref.sync import async_to_sync
+from celery import shared_task
+from channels.layers import get_channel_layer
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from config.utils import download_from_spaces, get_object_key, upload_bytes_to_spaces
+from rapidconsult.chats.api.serializers import MediaSerializer
+from rapidconsult.chats.history import cache_media_update
+from rapidconsult.chats.mongo.models import Message, Thumbnail
+
+logger = logging.getLogger(__name__)
+
+EXIF_ORIENTATION = 0x0112
+
+
+def render_thumbnails(fileobj, sizes):
+    """
+    Decode an image once and render a WebP thumbnail per entry in `sizes` (name -> longest edge).
+    Returns the original dimensions, a blurhash and a list of (name, webp bytes, width, height).
+    """
+    with Image.open(fileobj) as image:
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+
+        # Let the JPEG decoder downscale while decoding; nothing we produce needs more pixels
+        longest = max(sizes.values())
+        image.draft("RGB", (longest, longest))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+
+        thumbnails = []
+        for name, edge in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            thumb = image.copy()
+            thumb.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            thumb.save(buffer, format="WEBP", quality=80, method=4)
+            thumbnails.append((name, buffer.getvalue(), thumb.width, thumb.height))
+
+        # blurhash only needs a tiny input; hashing the full image is wasted work
+        tiny = image.convert("RGB")
+        tiny.thumbnail((64, 64))
+        placeholder = blurhash.encode(tiny, x_components=4, y_components=3)
+
+    return width, height, placeholder, thumbnails
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=10)
+def process_message_media(self, message_id):
+    """Generate thumbnails, dimensions and a blurhash for an image message, then tell the conversation."""
+    msg = Message.objects(id=message_id).only("conversationId", "media").first()
+    if not msg or not msg.media or not (msg.media.mimeType or "").startswith("image/"):
+        return
+
+    key = get_object_key(msg.media.url)
+    if not key:
+        logger.warning("Message %s media is not stored in Spaces, skipping thumbnails", message_id)
+        return
+
+    try:
+        original = download_from_spaces(key, io.BytesIO())
+    except Exception as exc:  # noqa: BLE001
+        raise self.retry(exc=exc)
+
+    try:
+        width, height, placeholder, rendered = render_thumbnails(original, settings.CHAT_THUMBNAIL_SIZES)
+    except (OSError, Image.DecompressionBombError):
+        logger.exception("Could not generate thumbnails for message %s", message_id)
+        return
+
+    base_key = key.rsplit(".", 1)[0]
+    thumbnails = [
+        Thumbnail(
+            name=name,
+            url=upload_bytes_to_spaces(f"{base_key}-{name}.webp", body, "image/webp"),
+            width=thumb_width,
+            height=thumb_height,
+        )
+        for name, body, thumb_width, thumb_height in rendered
+    ]
+
+    Message.objects(id=message_id).update_one(
+        set__media__width=width,
+        set__media__height=height,
+        set__media__blurhash=placeholder,
+        set__media__thumbnails=thumbnails,
+    )
+    msg.reload("media")
+    cache_media_update(msg.conversationId, str(msg.id), msg.media)
+
+    async_to_sync(get_channel_layer().group_send)(
+        msg.conversationId,
+        {
+            "type": "media_ready",
+            "messageId": str(msg.id),
+            "conversationId": msg.conversationId,
+            "media": MediaSerializer(msg.media).data,
+        },
+    )
@@ -1,3 +1,306 @@
-from django.test import TestCase
+import io
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
-# Create your tests here.
+import boto3
+from bson import ObjectId
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from moto import mock_aws
+from PIL import Image
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from config import utils
+from rapidconsult.chats.api.views import ConversationViewSet
+from rapidconsult.chats.models import Conversation, Message
+from rapidconsult.chats.mongo.models import (
+    Conversation as MongoConversation, Message as MongoMessage, User as MongoUser, UserConversation
+)
+from rapidconsult.chats.api.mongo import add_user_to_group_chat, remove_user_from_group_chat, sync_group_chat_members
+from rapidconsult.chats.backpressure import COALESCED, DROPPABLE, OutboundQueue, classify
+from rapidconsult.chats.consumers import MongoChatMixin
+from rapidconsult.chats.tasks import render_thumbnails
+from rapidconsult.chats.throttling import TYPING_REFRESH, TYPING_TIMEOUT, TrafficCounters, TypingThrottle
+from rapidconsult.chats.utils import insert_message
+from rapidconsult.users.tests.factories import UserFactory
+
+BUCKET = "rapidconsult-test"
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def spaces(settings):
+    settings.AWS_ACCESS_KEY_ID = "testing"
+    settings.AWS_SECRET_ACCESS_KEY = "testing"  # noqa: S105
+    settings.AWS_STORAGE_BUCKET_NAME = BUCKET
+    settings.AWS_S3_REGION_NAME = "us-east-1"
+    settings.AWS_S3_ENDPOINT_URL = None
+    settings.CHAT_UPLOAD_MULTIPART_THRESHOLD = 5 * MB
+    settings.CHAT_UPLOAD_PART_SIZE = 5 * MB
+
+    utils.get_spaces_client.cache_clear()
+    with mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+        yield utils.get_spaces_client()
+    utils.get_spaces_client.cache_clear()
+
+
+def test_spaces_client_is_reused(spaces):
+    assert utils.get_spaces_client() is spaces
+
+
+def test_upload_to_spaces_streams_large_files_as_multipart(spaces):
+    upload = SimpleUploadedFile("scan.pdf", b"x" * (11 * MB), content_type="application/pdf")
+
+    url = utils.upload_to_spaces(upload, folder="chat")
+
+    key = url.split(f"{BUCKET}/", 1)[1]
+    head = spaces.head_object(Bucket=BUCKET, Key=key)
+    assert head["ContentLength"] == 11 * MB
+    assert head["ContentType"] == "application/pdf"
+    # Multipart objects carry a "<md5>-<part count>" ETag
+    assert head["ETag"].strip('"').endswith("-3")
+
+
+def test_presigned_upload_for_small_file(spaces):
+    upload = utils.create_presigned_upload("photo.jpg", "image/jpeg", 200 * 1024)
+
+    assert upload["method"] == "single"
+    assert upload["key"].startswith("chat/")
+    assert upload["key"] in upload["url"]
+    assert utils.get_uploaded_object(upload["key"]) is None
+
+
+def test_object_key_drops_client_path_and_url_is_escaped(spaces):
+    key = utils.build_object_key("..\\scans/ward 3 #2?.jpg", folder="chat/7")
+
+    assert key.startswith("chat/7/")
+    assert key.endswith("-ward 3 #2?.jpg")
+    assert key.count("/") == 2
+    url = utils.get_object_url(key)
+    assert " " not in url and "#" not in url and "?" not in url
+    assert utils.get_object_key(url) == key
+
+
+def test_presigned_multipart_upload_round_trip(spaces):
+    size = 12 * MB
+    upload = utils.create_presigned_upload("ct.pdf", "application/pdf", size)
+    assert upload["method"] == "multipart"
+    assert len(upload["parts"]) == 3
+
+    # Stand in for the client PUTting each part to its presigned URL
+    data = b"y" * size
+    parts = []
+    for part in upload["parts"]:
+        offset = (part["partNumber"] - 1) * upload["partSize"]
+        response = spaces.upload_part(
+            Bucket=BUCKET,
+            Key=upload["key"],
+            UploadId=upload["uploadId"],
+            PartNumber=part["partNumber"],
+            Body=data[offset:offset + upload["partSize"]],
+        )
+        parts.append({"partNumber": part["partNumber"], "etag": response["ETag"]})
+
+    utils.complete_multipart_upload(upload["key"], upload["uploadId"], reversed(parts))
+
+    assert utils.get_uploaded_object(upload["key"]) == {"size": size, "mimeType": "application/pdf"}
+
+
+def test_render_thumbnails_keeps_aspect_ratio():
+    original = io.BytesIO()
+    Image.new("RGB", (3000, 2000), color=(200, 30, 30)).save(original, format="JPEG")
+    original.seek(0)
+
+    width, height, placeholder, thumbnails = render_thumbnails(original, {"small": 160, "large": 1080})
+
+    assert (width, height) == (3000, 2000)
+    assert placeholder
+    assert [(name, w, h) for name, _, w, h in thumbnails] == [("large", 1080, 720), ("small", 160, 107)]
+    assert Image.open(io.BytesIO(thumbnails[0][1])).format == "WEBP"
+
+
+def test_typing_throttle_publishes_only_edges(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("rapidconsult.chats.throttling.time.monotonic", lambda: clock[0])
+    counters = TrafficCounters()
+    throttle = TypingThrottle(counters)
+
+    published = []
+    for _ in range(16):
+        published.append(throttle.on_frame("c1", True))
+        clock[0] += 0.3
+    published.append(throttle.on_frame("c1", False))
+    published.append(throttle.on_frame("c1", False))
+
+    # start, one refresh once TYPING_REFRESH passed, then a single stop
+    assert [i for i, sent in enumerate(published) if sent] == [0, 14, 16]
+    assert counters.counts["typing_published"] == 3
+    assert counters.counts["typing_coalesced"] == 15
+
+    # A client that vanishes mid-typing is treated as stopped after the timeout
+    throttle.on_frame("c2", True)
+    clock[0] += TYPING_TIMEOUT + TYPING_REFRESH
+    assert throttle.active() == []
+    assert throttle.on_frame("c2", False) is False
+
+
+def test_typing_frames_keep_the_string_protocol():
+    sent = []
+
+    async def group_send(group, event):
+        sent.append(event)
+
+    consumer = MongoChatMixin()
+    consumer.user = SimpleNamespace(id=7, name="Asha Rao")
+    consumer.typing = TypingThrottle(TrafficCounters())
+    consumer.channel_layer = SimpleNamespace(group_send=group_send)
+
+    # What ChatView.tsx sends: a start, more keystrokes, then the stop
+    for status in ("typing", "typing", "typing", "stop_typing"):
+        consumer.typing_status("c1", {"type": "typing", "status": status})
+
+    assert [event["status"] for event in sent] == ["typing", "stop_typing"]
+    assert sent[0]["expiresIn"] == TYPING_TIMEOUT
+    assert "expiresIn" not in sent[1]
+
+
+def test_outbound_queue_sheds_chatter_but_keeps_messages():
+    queue = OutboundQueue(soft_limit=2, high_water=4)
+
+    def frame(content):
+        return {"type": "websocket.send", "text": str(content)}, *classify(content)
+
+    assert queue.put(*frame({"type": "chat_message_echo", "message": 1}))
+    assert queue.put(*frame({"type": "read_messages_ack", "conversationId": "c1", "lastReadAt": "t1"}))
+    # Past the soft limit typing is dropped and the queued ack is replaced in place
+    assert queue.put(*frame({"type": "typing", "status": True}))
+    assert queue.put(*frame({"type": "read_messages_ack", "conversationId": "c1", "lastReadAt": "t2"}))
+    assert len(queue) == 2
+    assert queue.stats["dropped"] == 1 and queue.stats["coalesced"] == 1
+
+    assert queue.put(*frame({"type": "chat_message_echo", "message": 2}))
+    assert queue.put(*frame({"type": "chat_message_echo", "message": 3}))
+    # Messages are never dropped; the client is cut off instead
+    assert not queue.put(*frame({"type": "chat_message_echo", "message": 4}))
+
+    assert [queue.pop()["text"] for _ in range(len(queue))] == [
+        str({"type": "chat_message_echo", "message": 1}),
+        str({"type": "read_messages_ack", "conversationId": "c1", "lastReadAt": "t2"}),
+        str({"type": "chat_message_echo", "message": 2}),
+        str({"type": "chat_message_echo", "message": 3}),
+    ]
+    assert classify({"type": "presence"})[0] == DROPPABLE
+    assert classify({"type": "pong"})[0] == COALESCED
+
+
+def _list_conversations(user):
+    request = APIRequestFactory().get("/api/conversations/")
+    force_authenticate(request, user=user)
+    with CaptureQueriesContext(connection) as queries:
+        response = ConversationViewSet.as_view({"get": "list"})(request)
+    assert response.status_code == 200
+    return response, len(queries)
+
+
+@pytest.mark.django_db
+def test_legacy_conversation_list_has_fixed_query_budget(user):
+    def add_conversations(count):
+        for other in UserFactory.create_batch(count):
+            conversation = Conversation.objects.create(name=f"{user.username}__{other.username}")
+            Message.objects.create(conversation=conversation, from_user=other, to_user=user, content="hi")
+
+    add_conversations(2)
+    _, few = _list_conversations(user)
+
+    add_conversations(8)
+    response, many = _list_conversations(user)
+
+    assert few == many
+    first = response.data["results"][0]
+    assert first["last_message"]["content"] == "hi"
+    assert set(first["other_user"]) == {"id", "username", "name", "profile_picture"}
+
+
+@pytest.fixture
+def unit_group_chat():
+    unit_id = f"test-unit-{ObjectId()}"
+    users = [
+        MongoUser(sql_user_id=f"{unit_id}-{i}", username=f"{unit_id}-{i}", email=f"{unit_id}-{i}@example.com",
+                  displayName=f"User {i}").save()
+        for i in range(20)
+    ]
+    conversation = MongoConversation(type="group", name="Unit chat", createdBy=users[0].sql_user_id,
+                                     unitId=unit_id).save()
+    yield unit_id, [user.sql_user_id for user in users]
+
+    UserConversation.objects(conversationId=str(conversation.id)).delete()
+    conversation.delete()
+    for user in users:
+        user.delete()
+
+
+def test_concurrent_group_membership_changes_stay_consistent(unit_group_chat):
+    unit_id, user_ids = unit_group_chat
+    conversation = MongoConversation.objects.get(unitId=unit_id)
+
+    # Every user is added twice at once, then half of them are removed while the rest are re-added
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        list(pool.map(lambda user_id: add_user_to_group_chat(unit_id, user_id), user_ids * 2))
+    changes = ([(remove_user_from_group_chat, user_id) for user_id in user_ids[:10]]
+               + [(add_user_to_group_chat, user_id) for user_id in user_ids[10:]])
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        list(pool.map(lambda change: change[0](unit_id, change[1]), changes))
+
+    conversation.reload()
+    assert sorted(p.userId for p in conversation.participants) == sorted(user_ids[10:])
+    inboxes = UserConversation.objects(conversationId=str(conversation.id))
+    assert sorted(inbox.userId for inbox in inboxes) == sorted(user_ids[10:])
+    assert {inbox.groupChat.memberCount for inbox in inboxes} == {10}
+
+
+def test_roster_diff_touches_only_changed_members(unit_group_chat):
+    unit_id, user_ids = unit_group_chat
+    conversation = MongoConversation.objects.get(unitId=unit_id)
+    sync_group_chat_members(unit_id, added={user_id: False for user_id in user_ids[:10]}, removed=[], role_changes={})
+    conversation.reload()
+    joined_at = {p.userId: p.joinedAt for p in conversation.participants}
+
+    # Re-adding an existing member is a no-op for them; the diff is applied in one pass
+    sync_group_chat_members(
+        unit_id,
+        added={user_ids[0]: False, **{user_id: False for user_id in user_ids[10:12]}},
+        removed=user_ids[8:10],
+        role_changes={user_ids[1]: True},
+    )
+
+    conversation.reload()
+    participants = {p.userId: p for p in conversation.participants}
+    assert sorted(participants) == sorted(user_ids[:8] + user_ids[10:12])
+    assert participants[user_ids[0]].joinedAt == joined_at[user_ids[0]]
+    assert participants[user_ids[1]].role == "admin"
+    inboxes = {inbox.userId: inbox for inbox in UserConversation.objects(conversationId=str(conversation.id))}
+    assert sorted(inboxes) == sorted(participants)
+    assert inboxes[user_ids[1]].groupChat.myRole == "admin"
+    assert {inbox.groupChat.memberCount for inbox in inboxes.values()} == {10}
+
+
+def test_client_message_id_is_scoped_to_the_sender(unit_group_chat):
+    unit_id, user_ids = unit_group_chat
+    conversation_id = str(MongoConversation.objects.get(unitId=unit_id).id)
+
+    def send(sender_id):
+        return insert_message(MongoMessage(conversationId=conversation_id, senderId=sender_id, content="hi",
+                                           type="text", clientMessageId="retry-1"))
+
+    first, created = send(user_ids[0])
+    assert created
+    # Another participant reusing the id gets their own message, not the first sender's acked back
+    other, created = send(user_ids[1])
+    assert created and other.id != first.id
+    retried, created = send(user_ids[0])
+    assert not created and retried.id == first.id
+
+    MongoMessage.objects(conversationId=conversation_id).delete()
@@ -0,0 +1,121 @@
+"""
+Per-connection throttling of chat chatter (typing indicators, pings).
+
+Clients send `typing` on every keystroke, but receivers only need the start / stop edges.
+TypingThrottle publishes an edge once, re-announces an ongoing "typing" at most every
+TYPING_REFRESH seconds so receivers can expire it on their own after TYPING_TIMEOUT, and
+drops keystroke bursts above TYPING_RATE frames per second. Stop edges are never rate limited.
+
+TrafficCounters records how many frames came in versus how many group events went out, and
+flushes the totals to Redis in batches so counting does not add a round trip per frame.
+"""
+import time
+from collections import Counter
+
+from rapidconsult.chats.presence import r
+
+METRICS_KEY = "chats:traffic:metrics"
+
+# Receivers drop a typing indicator that was not refreshed within this many seconds
+TYPING_TIMEOUT = 6
+# While the user keeps typing, re-announce the start edge at most this often
+TYPING_REFRESH = 4
+# Token bucket for typing frames of one connection
+TYPING_RATE = 5
+TYPING_BURST = 10
+# Frames counted locally before the totals are written to Redis
+COUNTER_FLUSH_EVERY = 100
+
+
+class TrafficCounters:
+    def __init__(self):
+        self.counts = Counter()
+        self.pending = 0
+
+    def add(self, metric, amount=1):
+        self.counts[metric] += amount
+        self.pending += amount
+        if self.pending >= COUNTER_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if self.counts:
+            pipe = r.pipeline(transaction=False)
+            for metric, amount in self.counts.items():
+                pipe.hincrby(METRICS_KEY, metric, amount)
+            pipe.execute()
+            self.counts.clear()
+        self.pending = 0
+
+
+class TypingThrottle:
+    def __init__(self, counters):
+        self.counters = counters
+        # conversation id -> when the start edge was last published / when the client last said it is typing
+        self.announced = {}
+        self.last_frame = {}
+        self.tokens = TYPING_BURST
+        self.refilled_at = time.monotonic()
+
+    def _take_token(self, now):
+        self.tokens = min(TYPING_BURST, self.tokens + (now - self.refilled_at) * TYPING_RATE)
+        self.refilled_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _is_typing(self, conversation_id, now):
+        last_frame = self.last_frame.get(conversation_id)
+        return last_frame is not None and now - last_frame < TYPING_TIMEOUT
+
+    def on_frame(self, conversation_id, typing):
+        """Record a client `typing` frame; returns True when the new status should be published."""
+        now = time.monotonic()
+        self.counters.add("typing_received")
+
+        if typing and not self._take_token(now):
+            self.counters.add("typing_rate_limited")
+            return False
+
+        was_typing = self._is_typing(conversation_id, now)
+        if typing:
+            self.last_frame[conversation_id] = now
+            if was_typing and now - self.announced[conversation_id] < TYPING_REFRESH:
+                self.counters.add("typing_coalesced")
+                return False
+            self.announced[conversation_id] = now
+        else:
+            self.announced.pop(conversation_id, None)
+            self.last_frame.pop(conversation_id, None)
+            if not was_typing:
+                self.counters.add("typing_coalesced")
+                return False
+
+        self.counters.add("typing_published")
+        return True
+
+    def stop(self, conversation_id):
+        """Forget the typing state (message sent, chat closed); returns True if a stop edge is owed."""
+        was_typing = self._is_typing(conversation_id, time.monotonic())
+        self.announced.pop(conversation_id, None)
+        self.last_frame.pop(conversation_id, None)
+        if was_typing:
+            self.counters.add("typing_published")
+        return was_typing
+
+    def active(self):
+        now = time.monotonic()
+        return [conversation_id for conversation_id in list(self.last_frame) if self._is_typing(conversation_id, now)]
+
+
+def get_traffic_stats():
+    stats = {metric: int(value) for metric, value in r.hgetall(METRICS_KEY).items()}
+    # Every typing frame used to be a group_send, and so did every ping on VoxChatConsumer
+    stats["events_saved"] = (stats.get("typing_received", 0) - stats.get("typing_published", 0)
+                             + stats.get("ping_direct", 0))
+    return stats
+
+
+def reset_traffic_stats():
+    r.delete(METRICS_KEY)
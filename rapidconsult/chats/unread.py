@@ -0,0 +1,96 @@
+"""
+Per-user unread counter for the legacy SQL chat, kept in Redis.
+
+The counter is seeded from the database the first time it is read and then maintained
+incrementally as messages are sent and read. While it is missing, updates only bump a
+"changes" marker: a reader notes the marker before it counts and stores its count only if
+the marker has not moved since, so a count that may or may not include a racing change is
+thrown away and taken again instead of being stored off by one.
+"""
+from rapidconsult.chats.models import Message
+from rapidconsult.chats.presence import r
+
+# Recount from the database now and then so any drift heals itself
+UNREAD_COUNT_TTL = 7 * 24 * 60 * 60
+# Lifetime of the changes marker; longer than any count takes
+UNREAD_SEED_TTL = 60
+# Counts discarded because of racing changes before a read gives up caching
+UNREAD_SEED_ATTEMPTS = 3
+
+# KEYS: counter, changes marker. Without a counter, only note that something changed.
+_incr_if_exists = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('INCR', KEYS[2])
+end
+return nil
+""")
+
+_decr_if_exists = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        redis.call('INCR', KEYS[2])
+    end
+    return nil
+end
+local value = redis.call('DECRBY', KEYS[1], ARGV[1])
+if value < 0 then
+    redis.call('SET', KEYS[1], 0, 'KEEPTTL')
+    return 0
+end
+return value
+""")
+
+# KEYS: counter, changes marker; ARGV: marker value noted before counting, count, TTL.
+# Returns the counter's value, or nil if something changed while counting.
+_seed = r.register_script("""
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return nil
+end
+if redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3], 'NX') then
+    return tonumber(ARGV[2])
+end
+return tonumber(redis.call('GET', KEYS[1]))
+""")
+
+
+def _key(user_id):
+    return f"chats:unread:user:{user_id}"
+
+
+def _keys(user_id):
+    return [_key(user_id), f"chats:unread:changes:{user_id}"]
+
+
+def get_unread_count(user_id) -> int:
+    value = r.get(_key(user_id))
+    if value is not None:
+        return int(value)
+
+    keys = _keys(user_id)
+    for _ in range(UNREAD_SEED_ATTEMPTS):
+        pipe = r.pipeline()
+        pipe.set(keys[1], 0, ex=UNREAD_SEED_TTL, nx=True)
+        pipe.get(keys[1])
+        changes = pipe.execute()[1] or ""
+        count = Message.objects.filter(to_user_id=user_id, read=False).count()
+        value = _seed(keys=keys, args=[changes, count, UNREAD_COUNT_TTL])
+        if value is not None:
+            return int(value)
+    # Still racing sends or reads: answer with the last count and let a later read seed
+    return count
+
+
+def increment_unread_count(user_id, amount: int = 1):
+    _incr_if_exists(keys=_keys(user_id), args=[amount])
+
+
+def decrement_unread_count(user_id, amount: int) -> int:
+    """Lower the counter after messages were marked read and return the new value."""
+    if amount > 0:
+        value = _decr_if_exists(keys=_keys(user_id), args=[amount])
+        if value is not None:
+            return int(value)
+    return get_unread_count(user_id)
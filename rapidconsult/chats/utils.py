@@ -1,35 +1,102 @@
+from collections import Counter, defaultdict
+
+from bson import ObjectId
+from django.conf import settings
 from django.utils import timezone
-from .mongo.models import UserConversation, Message, LastMessageInfo
+from mongoengine.errors import NotUniqueError
 
+from .mongo.models import Conversation, UserConversation, Message, LastMessageInfo
 
-def update_user_conversation(msg: Message):
-    now = timezone.now()
 
-    # # Reset unread count for sender
-    # UserConversation.objects(
-    #     userId=sender_id,
-    #     conversationId=conversation_id
-    # ).update_one(
-    #     set__unreadCount=0,
-    #     set__updatedAt=now
-    # )
-
-    last_message_info = LastMessageInfo(
-        messageId=str(msg.id),
-        content=msg.content,
-        senderId=msg.senderId,
-        senderName=msg.senderName,
-        timestamp=msg.timestamp,
-        type=msg.type,
-    )
+# Concurrent writers to one conversation that keep reading the same highest seq
+SEQ_ATTEMPTS = 20
+
 
-    # Update all UserConversations tied to this conversation
-    UserConversation.objects(conversationId=msg.conversationId).update(
-        set__lastMessage=last_message_info,
-        set__updatedAt=timezone.now()
+def next_message_seq(conversation_id: str) -> int:
+    """One past the highest seq stored in the conversation, from the (conversationId, seq) index."""
+    last = Message._get_collection().find_one(
+        {"conversationId": conversation_id, "seq": {"$exists": True}},
+        projection={"seq": True},
+        sort=[("seq", -1)],
     )
+    return last["seq"] + 1 if last else 1
+
+
+def find_client_message(conversation_id: str, sender_id: str, client_message_id: str):
+    # Scoped to the sender: another participant reusing the id must not get this message acked back
+    if not client_message_id:
+        return None
+    return Message.objects(
+        conversationId=conversation_id, senderId=sender_id, clientMessageId=client_message_id
+    ).first()
+
+
+def insert_message(msg: Message):
+    """
+    Assign the next seq and insert a new message, de-duplicated per sender on clientMessageId.
+    Returns (message, created); a retried send gets the original message back with created=False.
+    Raises Conversation.DoesNotExist for an unknown conversation.
+
+    A writer only takes seq N once N - 1 is stored, so seqs become visible in order and a resume
+    from the highest seq a client holds never skips one. Writers that read the same highest seq
+    collide on the unique (conversationId, seq) index and the loser takes the next one.
+    """
+    existing = find_client_message(msg.conversationId, msg.senderId, msg.clientMessageId)
+    if existing:
+        return existing, False
+    if not Conversation.objects(id=msg.conversationId).only("id").first():
+        raise Conversation.DoesNotExist(f"Conversation {msg.conversationId} does not exist")
+
+    for _ in range(SEQ_ATTEMPTS if settings.CHAT_MESSAGE_SEQ else 1):
+        msg.seq = next_message_seq(msg.conversationId) if settings.CHAT_MESSAGE_SEQ else None
+        try:
+            msg.save(force_insert=True)
+        except NotUniqueError:
+            # A concurrent retry of the same send got in first, or another writer took this seq
+            existing = find_client_message(msg.conversationId, msg.senderId, msg.clientMessageId)
+            if existing:
+                return existing, False
+            if msg.seq is None:
+                raise
+            continue
+        if msg.seq is not None:
+            Conversation._get_collection().update_one(
+                {"_id": ObjectId(msg.conversationId)}, {"$max": {"lastSeq": msg.seq}}
+            )
+        return msg, True
+    raise NotUniqueError(f"No free seq in conversation {msg.conversationId} after {SEQ_ATTEMPTS} attempts")
+
+
+def update_user_conversations(messages: list[Message]):
+    """
+    Inbox side of new messages: one lastMessage write per conversation, and one unread
+    increment per conversation and sender, however many messages the batch holds.
+    """
+    now = timezone.now()
+
+    by_conversation = defaultdict(list)
+    for msg in messages:
+        by_conversation[msg.conversationId].append(msg)
+
+    for conversation_id, conv_messages in by_conversation.items():
+        last = max(conv_messages, key=lambda msg: (msg.seq or 0, msg.timestamp))
+        last_message_info = LastMessageInfo(
+            messageId=str(last.id),
+            content=last.content,
+            senderId=last.senderId,
+            senderName=last.senderName,
+            timestamp=last.timestamp,
+            type=last.type,
+        )
+
+        # Update all UserConversations tied to this conversation
+        UserConversation.objects(conversationId=conversation_id).update(
+            set__lastMessage=last_message_info,
+            set__updatedAt=now
+        )
 
-    # Increment unread count for all others
-    UserConversation.objects(
-        conversationId=msg.conversationId, userId__ne=msg.senderId
-    ).update(inc__unreadCount=1, set__updatedAt=now)
+        # Increment unread count for all others
+        for sender_id, count in Counter(msg.senderId for msg in conv_messages).items():
+            UserConversation.objects(
+                conversationId=conversation_id, userId__ne=sender_id
+            ).update(inc__unreadCount=count, set__updatedAt=now)
@@ -0,0 +1,93 @@
+"""
+Per-user authorization snapshot: organization id -> ids of the locations the user may access.
+
+HasOrgLocationAccess and the chat consumers check it on every message list, inbox and send.
+Snapshots are kept in-process for ORG_ACCESS_LOCAL_TTL seconds (for at most
+ORG_ACCESS_LOCAL_MAX_USERS users) and in Redis for ORG_ACCESS_CACHE_TTL, under a per-user
+version token, so a hot request makes no SQL query for authorization. Signals in
+`scheduling.signals` replace a user's token (and drop the snapshot from this process) whenever
+their org profiles or allowed locations change. Other processes can serve a revoked location
+for at most ORG_ACCESS_LOCAL_TTL seconds.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from rapidconsult.chats.presence import r
+from rapidconsult.scheduling.models import UserOrgProfile
+
+# user id -> (expires at, snapshot), least recently used first
+_local = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def _version_key(user_id):
+    return f"scheduling:access:version:{user_id}"
+
+
+def _version(user_id):
+    version = r.get(_version_key(user_id))
+    if version is None:
+        r.set(_version_key(user_id), uuid.uuid4().hex[:12], nx=True)
+        version = r.get(_version_key(user_id))
+    return version
+
+
+def _build(user_id):
+    snapshot = {}
+    rows = UserOrgProfile.objects.filter(user_id=user_id).values_list("organization_id", "allowed_locations__id")
+    for organization_id, location_id in rows:
+        locations = snapshot.setdefault(str(organization_id), [])
+        if location_id is not None:
+            locations.append(str(location_id))
+    return snapshot
+
+
+def _remember(user_id, expires_at, access):
+    # Consumers run in a thread pool, so the eviction must not interleave with another insert
+    with _local_lock:
+        _local[user_id] = (expires_at, access)
+        _local.move_to_end(user_id)
+        while len(_local) > settings.ORG_ACCESS_LOCAL_MAX_USERS:
+            _local.popitem(last=False)
+
+
+def get_access(user_id):
+    """{organization id: frozenset of allowed location ids} for the user, all ids as strings."""
+    now = time.monotonic()
+    cached = _local.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    # The version is read before the profiles: a snapshot built from rows that an invalidation
+    # has since replaced is stored under the old version, which nobody reads any more
+    key = f"scheduling:access:user:{user_id}:{_version(user_id)}"
+    raw = r.get(key)
+    if raw is None:
+        snapshot = _build(user_id)
+        r.set(key, json.dumps(snapshot), ex=settings.ORG_ACCESS_CACHE_TTL)
+    else:
+        snapshot = json.loads(raw)
+
+    access = {organization_id: frozenset(locations) for organization_id, locations in snapshot.items()}
+    _remember(user_id, now + settings.ORG_ACCESS_LOCAL_TTL, access)
+    return access
+
+
+def has_location_access(user_id, organization_id, location_id):
+    return str(location_id) in get_access(user_id).get(str(organization_id), ())
+
+
+def invalidate_access(*user_ids):
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        _local.pop(user_id, None)
+        pipe.set(_version_key(user_id), uuid.uuid4().hex[:12])
+    pipe.execute()
@@ -0,0 +1,78 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.response import Response
+
+from rapidconsult.chats.presence import r
+from rapidconsult.scheduling.access import get_access
+from rapidconsult.scheduling.versions import ALL, get_versions
+
+
+def check_org_member_or_raise(user, org_id):
+    # Reads the cached access snapshot rather than the profiles table
+    if str(org_id) not in get_access(user.id):
+        raise PermissionDenied("You do not belong to this organization.")
+
+
+class VersionedListCacheMixin:
+    """
+    Serves `list` from Redis while the version counters it depends on are unchanged.
+
+    `cache_kinds` names the counters (see scheduling.versions) that change whenever a row the
+    list shows changes. Pages are keyed by those counters, the query string and the host (for
+    absolute URLs), and the key doubles as the ETag, so a revalidation of an unchanged list
+    costs one Redis MGET and a 304 and a repeat fetch one more GET.
+
+    `cache_live_fields` are left out of the cached page and recomputed for each request by
+    `add_live_fields`; lists with such fields are still cached but never answered with a 304.
+    """
+    cache_kinds = ()
+    cache_live_fields = ()
+
+    def get_cache_scope(self):
+        org_id = self.request.query_params.get("organization_id")
+        if org_id:
+            check_org_member_or_raise(self.request.user, org_id)
+        return org_id or ALL
+
+    def add_live_fields(self, results):
+        pass
+
+    def _cache_key(self, request, scope):
+        versions = get_versions(self.cache_kinds, scope)
+        query = sorted(request.query_params.lists())
+        signature = json.dumps([self.basename, scope, versions, query, request.build_absolute_uri("/")])
+        return hashlib.sha1(signature.encode()).hexdigest()[:20]
+
+    @staticmethod
+    def _results(data):
+        return data["results"] if isinstance(data, dict) and "results" in data else data
+
+    def list(self, request, *args, **kwargs):
+        digest = self._cache_key(request, self.get_cache_scope())
+        etag = None if self.cache_live_fields else f'"list-{digest}"'
+        headers = {"ETag": etag} if etag else {}
+        if etag and etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        key = f"scheduling:list:{self.basename}:{digest}"
+        raw = r.get(key)
+        if raw is not None:
+            data = json.loads(raw)
+            self.add_live_fields(self._results(data))
+            return Response(data, headers=headers)
+
+        response = super().list(request, *args, **kwargs)
+        data = json.loads(json.dumps(response.data, cls=DjangoJSONEncoder))
+        for item in self._results(data):
+            for field in self.cache_live_fields:
+                item.pop(field, None)
+        r.set(key, json.dumps(data), ex=settings.LIST_CACHE_TTL)
+        for name, value in headers.items():
+            response[name] = value
+        return response
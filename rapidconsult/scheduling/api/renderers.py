@@ -0,0 +1,14 @@
+from rest_framework.renderers import BaseRenderer
+
+
+class ICSRenderer(BaseRenderer):
+    """Lets calendar apps that send `Accept: text/calendar` through content negotiation."""
+    media_type = "text/calendar"
+    format = "ics"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Feeds are returned as ready HttpResponses; only error details end up here
+        if isinstance(data, str):
+            return data.encode(self.charset)
+        return b""
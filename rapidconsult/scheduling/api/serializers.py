@@ -4,6 +4,7 @@ from rest_framework import serializers
 from rapidconsult.chats.api.mongo import create_direct_message_conv
 from rapidconsult.chats.mongo.models import UserConversation
 from config.roles import get_permissions_for_role
+from rapidconsult.scheduling.membership import reconcile_unit_members
 from rapidconsult.scheduling.models import Address, Organization, Location, Department, Unit, UserOrgProfile, \
     UnitMembership, Role, OnCallShift, Consultation
 from rapidconsult.users.api.serializers import ContactSerializer
@@ -155,8 +156,7 @@ class UnitWriteSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         members_data = validated_data.pop('unitmembership_set', [])
         unit = Unit.objects.create(**validated_data)
-        for member in members_data:
-            UnitMembership.objects.create(unit=unit, **member)
+        UnitMembership.objects.bulk_create([UnitMembership(unit=unit, **member) for member in members_data])
         return unit
 
     def update(self, instance, validated_data):
@@ -166,9 +166,7 @@ class UnitWriteSerializer(serializers.ModelSerializer):
         instance.save()
 
         if members_data is not None:
-            instance.unitmembership_set.all().delete()
-            for member in members_data:
-                UnitMembership.objects.create(unit=instance, **member)
+            reconcile_unit_members(instance, members_data)
         return instance
 
 
@@ -184,8 +182,7 @@ class UnitSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         members_data = validated_data.pop('unitmembership_set', [])
         unit = Unit.objects.create(**validated_data)
-        for member in members_data:
-            UnitMembership.objects.create(unit=unit, **member)
+        UnitMembership.objects.bulk_create([UnitMembership(unit=unit, **member) for member in members_data])
         return unit
 
     def update(self, instance, validated_data):
@@ -195,10 +192,7 @@ class UnitSerializer(serializers.ModelSerializer):
         instance.save()
 
         if members_data is not None:
-            # Clear existing and replace
-            instance.unitmembership_set.all().delete()
-            for member in members_data:
-                UnitMembership.objects.create(unit=instance, **member)
+            reconcile_unit_members(instance, members_data)
         return instance
 
     def get_oncall(self, obj):
@@ -1,24 +1,41 @@
 from datetime import datetime
 
+from django.conf import settings
+from django.core import signing
 from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied
 from django.db.models.query_utils import Q
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, status, mixins
 from rest_framework.decorators import action
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.filters import OrderingFilter, SearchFilter
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
 from rapidconsult.chats.api.mongo import handle_consult_update_system_message
-from rapidconsult.chats.api.mongo import create_group_chat, add_user_to_group_chat, remove_user_from_group_chat
+from rapidconsult.chats.api.mongo import create_group_chat, add_user_to_group_chat, remove_user_from_group_chat, \
+    sync_group_chat_members
 from rapidconsult.chats.api.permissions import HasOrgLocationAccess
+from rapidconsult.scheduling.access import get_access
+from rapidconsult.scheduling.api.caching import VersionedListCacheMixin, check_org_member_or_raise
 from rapidconsult.scheduling.api.permissions import check_org_admin_or_raise
+from rapidconsult.scheduling.api.renderers import ICSRenderer
+from rapidconsult.scheduling.feeds import UNIT as FEED_UNIT, USER as FEED_USER, feed_etag, feed_token, feed_version, \
+    get_feed, read_feed_token
 from rapidconsult.scheduling.models import Location, Department, Organization, Role, UnitMembership, Unit, OnCallShift, \
     UserOrgProfile, Consultation
+from rapidconsult.scheduling.roster import get_roster, get_roster_etag, parse_month
+from rapidconsult.scheduling.shift_import import import_shifts, rows_from_csv, rows_from_ics
+from rapidconsult.scheduling.tree import get_org_tree, get_org_tree_etag
+from rapidconsult.scheduling.versions import ALL, DEPARTMENT, LOCATION, ORGANIZATION, ROLE, UNIT
+from rapidconsult.users.sync import clear_removals, record_removals
 from .serializers import LocationSerializer, DepartmentSerializer, UnitSerializer, OrganizationSerializer, \
     UserProfileSerializer, UnitWriteSerializer, OnCallShiftSerializer, RoleSerializer, UnitMembershipSerializer, \
     UserOrgProfileSerializer, UserOrgProfileLocationUpdateSerializer, ConsultationSerializer
@@ -26,23 +43,43 @@ from .serializers import LocationSerializer, DepartmentSerializer, UnitSerialize
 User = get_user_model()
 
 
-class OrganizationViewSet(viewsets.ModelViewSet):
-    queryset = Organization.objects.all()
+class OrganizationViewSet(VersionedListCacheMixin, viewsets.ModelViewSet):
+    queryset = Organization.objects.select_related("address")
     serializer_class = OrganizationSerializer
     permission_classes = [IsAuthenticated]
+    cache_kinds = (ORGANIZATION,)
 
+    def get_cache_scope(self):
+        return ALL
 
-class LocationViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=["get"], url_path="tree")
+    def tree(self, request, pk=None):
+        """
+        Locations, departments and units of the organization as one nested tree.
+        Send the last ETag as If-None-Match to get a 304 when nothing changed.
+        """
+        if str(pk) not in get_access(request.user.id):
+            raise PermissionDenied("You do not belong to this organization.")
+
+        etag = get_org_tree_etag(pk)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        tree, etag = get_org_tree(pk)
+        return Response(tree, headers={"ETag": etag})
+
+
+class LocationViewSet(VersionedListCacheMixin, viewsets.ModelViewSet):
     serializer_class = LocationSerializer
     permission_classes = [IsAuthenticated]
+    cache_kinds = (LOCATION,)
 
     def get_queryset(self):
         org_id = self.request.query_params.get("organization_id")
-        qs = Location.objects.all()
+        qs = Location.objects.select_related("address")
 
         if org_id:
-            if not self.request.user.org_profiles.filter(organization_id=org_id).exists():
-                raise PermissionDenied("You do not belong to this organization.")
+            check_org_member_or_raise(self.request.user, org_id)
             qs = qs.filter(organization_id=org_id)
 
         return qs
@@ -63,20 +100,20 @@ class LocationViewSet(viewsets.ModelViewSet):
         instance.delete()
 
 
-class DepartmentViewSet(viewsets.ModelViewSet):
+class DepartmentViewSet(VersionedListCacheMixin, viewsets.ModelViewSet):
     serializer_class = DepartmentSerializer
     permission_classes = [IsAuthenticated]
+    cache_kinds = (DEPARTMENT, LOCATION)
 
     def get_queryset(self):
-        queryset = Department.objects.select_related('location', 'location__organization').all()
+        queryset = Department.objects.select_related('location', 'location__organization', 'location__address').all()
         location_id = self.request.query_params.get('location_id')
         org_id = self.request.query_params.get('organization_id')
 
         if org_id:
             # Filter departments through organization relationship via location
             queryset = queryset.filter(location__organization__id=org_id)
-            if not self.request.user.org_profiles.filter(organization_id=org_id).exists():
-                raise PermissionDenied("You do not belong to this organization.")
+            check_org_member_or_raise(self.request.user, org_id)
 
         if location_id:
             queryset = queryset.filter(location_id=location_id)
@@ -105,6 +142,32 @@ class DepartmentViewSet(viewsets.ModelViewSet):
         check_org_admin_or_raise(self.request.user, org)
         instance.delete()
 
+    @action(detail=True, methods=["get"], url_path="roster")
+    def roster(self, request, pk=None):
+        """
+        The department's shifts of `?month=YYYY-MM` as a unit x day grid of shift ids, with the
+        shifts, users and units side-loaded. Send the last ETag as If-None-Match to get a 304.
+        """
+        month = request.query_params.get("month") or timezone.localdate().strftime("%Y-%m")
+        try:
+            month = parse_month(month).strftime("%Y-%m")
+        except ValueError:
+            return Response({"detail": "month must be YYYY-MM"}, status=status.HTTP_400_BAD_REQUEST)
+
+        site = Department.objects.filter(pk=pk).values_list("location_id", "location__organization_id").first()
+        if site is None:
+            raise Http404
+        location_id, org_id = site
+        if str(location_id) not in get_access(request.user.id).get(str(org_id), ()):
+            raise PermissionDenied("You do not have access to this department's location.")
+
+        etag = get_roster_etag(pk, month)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        roster, etag = get_roster(pk, month)
+        return Response(roster, headers={"ETag": etag})
+
     @action(detail=False, methods=["get"], url_path="org")
     def by_organization(self, request):
         org_id = request.query_params.get("organization_id")
@@ -127,8 +190,12 @@ class DepartmentViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class UnitViewSet(viewsets.ModelViewSet):
+class UnitViewSet(VersionedListCacheMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
+    # Members show their profile's organization, role and allowed locations
+    cache_kinds = (UNIT, DEPARTMENT, LOCATION, ORGANIZATION, ROLE)
+    # Who is on call right now, with the caller's own conversation with them
+    cache_live_fields = ("oncall",)
 
     def get_queryset(self):
         org_id = self.request.query_params.get('organization_id')
@@ -137,12 +204,12 @@ class UnitViewSet(viewsets.ModelViewSet):
         queryset = Unit.objects.select_related(
             'department',
             'department__location',
-            'department__location__organization'
+            'department__location__organization',
+            'department__location__address',
         )
 
         if org_id:
-            if not self.request.user.org_profiles.filter(organization_id=org_id).exists():
-                raise PermissionDenied("You do not belong to this organization.")
+            check_org_member_or_raise(self.request.user, org_id)
             queryset = queryset.filter(department__location__organization_id=org_id)
 
         if department_id:
@@ -155,6 +222,13 @@ class UnitViewSet(viewsets.ModelViewSet):
             return UnitSerializer
         return UnitWriteSerializer
 
+    def add_live_fields(self, results):
+        units = Unit.objects.select_related("department__location").in_bulk([item["id"] for item in results])
+        serializer = UnitSerializer(context=self.get_serializer_context())
+        for item in results:
+            unit = units.get(item["id"])
+            item["oncall"] = serializer.get_oncall(unit) if unit else []
+
     def perform_create(self, serializer):
         department = serializer.validated_data['department']
         org = department.location.organization
@@ -234,6 +308,19 @@ class UnitMembershipViewSet(viewsets.ModelViewSet):
         if user_profile.organization != unit_org:
             raise PermissionDenied("User must belong to the same organization as the unit.")
 
+    @staticmethod
+    def join_group_chat(unit_id, user_id, is_admin):
+        conversation = add_user_to_group_chat(unit_id=unit_id, user_id=user_id, is_admin=is_admin)
+        if conversation:
+            clear_removals("conversation", conversation.id, [user_id])
+
+    @staticmethod
+    def leave_group_chat(unit_id, user_id):
+        conversation_id = remove_user_from_group_chat(unit_id=unit_id, user_id=user_id)
+        if conversation_id:
+            # Offline clients learn that they left through their next /api/sync/
+            record_removals("conversation", conversation_id, [user_id])
+
     def perform_create(self, serializer):
         """
         Enforce that only org admins can create unit memberships.
@@ -250,7 +337,7 @@ class UnitMembershipViewSet(viewsets.ModelViewSet):
         membership = serializer.save()
 
         sql_user_id = str(user_profile.user.id)  # Django User.id
-        add_user_to_group_chat(unit_id=unit.id, user_id=sql_user_id, is_admin=membership.is_admin)
+        self.join_group_chat(membership.unit_id, sql_user_id, membership.is_admin)
 
     def perform_update(self, serializer):
         """
@@ -265,11 +352,21 @@ class UnitMembershipViewSet(viewsets.ModelViewSet):
         if new_unit and new_unit.department.location.organization != org:
             raise PermissionDenied("Cannot change to a unit from another organization.")
 
+        previous_unit_id = serializer.instance.unit_id
+        previous_user_id = str(serializer.instance.user.user_id)
+        was_admin = serializer.instance.is_admin
         membership = serializer.save()
 
-        sql_user_id = str(membership.user.user.id)
-        remove_user_from_group_chat(unit_id=membership.unit.id, user_id=sql_user_id)
-        add_user_to_group_chat(unit_id=membership.unit.id, user_id=sql_user_id, is_admin=membership.is_admin)
+        sql_user_id = str(membership.user.user_id)
+        if membership.unit_id == previous_unit_id and sql_user_id == previous_user_id:
+            # Same person in the same unit: at most the role changed, so keep their chat membership
+            if membership.is_admin != was_admin:
+                sync_group_chat_members(membership.unit_id, added={}, removed=[],
+                                        role_changes={sql_user_id: membership.is_admin})
+            return
+
+        self.leave_group_chat(previous_unit_id, previous_user_id)
+        self.join_group_chat(membership.unit_id, sql_user_id, membership.is_admin)
 
     def perform_destroy(self, instance):
         """
@@ -279,7 +376,7 @@ class UnitMembershipViewSet(viewsets.ModelViewSet):
         check_org_admin_or_raise(self.request.user, org)
 
         sql_user_id = str(instance.user.user.id)
-        remove_user_from_group_chat(unit_id=instance.unit.id, user_id=sql_user_id)
+        self.leave_group_chat(instance.unit.id, sql_user_id)
 
         instance.delete()
 
@@ -330,9 +427,13 @@ class UserProfileViewSet(
         return Response(serializer.data)
 
 
-class RoleViewSet(viewsets.ModelViewSet):
+class RoleViewSet(VersionedListCacheMixin, viewsets.ModelViewSet):
     queryset = Role.objects.all()
     serializer_class = RoleSerializer
+    cache_kinds = (ROLE,)
+
+    def get_cache_scope(self):
+        return ALL
 
 
 class OnCallShiftViewSet(viewsets.ModelViewSet):
@@ -393,6 +494,91 @@ class OnCallShiftViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    @action(detail=False, methods=["post"], url_path="import")
+    def bulk_import(self, request):
+        """
+        Import many shifts at once from a JSON body ({"shifts": [...]}), a CSV or ICS body, or a
+        `file` upload. All rows are validated first; nothing is saved unless every row is valid.
+        """
+        content_type = request.content_type.split(";")[0].strip().lower()
+        upload = request.FILES.get("file") if content_type == "multipart/form-data" else None
+        user, unit = request.query_params.get("user"), request.query_params.get("unit")
+
+        try:
+            if upload is not None:
+                text = upload.read().decode("utf-8-sig")
+                name = upload.name.lower()
+                rows = rows_from_ics(text, user, unit) if name.endswith(".ics") else rows_from_csv(text)
+            elif content_type == "text/csv":
+                rows = rows_from_csv(request.body.decode("utf-8-sig"))
+            elif content_type == "text/calendar":
+                rows = rows_from_ics(request.body.decode("utf-8-sig"), user, unit)
+            else:
+                rows = request.data.get("shifts") if isinstance(request.data, dict) else request.data
+        except (UnicodeDecodeError, ValueError) as e:
+            return Response({"detail": f"Could not read the import: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not isinstance(rows, list) or not rows:
+            return Response({"detail": "No shifts to import"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > settings.SHIFT_IMPORT_MAX_ROWS:
+            return Response({"detail": f"At most {settings.SHIFT_IMPORT_MAX_ROWS} shifts per import"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not all(isinstance(row, dict) for row in rows):
+            return Response({"detail": "Each shift must be an object"}, status=status.HTTP_400_BAD_REQUEST)
+
+        dry_run = request.query_params.get("dry_run") in ("1", "true")
+        results, created = import_shifts(rows, request.user, dry_run=dry_run)
+        failed = sum(1 for result in results if "errors" in result)
+        if failed:
+            response_status = status.HTTP_400_BAD_REQUEST
+        else:
+            response_status = status.HTTP_200_OK if dry_run else status.HTTP_201_CREATED
+        return Response({"created": created, "failed": failed, "results": results}, status=response_status)
+
+    @action(detail=False, methods=["get"], url_path="feed-url")
+    def feed_url(self, request):
+        """
+        Address of an ICS feed for calendar apps: the shifts of `?unit=`, or the caller's own
+        shifts without it. The address is the credential, so it is only handed to the caller.
+        """
+        unit_id = request.query_params.get("unit")
+        if unit_id:
+            unit = get_object_or_404(Unit.objects.select_related("department__location"), pk=unit_id)
+            location = unit.department.location if unit.department else None
+            if location is None or str(location.id) not in get_access(request.user.id).get(
+                    str(location.organization_id), ()):
+                raise PermissionDenied("You do not have access to this unit's location.")
+            token = feed_token(FEED_UNIT, unit.id, request.user.id, location.organization_id, location.id)
+        else:
+            token = feed_token(FEED_USER, request.user.id, request.user.id)
+        return Response({"url": request.build_absolute_uri(reverse("api:shifts-feed", kwargs={"token": token}))})
+
+    @action(detail=False, methods=["get"], url_path=r"feed/(?P<token>[^/]+)",
+            permission_classes=[AllowAny], authentication_classes=[], renderer_classes=[ICSRenderer])
+    def feed(self, request, token=None):
+        """ICS feed addressed by a token from `feed-url`; supports If-None-Match and If-Modified-Since."""
+        try:
+            scope, scope_id, owner_id, organization_id, location_id = read_feed_token(token)
+        except (signing.BadSignature, ValueError):
+            return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+        if scope == FEED_UNIT and str(location_id) not in get_access(owner_id).get(str(organization_id), ()):
+            return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+
+        version, last_modified = feed_version(scope, scope_id)
+        etag = feed_etag(scope, scope_id, version)
+        if_none_match = request.headers.get("If-None-Match")
+        if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+        if (etag in parse_etags(if_none_match) if if_none_match
+                else if_modified_since is not None and last_modified <= if_modified_since):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            body, etag, last_modified = get_feed(scope, scope_id)
+            response = HttpResponse(body, content_type="text/calendar; charset=utf-8")
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        response["Cache-Control"] = "private, max-age=300"
+        return response
+
 
 class ConsultationViewSet(viewsets.ModelViewSet):
     serializer_class = ConsultationSerializer
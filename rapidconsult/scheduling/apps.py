@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SchedulingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rapidconsult.scheduling'
+
+    def ready(self):
+        import rapidconsult.scheduling.signals  # noqa: F401
@@ -0,0 +1,211 @@
+"""
+Staff directory: who can be found at which organization and location.
+
+DirectoryMembership flattens UserOrgProfile.allowed_locations (plus the profile's user and
+organization) into one indexed table, which `scheduling.signals` keeps in step with profile
+and allowed-location changes. Searches match name / username (and, within an organization,
+email) through the pg_trgm indexes on the users table and filter by organization and location
+with EXISTS subqueries, so they need neither the profile joins nor a DISTINCT.
+
+DirectoryEntry materializes what a contact picker shows for each user at each location.
+`refresh_directory_entries` rewrites the entries of the users a change touched, stamping
+them with the location's next directory_version. Clients download a location once and then
+ask only for entries changed since the version they hold.
+"""
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q, Subquery
+
+from rapidconsult.scheduling.models import DirectoryEntry, DirectoryMembership, Location, UserOrgProfile
+from rapidconsult.users.models import Contact
+
+User = get_user_model()
+
+
+def sync_directory_memberships(profile_ids):
+    """Bring the directory rows of the given profiles in line with their allowed locations."""
+    profile_ids = set(profile_ids)
+    if not profile_ids:
+        return
+
+    desired = {
+        (profile_id, location_id): (user_id, organization_id)
+        for profile_id, location_id, user_id, organization_id in UserOrgProfile.allowed_locations.through.objects.filter(
+            userorgprofile_id__in=profile_ids,
+            userorgprofile__user__isnull=False,
+            userorgprofile__organization__isnull=False,
+        ).values_list("userorgprofile_id", "location_id", "userorgprofile__user_id", "userorgprofile__organization_id")
+    }
+    existing = {
+        (profile_id, location_id): (row_id, (user_id, organization_id))
+        for row_id, profile_id, location_id, user_id, organization_id in DirectoryMembership.objects.filter(
+            profile_id__in=profile_ids
+        ).values_list("id", "profile_id", "location_id", "user_id", "organization_id")
+    }
+
+    # A profile moved to another user or organization has its rows replaced
+    stale = [row_id for key, (row_id, owner) in existing.items() if desired.get(key) != owner]
+    missing = [key for key, owner in desired.items() if key not in existing or existing[key][1] != owner]
+    if stale:
+        DirectoryMembership.objects.filter(id__in=stale).delete()
+    if missing:
+        DirectoryMembership.objects.bulk_create([
+            DirectoryMembership(profile_id=profile_id, location_id=location_id,
+                                user_id=desired[profile_id, location_id][0],
+                                organization_id=desired[profile_id, location_id][1])
+            for profile_id, location_id in missing
+        ])
+
+    # Job titles and roles live on the profile, so the entries are refreshed even if no row changed
+    refresh_directory_entries(
+        {owner[0] for owner in desired.values()} | {owner[0] for _, owner in existing.values()}
+        | set(UserOrgProfile.objects.filter(id__in=profile_ids).exclude(user=None).values_list("user_id", flat=True))
+    )
+
+
+def search_directory(query, organization_id=None, location_id=None):
+    """
+    Users whose name or username contains `query`, best name matches first. With an
+    organization, the search is limited to its members, also matches emails, and each user is
+    annotated with their `job_title` and `role_name` there.
+    """
+    matches = Q(name__icontains=query) | Q(username__icontains=query)
+    # Emails are only searchable within an organization, so `q=@domain` cannot list everyone's
+    if organization_id:
+        matches |= Q(email__icontains=query)
+    users = User.objects.filter(matches).only("id", "username", "name", "email", "profile_picture")
+
+    if organization_id:
+        # Members without any allowed location have no directory rows but are still found here
+        profile = UserOrgProfile.objects.filter(user=OuterRef("pk"), organization_id=organization_id)
+        users = users.filter(Exists(profile)).annotate(
+            job_title=Subquery(profile.values("job_title")[:1]),
+            role_name=Subquery(profile.values("role__name")[:1]),
+        )
+    if location_id:
+        site = {"location_id": location_id}
+        if organization_id:
+            site["organization_id"] = organization_id
+        users = users.filter(Exists(DirectoryMembership.objects.filter(user=OuterRef("pk"), **site)))
+
+    return users.annotate(rank=TrigramWordSimilarity(query, "name")).order_by(
+        F("rank").desc(nulls_last=True), "name", "id"
+    )
+
+
+ENTRY_FIELDS = ("name", "avatar", "job_title", "role", "primary_contact")
+
+
+def _primary_contacts(user_ids):
+    contacts = {}
+    for contact in Contact.objects.filter(user_id__in=user_ids).order_by("user_id", "-primary", "id"):
+        contacts.setdefault(contact.user_id, {
+            "type": contact.type,
+            "country_code": contact.country_code,
+            "number": contact.number,
+        })
+    return contacts
+
+
+def _lock_locations(location_ids):
+    """Row-lock the locations in id order; concurrent refreshes of their entries then run one at a time."""
+    list(Location.objects.select_for_update().filter(id__in=location_ids).order_by("id").values_list("id", flat=True))
+
+
+def _bump_versions(location_ids):
+    """Next directory_version of each (already locked) location."""
+    versions = {}
+    for location_id in sorted(location_ids):
+        Location.objects.filter(id=location_id).update(directory_version=F("directory_version") + 1)
+        versions[location_id] = Location.objects.values_list("directory_version", flat=True).get(id=location_id)
+    return versions
+
+
+def _read_entries(user_ids):
+    """(desired entry fields, existing DirectoryEntry) of the users, by (location id, user id)."""
+    avatar_storage = User._meta.get_field("profile_picture").storage
+    contacts = _primary_contacts(user_ids)
+    desired = {}
+    for location_id, user_id, name, picture, job_title, role in DirectoryMembership.objects.filter(
+        user_id__in=user_ids
+    ).values_list("location_id", "user_id", "user__name", "user__profile_picture", "profile__job_title",
+                  "profile__role__name"):
+        desired[location_id, user_id] = {
+            "name": name,
+            "avatar": avatar_storage.url(picture) if picture else None,
+            "job_title": job_title,
+            "role": role,
+            "primary_contact": contacts.get(user_id),
+        }
+
+    existing = {(entry.location_id, entry.user_id): entry for entry in DirectoryEntry.objects.filter(user_id__in=user_ids)}
+    return desired, existing
+
+
+def refresh_directory_entries(user_ids):
+    """Rewrite the DirectoryEntry rows of the given users that no longer match their data."""
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+
+    with transaction.atomic():
+        # Read under the locks of every location involved, so a refresh that waited for a concurrent
+        # one sees what it committed instead of writing older data under a newer version
+        locked = set()
+        while True:
+            desired, existing = _read_entries(user_ids)
+            location_ids = {key[0] for key in desired} | {key[0] for key in existing}
+            if location_ids <= locked:
+                break
+            _lock_locations(location_ids - locked)
+            locked |= location_ids
+
+        changed, created = [], []
+        for key, fields in desired.items():
+            entry = existing.get(key)
+            if entry is None:
+                created.append(DirectoryEntry(location_id=key[0], user_id=key[1], **fields))
+            elif not entry.is_active or any(getattr(entry, field) != value for field, value in fields.items()):
+                for field, value in fields.items():
+                    setattr(entry, field, value)
+                entry.is_active = True
+                changed.append(entry)
+        for key, entry in existing.items():
+            if entry.is_active and key not in desired:
+                entry.is_active = False
+                changed.append(entry)
+
+        if not (changed or created):
+            return
+
+        versions = _bump_versions({entry.location_id for entry in changed + created})
+        for entry in changed + created:
+            entry.version = versions[entry.location_id]
+        if changed:
+            DirectoryEntry.objects.bulk_update(changed, [*ENTRY_FIELDS, "version", "is_active"])
+        if created:
+            # A concurrent refresh of the same user may have created the entry first
+            DirectoryEntry.objects.bulk_create(created, ignore_conflicts=True)
+
+
+def get_directory_changes(location_id, since=None):
+    """
+    (version, entries, removed user ids, full) for a location: everything when `since` is None or
+    not a version this location has issued, otherwise only what changed after `since`.
+    """
+    version = Location.objects.values_list("directory_version", flat=True).get(id=location_id)
+    entries = DirectoryEntry.objects.filter(location_id=location_id)
+    full = since is None or since > version
+    if full:
+        entries = entries.filter(is_active=True)
+    else:
+        entries = entries.filter(version__gt=since)
+
+    active, removed = [], []
+    for entry in entries.order_by("version", "id"):
+        if entry.is_active:
+            active.append(entry)
+        else:
+            removed.append(entry.user_id)
+    return version, active, removed, full
@@ -0,0 +1,117 @@
+"""
+ICS calendar feeds of on-call shifts, per unit and per user.
+
+Calendar apps poll a feed every few minutes and cannot send an auth header, so a feed is
+addressed by a signed token naming its scope (a unit or a user) and the user it was issued to,
+whose access to the unit is re-checked on every poll. The body is built by streaming the
+shifts from the database and cached in Redis under a per-scope version token, which
+`scheduling.signals` replaces whenever a shift of the scope changes. The version also carries
+the time of that change, which is served as Last-Modified, so polls of an unchanged feed cost
+one Redis GET and a 304.
+"""
+import datetime
+import time
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+from rapidconsult.chats.presence import r
+from rapidconsult.scheduling.ics import format_datetime, write_calendar
+from rapidconsult.scheduling.models import OnCallShift, Unit
+
+FEED_SALT = "rapidconsult.scheduling.feeds"
+UNIT, USER = "unit", "user"
+
+
+def feed_token(scope, scope_id, owner_id, organization_id=None, location_id=None):
+    """Signed feed address; unit feeds carry the unit's site so polls can re-check access without a query."""
+    return signing.dumps([scope, int(scope_id), owner_id, organization_id, location_id], salt=FEED_SALT,
+                         compress=True)
+
+
+def read_feed_token(token):
+    """(scope, scope id, owner user id, organization id, location id); raises signing.BadSignature."""
+    scope, scope_id, owner_id, organization_id, location_id = signing.loads(token, salt=FEED_SALT)
+    return scope, scope_id, owner_id, organization_id, location_id
+
+
+def _version_key(scope, scope_id):
+    return f"scheduling:feed:version:{scope}:{scope_id}"
+
+
+def _new_version():
+    return f"{uuid.uuid4().hex[:12]}-{int(time.time())}"
+
+
+def feed_version(scope, scope_id):
+    """(version, last modified as a unix timestamp) of the feed."""
+    version = r.get(_version_key(scope, scope_id))
+    if version is None:
+        r.set(_version_key(scope, scope_id), _new_version(), nx=True)
+        version = r.get(_version_key(scope, scope_id))
+    return version, int(version.rsplit("-", 1)[1])
+
+
+def feed_etag(scope, scope_id, version):
+    return f'"feed-{scope}-{scope_id}-{version}"'
+
+
+def _shift_events(shifts, stamp):
+    labels = dict(OnCallShift.SHIFT_TYPE_CHOICES)
+    for shift_id, shift_type, start, end, profile_id, name, username, unit_id, unit_name in shifts.iterator(
+        chunk_size=2000
+    ):
+        yield [
+            ("UID", f"shift-{shift_id}@rapidconsult"),
+            ("DTSTAMP", stamp),
+            ("DTSTART", format_datetime(start)),
+            ("DTEND", format_datetime(end)),
+            ("SUMMARY", f"{labels.get(shift_type, shift_type)}: {name or username or 'Unassigned'} ({unit_name})"),
+            ("CATEGORIES", shift_type),
+            ("X-RAPIDCONSULT-USER", profile_id),
+            ("X-RAPIDCONSULT-UNIT", unit_id),
+            ("X-RAPIDCONSULT-SHIFT-TYPE", shift_type),
+        ]
+
+
+def build_feed(scope, scope_id, last_modified):
+    since = timezone.now() - datetime.timedelta(days=settings.ICS_FEED_PAST_DAYS)
+    shifts = OnCallShift.objects.filter(end_time__gte=since, start_time__isnull=False)
+    if scope == UNIT:
+        shifts = shifts.filter(unit_id=scope_id)
+        name = Unit.objects.filter(id=scope_id).values_list("name", flat=True).first() or "Unit"
+        name = f"{name} on-call"
+    else:
+        shifts = shifts.filter(user__user_id=scope_id)
+        name = "My shifts"
+
+    shifts = shifts.order_by("start_time", "id").values_list(
+        "id", "shift_type", "start_time", "end_time", "user_id", "user__user__name", "user__user__username",
+        "unit_id", "unit__name",
+    )
+    stamp = format_datetime(datetime.datetime.fromtimestamp(last_modified, tz=datetime.timezone.utc))
+    return "".join(write_calendar(name, _shift_events(shifts, stamp)))
+
+
+def get_feed(scope, scope_id):
+    """(body, etag, last modified) of the feed, from the cache when its version is unchanged."""
+    version, last_modified = feed_version(scope, scope_id)
+    key = f"scheduling:feed:{scope}:{scope_id}:{version}"
+
+    body = r.get(key)
+    if body is None:
+        body = build_feed(scope, scope_id, last_modified)
+        r.set(key, body, ex=settings.ICS_FEED_CACHE_TTL)
+    return body, feed_etag(scope, scope_id, version), last_modified
+
+
+def invalidate_feeds(unit_ids=(), user_ids=()):
+    scopes = [(UNIT, unit_id) for unit_id in set(unit_ids) if unit_id is not None]
+    scopes += [(USER, user_id) for user_id in set(user_ids) if user_id is not None]
+    if scopes:
+        pipe = r.pipeline(transaction=False)
+        for scope, scope_id in scopes:
+            pipe.set(_version_key(scope, scope_id), _new_version())
+        pipe.execute()
@@ -0,0 +1,112 @@
+"""
+Minimal iCalendar (RFC 5545) support for shift rosters: reading VEVENTs for bulk imports and
+writing calendar feeds. Only what rosters use is handled: DTSTART / DTEND as UTC, floating or
+TZID date-times, SUMMARY, CATEGORIES and X- properties.
+"""
+import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.utils import timezone
+
+
+class ICSError(ValueError):
+    pass
+
+
+def _unfold(text):
+    lines = []
+    for line in text.replace("\r\n", "\n").split("\n"):
+        if line[:1] in (" ", "\t") and lines:
+            lines[-1] += line[1:]
+        elif line:
+            lines.append(line)
+    return lines
+
+
+def _split_property(line):
+    """'DTSTART;TZID=Asia/Kolkata:20251110T080000' -> ('DTSTART', {'TZID': 'Asia/Kolkata'}, '20251110T080000')"""
+    head, sep, value = line.partition(":")
+    if not sep:
+        raise ICSError(f"Malformed line: {line!r}")
+    name, *params = head.split(";")
+    return name.upper(), dict(param.split("=", 1) for param in params if "=" in param), value
+
+
+def parse_datetime_value(value, params):
+    try:
+        if "T" not in value:
+            # All-day (VALUE=DATE): midnight in the default timezone
+            parsed = datetime.datetime.strptime(value, "%Y%m%d")
+            return timezone.make_aware(parsed)
+        if value.endswith("Z"):
+            return datetime.datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=datetime.timezone.utc)
+        parsed = datetime.datetime.strptime(value, "%Y%m%dT%H%M%S")
+    except ValueError:
+        raise ICSError(f"Invalid date-time {value!r}")
+
+    if "TZID" in params:
+        try:
+            return parsed.replace(tzinfo=ZoneInfo(params["TZID"].strip('"')))
+        except ZoneInfoNotFoundError:
+            raise ICSError(f"Unknown TZID {params['TZID']!r}")
+    return timezone.make_aware(parsed)
+
+
+def parse_events(text):
+    """VEVENTs of a calendar as dicts of property name -> (params, value), in file order."""
+    events = []
+    current = None
+    for line in _unfold(text):
+        name, params, value = _split_property(line)
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            current = {}
+        elif name == "END" and value.upper() == "VEVENT":
+            if current is not None:
+                events.append(current)
+            current = None
+        elif current is not None:
+            current[name] = (params, value)
+    return events
+
+
+def _escape(text):
+    return (str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def _fold(line):
+    """Split a content line into 75-octet pieces, continuation lines starting with a space."""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    pieces, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Never cut a multi-byte character in half
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        pieces.append(encoded[start:end].decode("utf-8"))
+        start, limit = end, 74
+    return "\r\n ".join(pieces) + "\r\n"
+
+
+def format_datetime(value):
+    return value.astimezone(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def write_calendar(name, events):
+    """
+    Yield the lines of a VCALENDAR named `name`. `events` is an iterable of lists of
+    (property, value) pairs; text values are escaped, date-times must be pre-formatted.
+    """
+    yield _fold("BEGIN:VCALENDAR")
+    yield _fold("VERSION:2.0")
+    yield _fold("PRODID:-//RapidConsult//On-call roster//EN")
+    yield _fold("CALSCALE:GREGORIAN")
+    yield _fold(f"X-WR-CALNAME:{_escape(name)}")
+    for event in events:
+        yield _fold("BEGIN:VEVENT")
+        for prop, value in event:
+            yield _fold(f"{prop}:{value if prop in ('DTSTAMP', 'DTSTART', 'DTEND') else _escape(value)}")
+        yield _fold("END:VEVENT")
+    yield _fold("END:VCALENDAR")
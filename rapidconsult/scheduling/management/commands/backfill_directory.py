@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from rapidconsult.scheduling.directory import sync_directory_memberships
+from rapidconsult.scheduling.models import UserOrgProfile
+
+
+class Command(BaseCommand):
+    help = "Rebuild DirectoryMembership rows and DirectoryEntry snapshots from every org profile."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Profiles synced per batch")
+
+    def handle(self, *args, **options):
+        profile_ids = list(UserOrgProfile.objects.order_by("id").values_list("id", flat=True))
+        batch_size = options["batch_size"]
+        for start in range(0, len(profile_ids), batch_size):
+            # Also refreshes the directory entries of the profiles' users
+            sync_directory_memberships(profile_ids[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f"Synced the directory of {len(profile_ids)} org profiles."))
@@ -0,0 +1,79 @@
+import datetime
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from rapidconsult.scheduling.models import (
+    Department, Location, OnCallShift, Organization, Role, Unit, UserOrgProfile,
+)
+from rapidconsult.scheduling.shift_import import import_shifts
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Time a bulk shift import against seeded existing shifts; everything is rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shifts", type=int, default=10000, help="Rows in the import")
+        parser.add_argument("--users", type=int, default=200, help="Profiles the shifts are spread across")
+        parser.add_argument("--existing", type=int, default=10000, help="Shifts already stored before the import")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        organization = Organization.objects.create(name="Benchmark organization")
+        location = Location.objects.create(name="Benchmark location", organization=organization)
+        department = Department.objects.create(name="Benchmark department", location=location)
+        unit = Unit.objects.create(name="Benchmark unit", department=department)
+        admin_role, _ = Role.objects.get_or_create(name="admin")
+
+        # bulk_create keeps the user / profile signals (Mongo sync, directory) out of the timing
+        requester = User.objects.bulk_create([User(username=f"benchmark-import-{time.time_ns()}")])[0]
+        if requester.pk is None:
+            requester = User.objects.get(username=requester.username)
+        UserOrgProfile.objects.create(user=requester, organization=organization, role=admin_role)
+        profiles = UserOrgProfile.objects.bulk_create(
+            [UserOrgProfile(organization=organization) for _ in range(options["users"])]
+        )
+
+        # Back-to-back 8 hour shifts per profile; existing ones come first, imported ones after
+        origin = timezone.now().replace(minute=0, second=0, microsecond=0)
+        shift = datetime.timedelta(hours=8)
+
+        def slot(index):
+            return origin + shift * (index // len(profiles)), profiles[index % len(profiles)]
+
+        existing = []
+        for index in range(options["existing"]):
+            start, profile = slot(index)
+            existing.append(OnCallShift(user=profile, unit=unit, start_time=start, end_time=start + shift))
+        OnCallShift.objects.bulk_create(existing, batch_size=1000)
+
+        rows = []
+        for index in range(options["existing"], options["existing"] + options["shifts"]):
+            start, profile = slot(index)
+            rows.append({
+                "user": profile.id,
+                "unit": unit.id,
+                "shift_type": "oncall",
+                "start_time": start.isoformat(),
+                "end_time": (start + shift).isoformat(),
+            })
+
+        self.stdout.write(f"Importing {len(rows)} shifts for {len(profiles)} users over {len(existing)} existing...")
+        for label, dry_run in (("validate only", True), ("validate + insert", False)):
+            started = time.perf_counter()
+            results, created = import_shifts(rows, requester, dry_run=dry_run)
+            elapsed = time.perf_counter() - started
+            failed = sum(1 for result in results if "errors" in result)
+            self.stdout.write(
+                f"{label:>18}: {elapsed * 1000:.0f} ms, {len(rows) / elapsed:.0f} rows/s, "
+                f"created {created}, failed {failed}"
+            )
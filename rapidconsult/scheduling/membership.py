@@ -0,0 +1,65 @@
+"""
+Diff-based unit roster updates.
+
+Saving a unit with a `members` list used to delete every membership and recreate them one by
+one, and a membership edit left and rejoined the group chat even when only is_admin flipped.
+`reconcile_unit_members` works out what actually changed and applies just that: one
+bulk_create, one bulk_update and one delete in SQL, then a single bulk write per Mongo
+collection to the unit's group chat once the transaction commits.
+"""
+from django.db import transaction
+
+from rapidconsult.chats.api.mongo import sync_group_chat_members
+from rapidconsult.scheduling.models import UnitMembership
+from rapidconsult.scheduling.tree import invalidate_org_tree, tree_organization_ids
+from rapidconsult.users.sync import clear_removals, record_removals
+
+
+def reconcile_unit_members(unit, members_data):
+    """
+    Make `unit`'s memberships match `members_data` (validated UnitMembershipSerializer data).
+    Returns the Django user ids added, removed and with a changed role.
+    """
+    current = {membership.user_id: membership for membership in unit.unitmembership_set.select_related("user")}
+    # Keyed by profile id, so a profile listed twice keeps its last entry
+    desired = {member["user"].id: member for member in members_data}
+
+    to_add = [
+        UnitMembership(unit=unit, user=member["user"], is_admin=member.get("is_admin", False))
+        for profile_id, member in desired.items()
+        if profile_id not in current
+    ]
+    to_remove = [membership for profile_id, membership in current.items() if profile_id not in desired]
+    to_change = []
+    for profile_id, membership in current.items():
+        is_admin = desired.get(profile_id, {}).get("is_admin", False)
+        if profile_id in desired and membership.is_admin != is_admin:
+            membership.is_admin = is_admin
+            to_change.append(membership)
+
+    with transaction.atomic():
+        if to_remove:
+            UnitMembership.objects.filter(id__in=[membership.id for membership in to_remove]).delete()
+        if to_add:
+            UnitMembership.objects.bulk_create(to_add)
+        if to_change:
+            UnitMembership.objects.bulk_update(to_change, ["is_admin"])
+
+    # Chat members are keyed by the Django user id, not the org profile
+    added = {str(membership.user.user_id): membership.is_admin for membership in to_add}
+    removed = [str(membership.user.user_id) for membership in to_remove]
+    role_changes = {str(membership.user.user_id): membership.is_admin for membership in to_change}
+    if added or removed or role_changes:
+        def sync_chat():
+            conversation_id = sync_group_chat_members(unit.id, added, removed, role_changes)
+            if conversation_id:
+                # Offline clients learn about the users who left through their next /api/sync/
+                record_removals("conversation", conversation_id, removed)
+                clear_removals("conversation", conversation_id, added)
+
+        transaction.on_commit(sync_chat)
+    if to_add:
+        # bulk_create sends no post_save, and the org tree shows member counts
+        org_ids = tree_organization_ids(unit)
+        transaction.on_commit(lambda: invalidate_org_tree(*org_ids))
+    return added, removed, role_changes
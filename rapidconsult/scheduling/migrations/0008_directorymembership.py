@@ -0,0 +1,50 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    UserOrgProfile = apps.get_model('scheduling', 'UserOrgProfile')
+    DirectoryMembership = apps.get_model('scheduling', 'DirectoryMembership')
+    rows = UserOrgProfile.allowed_locations.through.objects.filter(
+        userorgprofile__user__isnull=False,
+        userorgprofile__organization__isnull=False,
+    ).values_list('userorgprofile_id', 'location_id', 'userorgprofile__user_id', 'userorgprofile__organization_id')
+    DirectoryMembership.objects.bulk_create(
+        [
+            DirectoryMembership(profile_id=profile_id, location_id=location_id, user_id=user_id,
+                                organization_id=organization_id)
+            for profile_id, location_id, user_id, organization_id in rows.iterator()
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('scheduling', '0007_consultation_department_alter_consultation_location_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='directory_memberships', to='scheduling.location')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='scheduling.organization')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='directory_memberships', to='scheduling.userorgprofile')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='directory_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('profile', 'location'), name='scheduling_dirmember_unique')],
+                'indexes': [
+                    models.Index(fields=['location', 'user'], name='scheduling_dirmember_loc_idx'),
+                    models.Index(fields=['organization', 'user'], name='scheduling_dirmember_org_idx'),
+                ],
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
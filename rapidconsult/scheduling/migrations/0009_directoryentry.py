@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0008_directorymembership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='directory_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='DirectoryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField()),
+                ('name', models.CharField(blank=True, max_length=255, null=True)),
+                ('avatar', models.CharField(blank=True, max_length=500, null=True)),
+                ('job_title', models.CharField(blank=True, max_length=255, null=True)),
+                ('role', models.CharField(blank=True, max_length=100, null=True)),
+                ('primary_contact', models.JSONField(blank=True, null=True)),
+                ('version', models.PositiveBigIntegerField()),
+                ('is_active', models.BooleanField(default=True)),
+                ('location', models.ForeignKey(on_delete=models.deletion.CASCADE, related_name='directory_entries', to='scheduling.location')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('location', 'user_id'), name='scheduling_direntry_unique')],
+                'indexes': [models.Index(fields=['location', 'version'], name='scheduling_direntry_ver_idx')],
+            },
+        ),
+    ]
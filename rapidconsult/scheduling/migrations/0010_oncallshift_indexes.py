@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0009_directoryentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='oncallshift',
+            index=models.Index(fields=['user', 'start_time'], name='scheduling_shift_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='oncallshift',
+            index=models.Index(fields=['unit', 'start_time'], name='scheduling_shift_unit_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0010_oncallshift_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='oncallshift',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='oncallshift',
+            index=models.Index(fields=['updated_at', 'id'], name='scheduling_shift_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='consultation',
+            index=models.Index(fields=['updated_at', 'id'], name='scheduling_consult_updated_idx'),
+        ),
+    ]
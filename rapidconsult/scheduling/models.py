@@ -40,6 +40,8 @@ class Location(models.Model):
                                      null=True)
     address = models.ForeignKey(Address, on_delete=models.SET_NULL, blank=True, null=True)
     display_picture = models.ImageField(upload_to="org_pics/", blank=True, null=True)
+    # Bumped (under the row lock) by every change to this location's DirectoryEntry rows
+    directory_version = models.PositiveBigIntegerField(default=0)
 
     def __str__(self):
         return f"{self.name} ({self.organization.name})"
@@ -76,6 +78,60 @@ class UserOrgProfile(models.Model):
                 )
 
 
+class DirectoryMembership(models.Model):
+    """
+    One row per org profile and location it may access: UserOrgProfile.allowed_locations flattened
+    with the user and organization, so directory queries filter one indexed table instead of
+    joining through profiles. Kept in sync by signals (see scheduling/directory.py).
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='directory_memberships')
+    profile = models.ForeignKey(UserOrgProfile, on_delete=models.CASCADE, related_name='directory_memberships')
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='+')
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='directory_memberships')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['profile', 'location'], name='scheduling_dirmember_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['location', 'user'], name='scheduling_dirmember_loc_idx'),
+            models.Index(fields=['organization', 'user'], name='scheduling_dirmember_org_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} at location {self.location_id}"
+
+
+class DirectoryEntry(models.Model):
+    """
+    Materialized contact-picker entry of a user at a location. Rows are never deleted while the
+    location exists: a user who leaves is kept as an inactive tombstone so delta syncs see it.
+    `version` is the location's directory_version at the time of the change.
+    """
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='directory_entries')
+    # Not a foreign key: the tombstone has to outlive a deleted user
+    user_id = models.BigIntegerField()
+    name = models.CharField(max_length=255, blank=True, null=True)
+    avatar = models.CharField(max_length=500, blank=True, null=True)
+    job_title = models.CharField(max_length=255, blank=True, null=True)
+    role = models.CharField(max_length=100, blank=True, null=True)
+    primary_contact = models.JSONField(blank=True, null=True)
+    version = models.PositiveBigIntegerField()
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['location', 'user_id'], name='scheduling_direntry_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['location', 'version'], name='scheduling_direntry_ver_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} at location {self.location_id} (v{self.version})"
+
+
 class Unit(models.Model):
     name = models.CharField(max_length=100, blank=True, null=True)
     department = models.ForeignKey(Department, related_name="units", on_delete=models.CASCADE, blank=True, null=True)
@@ -129,6 +185,18 @@ class OnCallShift(models.Model):
         blank=True,
         null=True
     )
+    # Drives the shift section of /api/sync/
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Delta sync (/api/sync/)
+            models.Index(fields=['updated_at', 'id'], name='scheduling_shift_updated_idx'),
+            # Overlap checks of bulk imports, per-user rosters
+            models.Index(fields=['user', 'start_time'], name='scheduling_shift_user_idx'),
+            # Per-unit rosters and calendars
+            models.Index(fields=['unit', 'start_time'], name='scheduling_shift_unit_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user} - {self.unit.name} ({self.start_time} to {self.end_time})"
@@ -203,5 +271,11 @@ class Consultation(models.Model):
     department = models.ForeignKey(Department, on_delete=models.SET_NULL, null=True, blank=True, related_name="departments")
     unit = models.ForeignKey(Unit, on_delete=models.SET_NULL, null=True, blank=True, related_name="units")
 
+    class Meta:
+        indexes = [
+            # Delta sync (/api/sync/)
+            models.Index(fields=['updated_at', 'id'], name='scheduling_consult_updated_idx'),
+        ]
+
     def __str__(self):
         return f"{self.patient_name} ({self.status})"
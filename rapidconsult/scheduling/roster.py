@@ -0,0 +1,136 @@
+"""
+Month grid of a department's on-call roster: unit x day -> shift ids.
+
+Calendar screens used to fetch every shift of the month through `/api/shifts/`, each with
+nested user and unit details, and group them on the device. `build_roster` reads the month in
+one query ordered along the (unit, start_time) index and returns the grid with the shifts,
+users and units side-loaded once each. Grids are cached in Redis per department and month
+under a per-department version token, which `scheduling.signals` replaces whenever a shift,
+unit or shown profile of the department changes; the token is also the ETag.
+"""
+import datetime
+import json
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+from rapidconsult.chats.presence import r
+from rapidconsult.scheduling.models import OnCallShift, Unit
+
+
+def _version_key(department_id):
+    return f"scheduling:roster:version:{department_id}"
+
+
+def _version(department_id):
+    version = r.get(_version_key(department_id))
+    if version is None:
+        r.set(_version_key(department_id), uuid.uuid4().hex[:12], nx=True)
+        version = r.get(_version_key(department_id))
+    return version
+
+
+def _etag(department_id, month, version):
+    return f'"roster-{department_id}-{month}-{version}"'
+
+
+def get_roster_etag(department_id, month):
+    return _etag(department_id, month, _version(department_id))
+
+
+def parse_month(month):
+    """The first day of a "YYYY-MM" month; raises ValueError for anything else."""
+    return datetime.datetime.strptime(month, "%Y-%m").date()
+
+
+def _month_days(first_day):
+    next_month = (first_day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return [first_day + datetime.timedelta(days=n) for n in range((next_month - first_day).days)], next_month
+
+
+def _local_midnight(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def build_roster(department_id, month):
+    first_day = parse_month(month)
+    days, next_month = _month_days(first_day)
+    month_start, month_end = _local_midnight(first_day), _local_midnight(next_month)
+
+    units = {
+        str(unit_id): {"id": unit_id, "name": name}
+        for unit_id, name in Unit.objects.filter(department_id=department_id).order_by("name", "id")
+        .values_list("id", "name")
+    }
+    grid = {unit_id: {} for unit_id in units}
+    shifts, users = {}, {}
+
+    for shift_id, unit_id, profile_id, shift_type, start, end, user_id, name, username, job_title in (
+        OnCallShift.objects.filter(
+            unit__department_id=department_id, start_time__lt=month_end, end_time__gt=month_start
+        ).order_by("unit_id", "start_time", "id").values_list(
+            "id", "unit_id", "user_id", "shift_type", "start_time", "end_time",
+            "user__user_id", "user__user__name", "user__user__username", "user__job_title",
+        )
+    ):
+        shifts[str(shift_id)] = {
+            "unit": unit_id,
+            "user": profile_id,
+            "shift_type": shift_type,
+            "start_time": start.isoformat(),
+            "end_time": end.isoformat(),
+        }
+        if profile_id is not None and str(profile_id) not in users:
+            users[str(profile_id)] = {"id": profile_id, "user_id": user_id, "name": name or username,
+                                      "job_title": job_title}
+
+        # A night shift sits in every local day it covers, within the month
+        day = max(timezone.localtime(start).date(), first_day)
+        last_day = min(timezone.localtime(end - datetime.timedelta(microseconds=1)).date(), days[-1])
+        cells = grid.setdefault(str(unit_id), {})
+        while day <= last_day:
+            cells.setdefault(day.isoformat(), []).append(shift_id)
+            day += datetime.timedelta(days=1)
+
+    return {
+        "department": int(department_id),
+        "month": first_day.strftime("%Y-%m"),
+        "days": [day.isoformat() for day in days],
+        "grid": grid,
+        "shifts": shifts,
+        "users": users,
+        "units": units,
+    }
+
+
+def get_roster(department_id, month):
+    """(roster, etag) of the department's month, from the cache when its version is unchanged."""
+    version = _version(department_id)
+    key = f"scheduling:roster:{department_id}:{month}:{version}"
+
+    raw = r.get(key)
+    if raw is not None:
+        return json.loads(raw), _etag(department_id, month, version)
+
+    roster = build_roster(department_id, month)
+    r.set(key, json.dumps(roster), ex=settings.ROSTER_CACHE_TTL)
+    return roster, _etag(department_id, month, version)
+
+
+def shift_department_ids(unit_ids=(), profile_ids=()):
+    """Departments whose grids show the given units, or any shift of the given profiles."""
+    department_ids = set(Unit.objects.filter(id__in=set(unit_ids) - {None}).values_list("department_id", flat=True))
+    if profile_ids:
+        department_ids |= set(OnCallShift.objects.filter(user_id__in=set(profile_ids) - {None}).values_list(
+            "unit__department_id", flat=True).distinct())
+    return department_ids - {None}
+
+
+def invalidate_rosters(*department_ids):
+    department_ids = {department_id for department_id in department_ids if department_id is not None}
+    if department_ids:
+        pipe = r.pipeline(transaction=False)
+        for department_id in department_ids:
+            pipe.set(_version_key(department_id), uuid.uuid4().hex[:12])
+        pipe.execute()
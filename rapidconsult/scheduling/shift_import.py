@@ -0,0 +1,174 @@
+"""
+Bulk import of on-call shifts (a department's monthly roster in one request).
+
+Rows come from JSON, CSV or ICS and are validated entirely in memory: profiles and units are
+loaded in two queries, the requester's admin organizations in one, and overlaps are checked
+against a per-user interval index of the existing shifts in the imported range (one query)
+plus the other rows of the same import. The whole import runs in one transaction holding row
+locks on the imported users' profiles, so concurrent imports cannot both pass the overlap check;
+valid rows are inserted with one bulk_create, and nothing is inserted if any row is invalid.
+"""
+import bisect
+import csv
+import io
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from rapidconsult.scheduling.feeds import invalidate_feeds
+from rapidconsult.scheduling.ics import ICSError, parse_datetime_value, parse_events
+from rapidconsult.scheduling.models import OnCallShift, Unit, UserOrgProfile
+from rapidconsult.scheduling.roster import invalidate_rosters
+
+SHIFT_TYPES = {choice for choice, _ in OnCallShift.SHIFT_TYPE_CHOICES}
+# X- properties an ICS event can carry to say whose shift it is and where
+ICS_USER, ICS_UNIT, ICS_SHIFT_TYPE = "X-RAPIDCONSULT-USER", "X-RAPIDCONSULT-UNIT", "X-RAPIDCONSULT-SHIFT-TYPE"
+
+
+def rows_from_csv(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def rows_from_ics(text, user=None, unit=None):
+    """One row per VEVENT; `user` / `unit` apply to events that do not name their own."""
+    rows = []
+    for event in parse_events(text):
+        row = {
+            "user": event.get(ICS_USER, (None, user))[1],
+            "unit": event.get(ICS_UNIT, (None, unit))[1],
+            "shift_type": event.get(ICS_SHIFT_TYPE, (None, None))[1],
+        }
+        if row["shift_type"] is None and "CATEGORIES" in event:
+            categories = {category.strip().lower() for category in event["CATEGORIES"][1].split(",")}
+            row["shift_type"] = next(iter(categories & SHIFT_TYPES), None)
+        for field, name in (("start_time", "DTSTART"), ("end_time", "DTEND")):
+            try:
+                row[field] = parse_datetime_value(event[name][1], event[name][0]) if name in event else None
+            except ICSError as e:
+                row[field] = str(e)
+        rows.append(row)
+    return rows
+
+
+class ShiftIndex:
+    """Per-user interval index: sorted starts with a running maximum of ends."""
+
+    def __init__(self, shifts):
+        self.starts = defaultdict(list)
+        self.max_ends = defaultdict(list)
+        for user_id, start, end in sorted(shifts, key=lambda shift: shift[1]):
+            ends = self.max_ends[user_id]
+            self.starts[user_id].append(start)
+            ends.append(max(end, ends[-1]) if ends else end)
+
+    def overlaps(self, user_id, start, end):
+        """True if any indexed shift of the user intersects [start, end)."""
+        count = bisect.bisect_left(self.starts[user_id], end)
+        return count > 0 and self.max_ends[user_id][count - 1] > start
+
+
+def _parse_time(value):
+    if hasattr(value, "tzinfo"):
+        return value
+    try:
+        parsed = parse_datetime(value) if isinstance(value, str) else None
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _as_id(value):
+    value = str(value).strip() if value is not None else ""
+    return int(value) if value.isdigit() else None
+
+
+def import_shifts(rows, requester, dry_run=False):
+    """
+    Validate and insert `rows` (dicts with user, unit, shift_type, start_time, end_time).
+    Returns (results, created): one compact result per row, in order, and how many were inserted.
+    """
+    with transaction.atomic():
+        return _import_shifts(rows, requester, dry_run)
+
+
+def _import_shifts(rows, requester, dry_run):
+    profile_ids = {_as_id(row.get("user")) for row in rows} - {None}
+    unit_ids = {_as_id(row.get("unit")) for row in rows} - {None}
+    if not dry_run:
+        # Concurrent imports for the same users wait here, so each checks overlaps against the
+        # shifts the other committed; id order keeps two imports from deadlocking
+        list(UserOrgProfile.objects.select_for_update().filter(id__in=profile_ids).order_by("id")
+             .values_list("id", flat=True))
+    profiles = UserOrgProfile.objects.in_bulk(profile_ids)
+    units = Unit.objects.select_related("department__location").in_bulk(unit_ids)
+    admin_orgs = set(requester.org_profiles.filter(role__name__iexact="admin").values_list("organization_id", flat=True))
+
+    parsed, results = [], []
+    for number, row in enumerate(rows, start=1):
+        errors = []
+        profile = profiles.get(_as_id(row.get("user")))
+        unit = units.get(_as_id(row.get("unit")))
+        shift_type = str(row.get("shift_type") or "oncall").strip().lower()
+        start, end = _parse_time(row.get("start_time")), _parse_time(row.get("end_time"))
+
+        if profile is None:
+            errors.append("unknown user")
+        if unit is None:
+            errors.append("unknown unit")
+        org_id = unit.department.location.organization_id if unit and unit.department and unit.department.location \
+            else None
+        if unit is not None and org_id not in admin_orgs:
+            errors.append("not an admin of the unit's organization")
+        if profile is not None and unit is not None and profile.organization_id != org_id:
+            errors.append("user is not in the unit's organization")
+        if shift_type not in SHIFT_TYPES:
+            errors.append(f"shift_type must be one of {', '.join(sorted(SHIFT_TYPES))}")
+        if start is None or end is None:
+            errors.append("start_time and end_time must be ISO 8601 date-times")
+        elif start >= end:
+            errors.append("start_time must be before end_time")
+
+        results.append({"row": number, "errors": errors} if errors else {"row": number})
+        if not errors:
+            parsed.append((number, OnCallShift(user=profile, unit=unit, shift_type=shift_type,
+                                               start_time=start, end_time=end)))
+
+    if parsed:
+        range_start = min(shift.start_time for _, shift in parsed)
+        range_end = max(shift.end_time for _, shift in parsed)
+        existing = ShiftIndex(OnCallShift.objects.filter(
+            user_id__in={shift.user_id for _, shift in parsed},
+            start_time__lt=range_end,
+            end_time__gt=range_start,
+        ).values_list("user_id", "start_time", "end_time"))
+
+        # Rows of the same user are checked against each other in start order
+        last_end = {}
+        for number, shift in sorted(parsed, key=lambda item: (item[1].user_id, item[1].start_time)):
+            if existing.overlaps(shift.user_id, shift.start_time, shift.end_time):
+                results[number - 1] = {"row": number, "errors": ["overlaps an existing shift of the user"]}
+            elif last_end.get(shift.user_id) and last_end[shift.user_id] > shift.start_time:
+                results[number - 1] = {"row": number, "errors": ["overlaps another row of the import"]}
+            last_end[shift.user_id] = max(last_end.get(shift.user_id, shift.end_time), shift.end_time)
+
+    if dry_run or any("errors" in result for result in results):
+        return results, 0
+
+    created = OnCallShift.objects.bulk_create([shift for _, shift in parsed], batch_size=1000)
+    # bulk_create sends no post_save, so the calendar feeds and roster grids are invalidated here
+    unit_ids = {shift.unit_id for shift in created}
+    user_ids = {shift.user.user_id for shift in created}
+    department_ids = {shift.unit.department_id for shift in created}
+
+    def invalidate():
+        invalidate_feeds(unit_ids, user_ids)
+        invalidate_rosters(*department_ids)
+
+    transaction.on_commit(invalidate)
+    for (number, _), shift in zip(parsed, created):
+        results[number - 1]["id"] = shift.id
+    return results, len(created)
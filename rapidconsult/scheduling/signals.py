@@ -0,0 +1,269 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from rapidconsult.scheduling.access import invalidate_access
+from rapidconsult.scheduling.directory import refresh_directory_entries, sync_directory_memberships
+from rapidconsult.scheduling.feeds import invalidate_feeds
+from rapidconsult.scheduling.models import Address, Consultation, Department, DirectoryMembership, Location, \
+    OnCallShift, Organization, Role, Unit, UnitMembership, UserOrgProfile
+from rapidconsult.scheduling.roster import invalidate_rosters, shift_department_ids
+from rapidconsult.scheduling.tree import invalidate_org_tree, tree_organization_ids
+from rapidconsult.scheduling.versions import DEPARTMENT, LOCATION, ORGANIZATION, ROLE, UNIT, bump_versions
+from rapidconsult.users.bootstrap import invalidate_all_bootstrap, invalidate_user_bootstrap
+from rapidconsult.users.sync import clear_removals, record_removals
+
+
+def _invalidate_on_commit(user_ids):
+    # After commit, so a concurrent request cannot cache the snapshot it read before the change
+    user_ids = set(user_ids)
+
+    def invalidate():
+        invalidate_access(*user_ids)
+        invalidate_user_bootstrap(*user_ids)
+
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=UserOrgProfile)
+@receiver(post_delete, sender=UserOrgProfile)
+def invalidate_profile_caches(sender, instance, **kwargs):
+    _invalidate_on_commit([instance.user_id])
+
+
+@receiver(m2m_changed, sender=UserOrgProfile.allowed_locations.through)
+def invalidate_allowed_locations_caches(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            _invalidate_on_commit([instance.user_id])
+        return
+
+    # Changed from the location side: `pk_set` holds profile ids, and is None when clearing
+    if action == "pre_clear":
+        _invalidate_on_commit(instance.permitted_users.values_list("user_id", flat=True))
+    elif action in ("post_add", "post_remove"):
+        _invalidate_on_commit(UserOrgProfile.objects.filter(pk__in=pk_set).values_list("user_id", flat=True))
+
+
+@receiver(post_save, sender=UserOrgProfile)
+def sync_profile_directory(sender, instance, **kwargs):
+    # The profile may have moved to another user or organization
+    sync_directory_memberships([instance.pk])
+
+
+@receiver(post_delete, sender=UserOrgProfile)
+def refresh_profile_directory(sender, instance, **kwargs):
+    # The profile's DirectoryMembership rows went with it; its entries become tombstones
+    refresh_directory_entries([instance.user_id])
+
+
+@receiver(post_save, sender=Role)
+def refresh_role_directory(sender, instance, **kwargs):
+    refresh_directory_entries(UserOrgProfile.objects.filter(role=instance).values_list("user_id", flat=True))
+
+
+@receiver(m2m_changed, sender=UserOrgProfile.allowed_locations.through)
+def sync_allowed_locations_directory(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        sync_directory_memberships([instance.pk])
+    elif action == "post_clear":
+        memberships = DirectoryMembership.objects.filter(location=instance)
+        user_ids = set(memberships.values_list("user_id", flat=True))
+        memberships.delete()
+        refresh_directory_entries(user_ids)
+    else:
+        sync_directory_memberships(pk_set)
+
+
+@receiver(pre_delete, sender=Location)
+def invalidate_location_access(sender, instance, **kwargs):
+    # The allowed_locations rows go with the location without an m2m_changed signal
+    _invalidate_on_commit(instance.permitted_users.values_list("user_id", flat=True))
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+@receiver(post_save, sender=Address)
+@receiver(post_delete, sender=Address)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def invalidate_shared_bootstrap(sender, instance, **kwargs):
+    # Shown to every member of the organization, so every bootstrap payload is rebuilt
+    transaction.on_commit(invalidate_all_bootstrap)
+
+
+TREE_MODELS = (Organization, Location, Department, Unit, UnitMembership, Address)
+# Cached list pages (scheduling.api.caching) that show each model
+LIST_KINDS = {
+    Organization: [ORGANIZATION],
+    Location: [LOCATION],
+    Department: [DEPARTMENT],
+    Unit: [UNIT],
+    UnitMembership: [UNIT],
+    Address: [ORGANIZATION, LOCATION],
+}
+
+
+def _invalidate_tree_on_commit(sender, org_ids):
+    org_ids = set(org_ids)
+
+    def invalidate():
+        invalidate_org_tree(*org_ids)
+        bump_versions(LIST_KINDS[sender], org_ids)
+
+    transaction.on_commit(invalidate)
+
+
+def remember_tree_organizations(sender, instance, **kwargs):
+    # A location, department or unit moved to another organization leaves the old tree too
+    if instance.pk is not None and sender is not Organization:
+        stored = sender.objects.filter(pk=instance.pk).first()
+        instance._tree_organization_ids = tree_organization_ids(stored) if stored else set()
+
+
+def invalidate_tree_on_save(sender, instance, **kwargs):
+    _invalidate_tree_on_commit(sender, tree_organization_ids(instance) | getattr(instance, "_tree_organization_ids", set()))
+
+
+def invalidate_tree_on_delete(sender, instance, **kwargs):
+    # Before the delete, while the rows linking the instance to its organization still exist
+    _invalidate_tree_on_commit(sender, tree_organization_ids(instance))
+
+
+for model in TREE_MODELS:
+    pre_save.connect(remember_tree_organizations, sender=model, dispatch_uid=f"tree-pre-save-{model.__name__}")
+    post_save.connect(invalidate_tree_on_save, sender=model, dispatch_uid=f"tree-post-save-{model.__name__}")
+    pre_delete.connect(invalidate_tree_on_delete, sender=model, dispatch_uid=f"tree-pre-delete-{model.__name__}")
+
+
+def _invalidate_shift_caches_on_commit(unit_ids=(), profile_ids=()):
+    unit_ids, profile_ids = set(unit_ids) - {None}, set(profile_ids) - {None}
+    # Personal feeds belong to the Django user behind the shift's org profile
+    user_ids = set(UserOrgProfile.objects.filter(id__in=profile_ids).values_list("user_id", flat=True))
+    department_ids = shift_department_ids(unit_ids)
+
+    def invalidate():
+        invalidate_feeds(unit_ids, user_ids)
+        invalidate_rosters(*department_ids)
+
+    transaction.on_commit(invalidate)
+
+
+@receiver(pre_save, sender=OnCallShift)
+def remember_shift_owners(sender, instance, **kwargs):
+    # A shift moved to another unit or user drops out of the old feeds and grids too
+    if instance.pk is not None:
+        instance._shift_owners = OnCallShift.objects.filter(pk=instance.pk).values_list("unit_id", "user_id").first()
+
+
+@receiver(post_save, sender=OnCallShift)
+@receiver(post_delete, sender=OnCallShift)
+def invalidate_shift_caches(sender, instance, **kwargs):
+    unit_id, profile_id = getattr(instance, "_shift_owners", None) or (None, None)
+    _invalidate_shift_caches_on_commit([instance.unit_id, unit_id], [instance.user_id, profile_id])
+
+
+@receiver(pre_save, sender=Unit)
+def remember_unit_department(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._roster_department_id = Unit.objects.filter(pk=instance.pk).values_list(
+            "department_id", flat=True).first()
+
+
+@receiver(post_save, sender=Unit)
+def invalidate_unit_shift_caches(sender, instance, **kwargs):
+    # Feeds and grids show the unit's name; a unit moved to another department leaves the old grid
+    department_ids = {instance.department_id, getattr(instance, "_roster_department_id", None)}
+
+    def invalidate():
+        invalidate_feeds(unit_ids=[instance.pk])
+        invalidate_rosters(*department_ids)
+
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_delete, sender=Unit)
+def invalidate_unit_roster(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_rosters(instance.department_id))
+
+
+@receiver(post_save, sender=UserOrgProfile)
+@receiver(post_delete, sender=UserOrgProfile)
+def invalidate_profile_shift_caches(sender, instance, **kwargs):
+    # Grids show the profile's job title next to its shifts
+    department_ids = shift_department_ids(profile_ids=[instance.pk])
+
+    def invalidate():
+        invalidate_feeds(user_ids=[instance.user_id])
+        invalidate_rosters(*department_ids)
+
+    transaction.on_commit(invalidate)
+
+
+def _profile_users(*profile_ids):
+    return set(UserOrgProfile.objects.filter(id__in=set(profile_ids) - {None}).values_list("user_id", flat=True)) - {None}
+
+
+def _track_visibility(kind, object_id, old_profile_ids, new_profile_ids):
+    # Users who lost sight of the object get a tombstone, users who can see it again lose theirs
+    old_users, new_users = _profile_users(*old_profile_ids), _profile_users(*new_profile_ids)
+    record_removals(kind, object_id, old_users - new_users)
+    clear_removals(kind, object_id, new_users - old_users)
+
+
+@receiver(post_save, sender=OnCallShift)
+def track_shift_sync(sender, instance, created, **kwargs):
+    if not created:
+        _, profile_id = getattr(instance, "_shift_owners", None) or (None, None)
+        if profile_id != instance.user_id:
+            _track_visibility("shift", instance.pk, [profile_id], [instance.user_id])
+
+
+@receiver(post_delete, sender=OnCallShift)
+def record_shift_removal(sender, instance, **kwargs):
+    record_removals("shift", instance.pk, _profile_users(instance.user_id))
+
+
+@receiver(pre_save, sender=Consultation)
+def remember_consultation_doctors(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._sync_doctors = Consultation.objects.filter(pk=instance.pk).values_list(
+            "referred_by_doctor_id", "referred_to_doctor_id").first()
+
+
+@receiver(post_save, sender=Consultation)
+def track_consultation_sync(sender, instance, created, **kwargs):
+    doctors = getattr(instance, "_sync_doctors", None)
+    current = (instance.referred_by_doctor_id, instance.referred_to_doctor_id)
+    if not created and doctors is not None and set(doctors) != set(current):
+        _track_visibility("consultation", instance.pk, doctors, current)
+
+
+@receiver(post_delete, sender=Consultation)
+def record_consultation_removal(sender, instance, **kwargs):
+    record_removals("consultation", instance.pk,
+                    _profile_users(instance.referred_by_doctor_id, instance.referred_to_doctor_id))
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def bump_role_versions(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_versions([ROLE]))
+
+
+@receiver(post_save, sender=UserOrgProfile)
+@receiver(post_delete, sender=UserOrgProfile)
+def bump_profile_unit_versions(sender, instance, **kwargs):
+    # Unit lists show each member's profile
+    transaction.on_commit(lambda: bump_versions([UNIT], [instance.organization_id]))
+
+
+@receiver(m2m_changed, sender=UserOrgProfile.allowed_locations.through)
+def bump_allowed_locations_unit_versions(sender, instance, action, reverse, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        org_id = instance.organization_id
+        transaction.on_commit(lambda: bump_versions([UNIT], [org_id]))
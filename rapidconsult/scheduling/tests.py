@@ -1,3 +1,106 @@
-from django.test import TestCase
+import datetime
 
-# Create your tests here.
+import pytest
+from django.utils import timezone
+
+from rapidconsult.scheduling.models import (
+    Department, Location, OnCallShift, Organization, Role, Unit, UserOrgProfile
+)
+from rapidconsult.scheduling.shift_import import import_shifts, rows_from_ics
+from rapidconsult.users.tests.factories import UserFactory
+
+UTC = datetime.timezone.utc
+
+
+@pytest.fixture
+def roster(user):
+    organization = Organization.objects.create(name="General Hospital")
+    location = Location.objects.create(name="Main", organization=organization)
+    department = Department.objects.create(name="Cardiology", location=location)
+    unit = Unit.objects.create(name="CCU", department=department)
+    admin, _ = Role.objects.get_or_create(name="admin")
+    UserOrgProfile.objects.create(user=user, organization=organization, role=admin)
+    staff = UserOrgProfile.objects.create(user=UserFactory(), organization=organization)
+    return user, unit, staff
+
+
+def _row(staff, unit, start, end, **extra):
+    return {"user": staff.id, "unit": unit.id, "start_time": start, "end_time": end, **extra}
+
+
+def test_import_rejects_overlap_with_existing_shift(roster):
+    requester, unit, staff = roster
+    OnCallShift.objects.create(user=staff, unit=unit, start_time=datetime.datetime(2025, 11, 10, 8, tzinfo=UTC),
+                               end_time=datetime.datetime(2025, 11, 10, 20, tzinfo=UTC))
+
+    results, created = import_shifts([
+        _row(staff, unit, "2025-11-10T07:00:00Z", "2025-11-10T09:00:00Z"),
+        _row(staff, unit, "2025-11-10T20:00:00Z", "2025-11-11T08:00:00Z"),
+    ], requester)
+
+    assert created == 0
+    assert results == [{"row": 1, "errors": ["overlaps an existing shift of the user"]}, {"row": 2}]
+    assert OnCallShift.objects.count() == 1
+
+
+def test_import_rejects_overlapping_rows_of_the_same_import(roster):
+    requester, unit, staff = roster
+
+    results, created = import_shifts([
+        _row(staff, unit, "2025-11-11T08:00:00Z", "2025-11-11T20:00:00Z"),
+        _row(staff, unit, "2025-11-10T08:00:00Z", "2025-11-11T09:00:00Z"),
+    ], requester)
+
+    assert created == 0
+    # Rows are compared in start order, so the later-starting row is the one reported
+    assert results == [{"row": 1, "errors": ["overlaps another row of the import"]}, {"row": 2}]
+
+
+def test_import_is_all_or_nothing(roster):
+    requester, unit, staff = roster
+
+    results, created = import_shifts([
+        _row(staff, unit, "2025-11-10T08:00:00Z", "2025-11-10T20:00:00Z"),
+        _row(staff, unit, "2025-11-11T08:00:00Z", "2025-11-11T20:00:00Z", shift_type="night"),
+        _row(staff, unit, "2025-11-12T20:00:00Z", "2025-11-12T08:00:00Z"),
+    ], requester)
+
+    assert created == 0
+    assert results[0] == {"row": 1}
+    assert results[1]["errors"] == ["shift_type must be one of oncall, outpatient"]
+    assert results[2]["errors"] == ["start_time must be before end_time"]
+    assert not OnCallShift.objects.exists()
+
+    results, created = import_shifts([_row(staff, unit, "2025-11-10T08:00:00Z", "2025-11-10T20:00:00Z")], requester)
+    assert created == 1
+    assert results == [{"row": 1, "id": OnCallShift.objects.get().id}]
+
+
+def test_import_ics_all_day_and_tzid_events(roster):
+    requester, unit, staff = roster
+    rows = rows_from_ics(
+        "BEGIN:VCALENDAR\r\n"
+        "BEGIN:VEVENT\r\n"
+        "DTSTART;VALUE=DATE:20251110\r\n"
+        "DTEND;VALUE=DATE:20251111\r\n"
+        "CATEGORIES:Outpatient\r\n"
+        "END:VEVENT\r\n"
+        "BEGIN:VEVENT\r\n"
+        "DTSTART;TZID=Asia/Kolkata:20251111T080000\r\n"
+        "DTEND;TZID=Asia/Kolkata:20251111T200000\r\n"
+        "END:VEVENT\r\n"
+        "END:VCALENDAR\r\n",
+        user=staff.id,
+        unit=unit.id,
+    )
+
+    results, created = import_shifts(rows, requester)
+
+    assert created == 2
+    all_day, timed = OnCallShift.objects.order_by("start_time")
+    assert all_day.shift_type == "outpatient"
+    assert all_day.start_time == timezone.make_aware(datetime.datetime(2025, 11, 10))
+    assert all_day.end_time == timezone.make_aware(datetime.datetime(2025, 11, 11))
+    assert timed.shift_type == "oncall"
+    assert timed.start_time == datetime.datetime(2025, 11, 11, 2, 30, tzinfo=UTC)
+    assert timed.end_time == datetime.datetime(2025, 11, 11, 14, 30, tzinfo=UTC)
@@ -0,0 +1,127 @@
+"""
+Organization directory tree: organization -> locations -> departments -> units, in one response.
+
+The tree is built with four queries and cached in Redis under a per-organization version token.
+Signals in `scheduling.signals` replace the token after any change to the organization's
+locations, departments, units, memberships or addresses. The token is also the ETag, so
+clients revalidating an unchanged tree get a 304 without the tree being read.
+"""
+import json
+import uuid
+
+from django.conf import settings
+from django.db.models import Count
+
+from rapidconsult.chats.presence import r
+from rapidconsult.scheduling.models import Department, Location, Organization, Unit, UnitMembership
+
+
+def _version_key(org_id):
+    return f"scheduling:tree:version:{org_id}"
+
+
+def _image_url(image):
+    return image.url if image else None
+
+
+def _version(org_id):
+    version = r.get(_version_key(org_id))
+    if version is None:
+        r.set(_version_key(org_id), uuid.uuid4().hex[:12], nx=True)
+        version = r.get(_version_key(org_id))
+    return version
+
+
+def _etag(org_id, version):
+    return f'"tree-{org_id}-{version}"'
+
+
+def get_org_tree_etag(org_id):
+    return _etag(org_id, _version(org_id))
+
+
+def build_org_tree(org_id):
+    from rapidconsult.scheduling.api.serializers import AddressSerializer, OrganizationSerializer
+
+    organization = Organization.objects.select_related("address").get(id=org_id)
+    locations = Location.objects.filter(organization_id=org_id).select_related("address").order_by("name", "id")
+    departments = Department.objects.filter(location__organization_id=org_id).order_by("name", "id")
+    units = (
+        Unit.objects.filter(department__location__organization_id=org_id)
+        .annotate(member_count=Count("unitmembership"))
+        .order_by("name", "id")
+    )
+
+    units_by_department = {}
+    for unit in units:
+        units_by_department.setdefault(unit.department_id, []).append({
+            "id": unit.id,
+            "name": unit.name,
+            "display_picture": _image_url(unit.display_picture),
+            "member_count": unit.member_count,
+        })
+
+    departments_by_location = {}
+    for department in departments:
+        departments_by_location.setdefault(department.location_id, []).append({
+            "id": department.id,
+            "name": department.name,
+            "display_picture": _image_url(department.display_picture),
+            "units": units_by_department.get(department.id, []),
+        })
+
+    return {
+        **OrganizationSerializer(organization).data,
+        "locations": [
+            {
+                "id": location.id,
+                "name": location.name,
+                "address": AddressSerializer(location.address).data if location.address else None,
+                "display_picture": _image_url(location.display_picture),
+                "departments": departments_by_location.get(location.id, []),
+            }
+            for location in locations
+        ],
+    }
+
+
+def get_org_tree(org_id):
+    """(tree, etag) of the organization, from the cache when its version is unchanged."""
+    version = _version(org_id)
+    key = f"scheduling:tree:{org_id}:{version}"
+
+    raw = r.get(key)
+    if raw is not None:
+        return json.loads(raw), _etag(org_id, version)
+
+    tree = build_org_tree(org_id)
+    r.set(key, json.dumps(tree), ex=settings.ORG_TREE_CACHE_TTL)
+    return tree, _etag(org_id, version)
+
+
+def tree_organization_ids(instance):
+    """Ids of the organizations whose tree shows `instance` (as currently stored)."""
+    if isinstance(instance, Organization):
+        return {instance.pk}
+    if isinstance(instance, Location):
+        return {instance.organization_id}
+    if isinstance(instance, Department):
+        return set(Location.objects.filter(id=instance.location_id).values_list("organization_id", flat=True))
+    if isinstance(instance, Unit):
+        return set(Department.objects.filter(id=instance.department_id).values_list(
+            "location__organization_id", flat=True))
+    if isinstance(instance, UnitMembership):
+        return set(Unit.objects.filter(id=instance.unit_id).values_list(
+            "department__location__organization_id", flat=True))
+    # Address: shared by organizations and locations
+    return (set(Organization.objects.filter(address_id=instance.pk).values_list("id", flat=True))
+            | set(Location.objects.filter(address_id=instance.pk).values_list("organization_id", flat=True)))
+
+
+def invalidate_org_tree(*org_ids):
+    org_ids = {org_id for org_id in org_ids if org_id is not None}
+    if org_ids:
+        pipe = r.pipeline(transaction=False)
+        for org_id in org_ids:
+            pipe.set(_version_key(org_id), uuid.uuid4().hex[:12])
+        pipe.execute()
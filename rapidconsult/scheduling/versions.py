@@ -0,0 +1,45 @@
+"""
+Version counters of the read-mostly scheduling lists, per kind of row and organization.
+
+`scheduling.signals` bumps the counters of a kind after any change to its rows, both for the
+organization the row belongs to and for "all" (lists that are not filtered by organization).
+Cached list pages (`scheduling.api.caching`) are keyed and ETagged by the counters they were
+built from, so a bump makes every page that could show the change miss.
+"""
+import time
+
+from rapidconsult.chats.presence import r
+
+ORGANIZATION, LOCATION, DEPARTMENT, UNIT, ROLE = "organization", "location", "department", "unit", "role"
+ALL = "all"
+# Roles are not tied to an organization
+GLOBAL_KINDS = {ROLE}
+
+
+def _key(kind, scope):
+    return f"scheduling:version:{kind}:{scope}"
+
+
+def get_versions(kinds, scope=ALL):
+    """Current counter of each kind for `scope` (an organization id or ALL), in one round trip."""
+    keys = [_key(kind, ALL if kind in GLOBAL_KINDS else scope) for kind in kinds]
+    versions = r.mget(keys)
+    missing = [key for key, version in zip(keys, versions) if version is None]
+    if missing:
+        # Start an evicted or new counter past anything it may have reached before, so no
+        # page cached under an earlier value can match it again
+        pipe = r.pipeline(transaction=False)
+        for key in missing:
+            pipe.set(key, time.time_ns(), nx=True)
+        pipe.execute()
+        versions = r.mget(keys)
+    return versions
+
+
+def bump_versions(kinds, org_ids=()):
+    scopes = {str(org_id) for org_id in org_ids if org_id is not None} | {ALL}
+    pipe = r.pipeline(transaction=False)
+    for kind in kinds:
+        for scope in ({ALL} if kind in GLOBAL_KINDS else scopes):
+            pipe.incr(_key(kind, scope))
+    pipe.execute()
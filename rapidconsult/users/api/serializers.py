@@ -1,8 +1,8 @@
 from rest_framework import serializers
 
-from config.roles import get_permissions_for_role
+from rapidconsult.users.bootstrap import serialize_organizations
 from rapidconsult.users.models import User, Contact
-from rapidconsult.scheduling.models import UserOrgProfile
+from rapidconsult.scheduling.models import DirectoryEntry, UserOrgProfile
 
 
 class ContactSerializer(serializers.ModelSerializer):
@@ -37,20 +37,8 @@ class UserSerializer(serializers.ModelSerializer):
         }
 
     def get_organizations(self, user):
-        from rapidconsult.scheduling.api.serializers import OrganizationSerializer, RoleSerializer, LocationSerializer
-        org_profiles = user.org_profiles.select_related("organization", "role")
-        orgs_data = []
-        for profile in org_profiles:
-            org_data = {
-                "id": profile.id,
-                "organization": OrganizationSerializer(profile.organization).data,
-                "role": RoleSerializer(profile.role).data if profile.role else None,
-                "job_title": profile.job_title,
-                "permissions": get_permissions_for_role(profile.role.name) if profile.role else [],
-                "allowed_locations": LocationSerializer(profile.allowed_locations.all(), many=True).data,
-            }
-            orgs_data.append(org_data)
-        return orgs_data
+        # Query-free when `user` comes from a queryset with ORG_PROFILES_PREFETCH
+        return serialize_organizations(user)
 
     def get_queryset(self):
         user = self.request.user
@@ -95,3 +83,27 @@ class UserSerializer(serializers.ModelSerializer):
                 user_org_profile.save()
 
         return instance
+
+
+class DirectoryUserSerializer(serializers.ModelSerializer):
+    """Slim directory entry; `job_title` / `role` are annotated by search_directory when an org is given."""
+    job_title = serializers.SerializerMethodField()
+    role = serializers.SerializerMethodField()
+
+    class Meta:
+        model = User
+        fields = ["id", "username", "name", "profile_picture", "job_title", "role"]
+
+    def get_job_title(self, user):
+        return getattr(user, "job_title", None)
+
+    def get_role(self, user):
+        return getattr(user, "role_name", None)
+
+
+class DirectoryEntrySerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source="user_id")
+
+    class Meta:
+        model = DirectoryEntry
+        fields = ["id", "name", "avatar", "job_title", "role", "primary_contact"]
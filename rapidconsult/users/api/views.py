@@ -1,7 +1,9 @@
-from django.db.models.query_utils import Q
+from django.conf import settings
+from django.utils.http import parse_etags
 from rest_framework import status
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.mixins import ListModelMixin
 from rest_framework.mixins import RetrieveModelMixin
 from rest_framework.mixins import UpdateModelMixin
@@ -9,18 +11,23 @@ from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.authtoken.models import Token
 
+from rapidconsult.scheduling.access import get_access
+from rapidconsult.scheduling.directory import get_directory_changes, search_directory
+from rapidconsult.users.bootstrap import ORG_PROFILES_PREFETCH, absolutize_bootstrap, get_bootstrap, \
+    get_bootstrap_etag
+from rapidconsult.chats.api.serializers import MongoMessageSerializer, UserConversationSerializer
+from rapidconsult.scheduling.api.serializers import ConsultationSerializer, OnCallShiftSerializer
 from rapidconsult.users.models import User, Contact
-from rapidconsult.scheduling.api.serializers import OrganizationSerializer, RoleSerializer, LocationSerializer
+from rapidconsult.users.sync import SyncTokenExpired, decode_token, get_changes
 
-from .serializers import UserSerializer
-from config.roles import get_permissions_for_role
+from .serializers import DirectoryEntrySerializer, DirectoryUserSerializer, UserSerializer
 from rest_framework import viewsets, permissions
 from .serializers import ContactSerializer
 
 
 class UserViewSet(RetrieveModelMixin, ListModelMixin, UpdateModelMixin, GenericViewSet):
     serializer_class = UserSerializer
-    queryset = User.objects.all()
+    queryset = User.objects.prefetch_related(ORG_PROFILES_PREFETCH)
     lookup_field = "username"
 
     @action(detail=False, methods=["post"], url_path="register")
@@ -63,34 +70,72 @@ class UserViewSet(RetrieveModelMixin, ListModelMixin, UpdateModelMixin, GenericV
         )
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=["get"], url_path="bootstrap")
+    def bootstrap(self, request):
+        """
+        The login payload without the token, for refreshing org data.
+        Send the last ETag as If-None-Match to get a 304 when nothing changed.
+        """
+        etag = get_bootstrap_etag(request.user.id)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        payload, etag = get_bootstrap(request.user.id)
+        return Response(absolutize_bootstrap(request, payload), headers={"ETag": etag})
+
+    @action(detail=False, methods=["get"], url_path="directory")
+    def directory(self, request):
+        """
+        Contact-picker directory of one location. Without `since` every active entry is returned;
+        with the `version` of a previous response, only entries changed since and removed user ids.
+        """
+        location_id = request.query_params.get("location_id")
+        since = request.query_params.get("since")
+        if not location_id or not location_id.isdigit():
+            return Response({"detail": "Missing location_id"}, status=status.HTTP_400_BAD_REQUEST)
+        if since is not None and not since.isdigit():
+            return Response({"detail": "since must be a directory version"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not any(location_id in locations for locations in get_access(request.user.id).values()):
+            raise PermissionDenied("You do not have access to this location.")
+
+        version, entries, removed, full = get_directory_changes(
+            int(location_id), int(since) if since is not None else None
+        )
+        return Response({
+            "location_id": int(location_id),
+            "version": version,
+            "full": full,
+            "entries": DirectoryEntrySerializer(entries, many=True).data,
+            "removed": removed,
+        })
+
     @action(detail=False, methods=["get"], url_path="search")
     def search(self, request):
         query = request.query_params.get("q", "").strip()
         if not query:
             return Response({"detail": "Missing search query"}, status=status.HTTP_400_BAD_REQUEST)
 
-        queryset = self.queryset.filter(Q(name__icontains=query)).distinct()
-        org_id = request.query_params.get("organization_id")
-        location_id = request.query_params.get("location_id")
-
-        # Exclude the user making the request
-        queryset = queryset.exclude(id=request.user.id)
+        queryset = search_directory(
+            query,
+            organization_id=request.query_params.get("organization_id"),
+            location_id=request.query_params.get("location_id"),
+        ).exclude(id=request.user.id)
 
-        if org_id:
-            queryset = queryset.filter(
-                org_profiles__organization_id=org_id
-            ).distinct()
+        # Full entries (with `organizations`) stay the default for existing clients; pickers that
+        # only show names ask for the slim shape, which needs no profile prefetch
+        if request.query_params.get("slim") in ("1", "true"):
+            serializer_class = DirectoryUserSerializer
+        else:
+            serializer_class = UserSerializer
+            queryset = queryset.prefetch_related(ORG_PROFILES_PREFETCH)
 
-        if location_id:
-            queryset = queryset.filter(
-                org_profiles__allowed_locations__id=location_id
-            ).distinct()
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = UserSerializer(page, many=True, context={"request": request})
+            serializer = serializer_class(page, many=True, context={"request": request})
             return self.get_paginated_response(serializer.data)
 
-        serializer = UserSerializer(queryset, many=True, context={"request": request})
+        serializer = serializer_class(queryset, many=True, context={"request": request})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
@@ -101,27 +146,11 @@ class CustomObtainAuthTokenView(ObtainAuthToken):
         user = serializer.validated_data["user"]
         token, created = Token.objects.get_or_create(user=user)
 
-        org_profiles = user.org_profiles.select_related('organization', 'role')
-        orgs_data = []
-        for profile in org_profiles:
-            org_data = {
-                "id": profile.id,
-                "organization": OrganizationSerializer(profile.organization).data,
-                "role": RoleSerializer(profile.role).data if profile.role else None,
-                "job_title": profile.job_title,
-                "permissions": get_permissions_for_role(profile.role.name) if profile.role else [],
-                "allowed_locations": LocationSerializer(profile.allowed_locations.all(), many=True).data,
-            }
-            orgs_data.append(org_data)
-
-        return Response({
-            "id": user.id,
-            "token": token.key,
-            "username": user.username,
-            "profile_picture": request.build_absolute_uri(user.profile_picture.url)
-            if user.profile_picture else None,
-            "organizations": orgs_data
-        })
+        payload, etag = get_bootstrap(user.id)
+        return Response(
+            {**absolutize_bootstrap(request, payload), "token": token.key},
+            headers={"ETag": etag},
+        )
 
 
 class ContactViewSet(viewsets.ModelViewSet):
@@ -133,3 +162,39 @@ class ContactViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
+
+
+class SyncViewSet(viewsets.ViewSet):
+    """
+    Offline-mode delta sync.
+    Example:
+        GET /api/sync/                 -> everything current, plus a token
+        GET /api/sync/?since=<token>   -> only what changed after the token
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        since = request.query_params.get("since")
+        try:
+            limit = min(int(request.query_params.get("limit", settings.SYNC_PAGE_SIZE)), settings.SYNC_PAGE_SIZE)
+        except ValueError:
+            return Response({"detail": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            cursors = decode_token(since) if since else None
+        except SyncTokenExpired:
+            # Unknown or too old to report removals reliably: the client starts over
+            cursors = None
+        changes = get_changes(request.user, cursors, max(limit, 1))
+
+        context = {"request": request}
+        return Response({
+            "token": changes["token"],
+            "full": changes["full"],
+            "has_more": changes["has_more"],
+            "conversations": UserConversationSerializer(changes["conversations"], many=True).data,
+            "messages": MongoMessageSerializer(changes["messages"], many=True).data,
+            "consultations": ConsultationSerializer(changes["consultations"], many=True, context=context).data,
+            "shifts": OnCallShiftSerializer(changes["shifts"], many=True, context=context).data,
+            "removed": changes["removed"],
+        })
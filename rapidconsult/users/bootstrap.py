@@ -0,0 +1,110 @@
+"""
+Session bootstrap payload: the user and their organizations, roles, permissions and allowed
+locations, as returned at login and by `GET /api/users/bootstrap/`.
+
+The payload is built from one prefetched query set and cached in Redis per user, under a key
+made of two version tokens: one for the user (their profile, org profiles and allowed
+locations) and one shared by everybody (organizations, locations, addresses, roles). Signals
+replace the relevant token after commit, which orphans the stale payloads. The same
+tokens make up the ETag, so an unchanged payload is answered with a 304 without being read.
+"""
+import json
+import uuid
+
+from django.conf import settings
+from django.db.models import Prefetch
+
+from config.roles import get_permissions_for_role
+from rapidconsult.chats.presence import r
+from rapidconsult.scheduling.models import Location, UserOrgProfile
+
+GLOBAL_VERSION_KEY = "users:bootstrap:version"
+
+ORG_PROFILES_PREFETCH = Prefetch(
+    "org_profiles",
+    queryset=UserOrgProfile.objects.select_related("organization__address", "role").prefetch_related(
+        Prefetch("allowed_locations", queryset=Location.objects.select_related("address"))
+    ),
+)
+
+
+def _user_version_key(user_id):
+    return f"users:bootstrap:version:{user_id}"
+
+
+def serialize_organizations(user):
+    """The `organizations` list of a user fetched with ORG_PROFILES_PREFETCH (no further queries)."""
+    from rapidconsult.scheduling.api.serializers import OrganizationSerializer, RoleSerializer, LocationSerializer
+
+    orgs_data = []
+    for profile in user.org_profiles.all():
+        orgs_data.append({
+            "id": profile.id,
+            "organization": OrganizationSerializer(profile.organization).data,
+            "role": RoleSerializer(profile.role).data if profile.role else None,
+            "job_title": profile.job_title,
+            "permissions": get_permissions_for_role(profile.role.name) if profile.role else [],
+            "allowed_locations": LocationSerializer(profile.allowed_locations.all(), many=True).data,
+        })
+    return orgs_data
+
+
+def _versions(user_id):
+    keys = [GLOBAL_VERSION_KEY, _user_version_key(user_id)]
+    versions = r.mget(keys)
+    if None in versions:
+        for key, version in zip(keys, versions):
+            if version is None:
+                r.set(key, uuid.uuid4().hex[:12], nx=True)
+        versions = r.mget(keys)
+    return versions
+
+
+def _etag(user_id, global_version, user_version):
+    return f'"bootstrap-{user_id}-{global_version}-{user_version}"'
+
+
+def get_bootstrap_etag(user_id):
+    return _etag(user_id, *_versions(user_id))
+
+
+def get_bootstrap(user_id):
+    """(payload, etag) for the user; `profile_picture` is left relative for the caller to absolutize."""
+    global_version, user_version = _versions(user_id)
+    etag = _etag(user_id, global_version, user_version)
+    key = f"users:bootstrap:{user_id}:{global_version}:{user_version}"
+
+    raw = r.get(key)
+    if raw is not None:
+        return json.loads(raw), etag
+
+    from rapidconsult.users.models import User
+
+    user = User.objects.prefetch_related(ORG_PROFILES_PREFETCH).get(id=user_id)
+    payload = {
+        "id": user.id,
+        "username": user.username,
+        "profile_picture": user.profile_picture.url if user.profile_picture else None,
+        "organizations": serialize_organizations(user),
+    }
+    r.set(key, json.dumps(payload), ex=settings.BOOTSTRAP_CACHE_TTL)
+    return payload, etag
+
+
+def absolutize_bootstrap(request, payload):
+    if payload["profile_picture"]:
+        payload = {**payload, "profile_picture": request.build_absolute_uri(payload["profile_picture"])}
+    return payload
+
+
+def invalidate_user_bootstrap(*user_ids):
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if user_ids:
+        pipe = r.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.set(_user_version_key(user_id), uuid.uuid4().hex[:12])
+        pipe.execute()
+
+
+def invalidate_all_bootstrap():
+    r.set(GLOBAL_VERSION_KEY, uuid.uuid4().hex[:12])
@@ -0,0 +1,29 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_user_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('conversation', 'Conversation'), ('consultation', 'Consultation'),
+                                                   ('shift', 'Shift')], max_length=20)),
+                ('object_id', models.CharField(max_length=64)),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user_id', models.BigIntegerField()),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['user_id', 'deleted_at', 'id'], name='users_tombstone_sync_idx'),
+                    models.Index(fields=['deleted_at'], name='users_tombstone_prune_idx'),
+                ],
+            },
+        ),
+    ]
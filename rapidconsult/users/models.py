@@ -1,8 +1,11 @@
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.conf import settings
 from django.db import models
 from django.db.models import CharField
+from django.db.models.functions import Upper
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
@@ -19,6 +22,14 @@ class User(AbstractUser):
     last_name = None  # type: ignore[assignment]
     profile_picture = models.ImageField(upload_to="profile/", blank=True, null=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Trigram indexes for the staff directory search (`icontains` compiles to UPPER(col) LIKE)
+            GinIndex(OpClass(Upper("name"), name="gin_trgm_ops"), name="users_user_name_trgm"),
+            GinIndex(OpClass(Upper("username"), name="gin_trgm_ops"), name="users_user_username_trgm"),
+            GinIndex(OpClass(Upper("email"), name="gin_trgm_ops"), name="users_user_email_trgm"),
+        ]
+
     def get_absolute_url(self) -> str:
         """Get URL for user's detail view.
         Returns:
@@ -65,3 +76,31 @@ class Contact(models.Model):
     def __str__(self):
         prefix = f"{self.country_code} " if self.country_code else ""
         return f"{self.label or 'Phone'}: {prefix}{self.number}"
+
+
+class SyncTombstone(models.Model):
+    """
+    Something a user could see and no longer can (a deleted shift, a group they left, ...).
+    Reported as removed by /api/sync/ until `prune_sync_tombstones` drops it.
+    """
+    KIND_CHOICES = [
+        ('conversation', 'Conversation'),
+        ('consultation', 'Consultation'),
+        ('shift', 'Shift'),
+    ]
+
+    # No foreign key: tombstones are written while the user's own rows may be cascading away
+    user_id = models.BigIntegerField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Conversation ids are Mongo ObjectIds, the rest are primary keys
+    object_id = models.CharField(max_length=64)
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'deleted_at', 'id'], name='users_tombstone_sync_idx'),
+            models.Index(fields=['deleted_at'], name='users_tombstone_prune_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} removed for {self.user_id}"
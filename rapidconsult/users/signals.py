@@ -1,11 +1,17 @@
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from rapidconsult.chats.mongo.models import User as MongoUser
 from mongoengine import DoesNotExist
 
-from rapidconsult.scheduling.models import UserOrgProfile
-from .models import User
+from rapidconsult.scheduling.directory import refresh_directory_entries
+from rapidconsult.scheduling.feeds import invalidate_feeds
+from rapidconsult.scheduling.models import OnCallShift, UserOrgProfile
+from rapidconsult.scheduling.roster import invalidate_rosters
+from rapidconsult.scheduling.versions import UNIT, bump_versions
+from rapidconsult.users.bootstrap import invalidate_user_bootstrap
+from .models import Contact, User
 
 
 @receiver(post_save, sender=User)
@@ -33,6 +39,45 @@ def sync_user_to_mongo(sender, instance, created, **kwargs):
     mongo_user.save()
 
 
+@receiver(post_save, sender=User)
+def refresh_user_caches(sender, instance, update_fields=None, **kwargs):
+    # Logging in only touches last_login, which neither the bootstrap payload nor the directory shows
+    if update_fields and set(update_fields) <= {"last_login"}:
+        return
+    transaction.on_commit(lambda: invalidate_user_bootstrap(instance.pk))
+    refresh_directory_entries([instance.pk])
+
+
+@receiver(post_save, sender=User)
+def refresh_user_display_caches(sender, instance, update_fields=None, **kwargs):
+    # Calendar feeds, roster grids and unit lists show the user's name
+    if update_fields and set(update_fields) <= {"last_login"}:
+        return
+    units = list(OnCallShift.objects.filter(user__user=instance).values_list("unit_id", "unit__department_id").distinct())
+    unit_ids = {unit_id for unit_id, _ in units}
+    department_ids = {department_id for _, department_id in units}
+    org_ids = set(UserOrgProfile.objects.filter(user=instance).values_list("organization_id", flat=True))
+
+    def invalidate():
+        invalidate_feeds(unit_ids, [instance.pk])
+        invalidate_rosters(*department_ids)
+        bump_versions([UNIT], org_ids)
+
+    transaction.on_commit(invalidate)
+
+
 @receiver(post_delete, sender=User)
 def delete_mongo_user(sender, instance, **kwargs):
     MongoUser.objects(sql_user_id=str(instance.pk)).delete()
+
+
+@receiver(post_delete, sender=User)
+def remove_from_directory(sender, instance, **kwargs):
+    # Leaves tombstones behind, so clients syncing the directory drop the user
+    refresh_directory_entries([instance.pk])
+
+
+@receiver(post_save, sender=Contact)
+@receiver(post_delete, sender=Contact)
+def refresh_contact_directory(sender, instance, **kwargs):
+    refresh_directory_entries([instance.user_id])
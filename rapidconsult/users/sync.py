@@ -0,0 +1,164 @@
+"""
+Delta sync for the mobile app's offline mode (`GET /api/sync/?since=<token>`).
+
+One request returns what changed for the user since the token in four sections (inbox rows,
+messages, consultations, shifts) plus the ids of what they can no longer see. Each section is
+read in (changed at, id) order along an index: UserConversation.updatedAt, Message.timestamp,
+Consultation.updated_at, OnCallShift.updated_at and SyncTombstone.deleted_at. The token holds
+one cursor per section, so a page cut short by the size bound resumes exactly where it
+stopped, and rows changed while a client pages through move ahead of its cursor instead of
+being missed.
+
+Rows are only read up to a few seconds in the past (SYNC_SAFETY_LAG): a row whose change
+time is stamped before its transaction commits still lands behind a cursor taken later.
+"""
+import datetime
+
+from bson import ObjectId
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+
+from rapidconsult.chats.mongo.models import Message, UserConversation
+from rapidconsult.scheduling.models import Consultation, OnCallShift, UserOrgProfile
+from rapidconsult.users.models import SyncTombstone
+
+SYNC_SALT = "rapidconsult.users.sync"
+SECTIONS = ("conversations", "messages", "consultations", "shifts", "removed")
+
+
+class SyncTokenExpired(Exception):
+    pass
+
+
+def record_removals(kind, object_id, user_ids):
+    """Tell the given users' next sync that they can no longer see `object_id`."""
+    SyncTombstone.objects.bulk_create([
+        SyncTombstone(user_id=int(user_id), kind=kind, object_id=str(object_id))
+        for user_id in set(user_ids) if user_id is not None
+    ])
+
+
+def clear_removals(kind, object_id, user_ids):
+    """Drop stale tombstones of something the users can see again, so a later page cannot remove it."""
+    user_ids = {int(user_id) for user_id in user_ids if user_id is not None}
+    if user_ids:
+        SyncTombstone.objects.filter(kind=kind, object_id=str(object_id), user_id__in=user_ids).delete()
+
+
+def encode_token(cursors):
+    return signing.dumps(cursors, salt=SYNC_SALT, compress=True)
+
+
+def decode_token(token):
+    """Cursors of a token: {section: [changed at ISO string, id or None]}."""
+    try:
+        cursors = signing.loads(token, salt=SYNC_SALT)
+        parsed = {section: (datetime.datetime.fromisoformat(cursors[section][0]), cursors[section][1])
+                  for section in SECTIONS}
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise SyncTokenExpired
+    # Tombstones older than the retention are pruned, so the removals can no longer be reported
+    if parsed["removed"][0] < timezone.now() - datetime.timedelta(days=settings.SYNC_TOMBSTONE_DAYS):
+        raise SyncTokenExpired
+    return parsed
+
+
+def _naive_utc(value):
+    # Mongo dates are stored as naive UTC
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _aware(value):
+    return value if timezone.is_aware(value) else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def _sql_after(queryset, field, cursor, upper):
+    if cursor is not None:
+        changed_at, last_id = cursor
+        after = Q(**{f"{field}__gt": changed_at})
+        if last_id is not None:
+            after |= Q(**{field: changed_at, "id__gt": last_id})
+        queryset = queryset.filter(after)
+    return queryset.filter(**{f"{field}__lte": upper}).order_by(field, "id")
+
+
+def _mongo_after(field, cursor, upper, id_type=str):
+    query = {field: {"$lte": _naive_utc(upper)}}
+    if cursor is not None:
+        changed_at, last_id = cursor
+        after = [{field: {"$gt": _naive_utc(changed_at)}}]
+        if last_id is not None:
+            after.append({field: _naive_utc(changed_at), "_id": {"$gt": id_type(last_id)}})
+        query["$or"] = after
+    return query
+
+
+def _page(rows, limit, changed_at, upper):
+    """(rows, next cursor, more) of a section read with limit + 1."""
+    rows = list(rows)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, [_aware(getattr(last, changed_at)).isoformat(), str(last.pk)], True
+    # Caught up: the next sync starts strictly after this read's upper bound
+    return rows, [upper.isoformat(), None], False
+
+
+def get_changes(user, cursors=None, limit=None):
+    """
+    Changes for `user` after `cursors` (None for a first, full sync). Returns a dict with the
+    changed rows of each section, the removed ids by kind, the next cursors and whether more
+    is waiting.
+    """
+    limit = limit or settings.SYNC_PAGE_SIZE
+    upper = timezone.now() - datetime.timedelta(seconds=settings.SYNC_SAFETY_LAG)
+    full = cursors is None
+    if full:
+        # Everything current, but only messages and removals from now on: history is paged
+        # through /api/messages/ and a fresh client has nothing to remove
+        cursors = {"conversations": None, "consultations": None, "shifts": None,
+                   "messages": (upper, None), "removed": (upper, None)}
+    user_id = str(user.id)
+    next_cursors, changes, more = {}, {}, False
+
+    conversations = UserConversation.objects(userId=user_id, __raw__=_mongo_after(
+        "updatedAt", cursors["conversations"], upper)).order_by("updatedAt", "_id").limit(limit + 1)
+    changes["conversations"], next_cursors["conversations"], section_more = _page(
+        conversations, limit, "updatedAt", upper)
+    more |= section_more
+
+    conversation_ids = UserConversation.objects(userId=user_id).distinct("conversationId")
+    messages = Message.objects(conversationId__in=conversation_ids, __raw__=_mongo_after(
+        "timestamp", cursors["messages"], upper, ObjectId)).order_by("timestamp", "id").limit(limit + 1)
+    changes["messages"], next_cursors["messages"], section_more = _page(messages, limit, "timestamp", upper)
+    more |= section_more
+
+    profile_ids = list(UserOrgProfile.objects.filter(user=user).values_list("id", flat=True))
+    consultations = _sql_after(
+        Consultation.objects.filter(Q(referred_by_doctor_id__in=profile_ids) | Q(referred_to_doctor_id__in=profile_ids))
+        .select_related("referred_by_doctor__user", "referred_to_doctor__user", "organization", "location",
+                        "department", "unit"),
+        "updated_at", cursors["consultations"], upper,
+    )
+    changes["consultations"], next_cursors["consultations"], section_more = _page(
+        consultations[:limit + 1], limit, "updated_at", upper)
+    more |= section_more
+
+    since = timezone.now() - datetime.timedelta(days=settings.SYNC_SHIFT_PAST_DAYS)
+    shifts = _sql_after(
+        OnCallShift.objects.filter(user_id__in=profile_ids, end_time__gte=since).select_related("user__user", "unit"),
+        "updated_at", cursors["shifts"], upper,
+    )
+    changes["shifts"], next_cursors["shifts"], section_more = _page(shifts[:limit + 1], limit, "updated_at", upper)
+    more |= section_more
+
+    removed = _sql_after(SyncTombstone.objects.filter(user_id=user.id), "deleted_at", cursors["removed"], upper)
+    tombstones, next_cursors["removed"], section_more = _page(removed[:limit + 1], limit, "deleted_at", upper)
+    more |= section_more
+    changes["removed"] = {kind: [] for kind, _ in SyncTombstone.KIND_CHOICES}
+    for tombstone in tombstones:
+        changes["removed"][tombstone.kind].append(tombstone.object_id)
+
+    return {"full": full, "has_more": more, "token": encode_token(next_cursors), **changes}
@@ -1,9 +1,21 @@
+import datetime
+
 from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
 
-from .models import User
+from .models import SyncTombstone, User
 
 
 @shared_task()
 def get_users_count():
     """A pointless Celery task to demonstrate usage."""
     return User.objects.count()
+
+
+@shared_task()
+def prune_sync_tombstones():
+    """Drop removals older than SYNC_TOMBSTONE_DAYS; tokens that old get a full sync anyway."""
+    cutoff = timezone.now() - datetime.timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+    deleted, _ = SyncTombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
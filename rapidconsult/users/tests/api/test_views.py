@@ -1,8 +1,14 @@
+import datetime
+
 import pytest
-from rest_framework.test import APIRequestFactory
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
 
-from rapidconsult.users.api.views import UserViewSet
+from rapidconsult.scheduling.access import invalidate_access
+from rapidconsult.scheduling.models import Department, Location, OnCallShift, Organization, Unit, UserOrgProfile
+from rapidconsult.users.api.views import SyncViewSet, UserViewSet
 from rapidconsult.users.models import User
+from rapidconsult.users.tests.factories import UserFactory
 
 
 class TestUserViewSet:
@@ -33,3 +39,102 @@ class TestUserViewSet:
             "url": f"http://testserver/api/users/{user.username}/",
             "name": user.name,
         }
+
+    def test_search_filters_by_location_through_directory(self, user: User, api_rf: APIRequestFactory):
+        organization = Organization.objects.create(name="General Hospital")
+        main, annex = (Location.objects.create(name=name, organization=organization) for name in ("Main", "Annex"))
+        cardiologist, other = UserFactory(name="Asha Cardiologist"), UserFactory(name="Arun Cardiologist")
+        for staff, location in ((cardiologist, main), (other, annex)):
+            profile = UserOrgProfile.objects.create(user=staff, organization=organization, job_title="Cardiologist")
+            profile.allowed_locations.add(location)
+
+        def search(**params):
+            request = api_rf.get("/fake-url/", {"q": "cardio", "organization_id": organization.id,
+                                                "location_id": main.id, **params})
+            force_authenticate(request, user=user)
+            return UserViewSet.as_view({"get": "search"})(request).data["results"]
+
+        slim = search(slim="1")
+        assert [row["id"] for row in slim] == [cardiologist.id]
+        assert slim[0]["job_title"] == "Cardiologist"
+        assert set(slim[0]) == {"id", "username", "name", "profile_picture", "job_title", "role"}
+
+        # Without `slim`, entries keep the full shape existing clients read organizations from
+        full = search()
+        assert [row["id"] for row in full] == [cardiologist.id]
+        assert full[0]["email"] == cardiologist.email
+        assert full[0]["organizations"][0]["job_title"] == "Cardiologist"
+
+    def test_search_org_members_without_locations_and_scoped_emails(self, user: User, api_rf: APIRequestFactory):
+        organization = Organization.objects.create(name="General Hospital")
+        member = UserFactory(name="Asha Rao", email="asha@general.example")
+        UserOrgProfile.objects.create(user=member, organization=organization)
+
+        def search(**params):
+            request = api_rf.get("/fake-url/", params)
+            force_authenticate(request, user=user)
+            return [row["id"] for row in UserViewSet.as_view({"get": "search"})(request).data["results"]]
+
+        assert search(q="asha", organization_id=organization.id) == [member.id]
+        assert search(q="@general.example", organization_id=organization.id) == [member.id]
+        assert search(q="@general.example") == []
+
+    def test_directory_delta_sync(self, user: User, api_rf: APIRequestFactory):
+        organization = Organization.objects.create(name="General Hospital")
+        location = Location.objects.create(name="Main", organization=organization)
+        UserOrgProfile.objects.create(user=user, organization=organization).allowed_locations.add(location)
+        colleague = UserFactory(name="Asha Rao")
+        profile = UserOrgProfile.objects.create(user=colleague, organization=organization, job_title="Resident")
+        profile.allowed_locations.add(location)
+        # on_commit hooks do not run inside the test transaction
+        invalidate_access(user.id)
+
+        def sync(**params):
+            request = api_rf.get("/fake-url/", {"location_id": location.id, **params})
+            force_authenticate(request, user=user)
+            return UserViewSet.as_view({"get": "directory"})(request).data
+
+        snapshot = sync()
+        assert snapshot["full"] is True
+        assert {entry["id"] for entry in snapshot["entries"]} == {user.id, colleague.id}
+
+        profile.job_title = "Cardiologist"
+        profile.save()
+        delta = sync(since=snapshot["version"])
+        assert [(entry["id"], entry["job_title"]) for entry in delta["entries"]] == [(colleague.id, "Cardiologist")]
+
+        profile.allowed_locations.remove(location)
+        delta = sync(since=delta["version"])
+        assert delta["entries"] == []
+        assert delta["removed"] == [colleague.id]
+        assert sync(since=delta["version"])["entries"] == []
+
+    def test_offline_sync_pages_and_removals(self, user: User, api_rf: APIRequestFactory, settings):
+        settings.SYNC_SAFETY_LAG = 0
+        organization = Organization.objects.create(name="General Hospital")
+        location = Location.objects.create(name="Main", organization=organization)
+        unit = Unit.objects.create(name="ICU", department=Department.objects.create(name="Medicine", location=location))
+        profile = UserOrgProfile.objects.create(user=user, organization=organization)
+        start = timezone.now()
+        shifts = [
+            OnCallShift.objects.create(user=profile, unit=unit, start_time=start + datetime.timedelta(days=day),
+                                       end_time=start + datetime.timedelta(days=day, hours=8))
+            for day in range(3)
+        ]
+
+        def sync(**params):
+            request = api_rf.get("/fake-url/", params)
+            force_authenticate(request, user=user)
+            return SyncViewSet.as_view({"get": "list"})(request).data
+
+        first = sync(limit=2)
+        assert first["full"] is True and first["has_more"] is True
+        second = sync(since=first["token"], limit=2)
+        assert second["full"] is False and second["has_more"] is False
+        assert [shift["id"] for shift in first["shifts"] + second["shifts"]] == [shift.id for shift in shifts]
+
+        shifts[0].delete()
+        delta = sync(since=second["token"])
+        assert delta["shifts"] == []
+        assert delta["removed"]["shift"] == [str(shifts[0].id)]
+        assert sync(since="not-a-token")["full"] is True